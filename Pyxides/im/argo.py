@@ -6,7 +6,6 @@ from astropy.io import fits as pyfits
 import numpy
 import math
 import pyrap.tables
-import subprocess
 import im
 import tempfile
 import ms
@@ -165,9 +164,7 @@ def findImager(path,imager_name=None):
         else : 
             return False
     # Look in system path
-    check_path = subprocess.Popen(['which',path],stderr=subprocess.PIPE,stdout=subprocess.PIPE)
-    stdout = check_path.stdout.read().strip()
-    if stdout : 
+    if find_exec(path):
         return path
 #   # Check aliases
 #   ##TODO: [@sphe] Potential issues with looking in aliases. Might need to review this
@@ -220,7 +217,7 @@ def icasa(taskname, mult=None, loadthese=[], **kw0):
     # we want get back to the working directory once casapy is launched
     cdir = os.path.realpath('.')
     
-    casapy = xro.which("casapy").strip() or xro.which("casa").strip() 
+    casapy = find_exec("casapy") or find_exec("casa") or ""
     # load modules in loadthese
     _load = ""
     if "os" not in loadthese or "import os" not in loadthese:
@@ -29,6 +29,10 @@ _casa_known_args = {4.10:set('vis imagename outlierfile field spw selectdata tim
                     4.22:set('calready fitmachine mosweight noise scaletype veltype'.split()),
 }
 
+@template_inputs("im.npix im.cellsize im.mode im.stokes im.weight im.robust im.niter im.gain im.threshold "
+                 "im.wprojplanes im.cachesize im.ifrs im.fixed im.flux_rescale im.velocity im.no_weight_fov",
+                 outputs="npix cellsize mode stokes weight robust niter gain threshold "
+                 "wprojplanes cachesize ifrs fixed flux_rescale velocity no_weight_fov",cache=0)
 def STANDARD_IMAGING_OPTS_Template():
     global npix,cellsize,mode,stokes,weight,robust,niter,gain,threshold
     global wprojplanes,cachesize,ifrs,fixed,flux_rescale,velocity,no_weight_fov
@@ -54,6 +58,7 @@ def STANDARD_IMAGING_OPTS_Template():
 
 # whenever the path changes, find out new version number, and build new set of arguments
 _casa_path_version = None,None;
+@template_inputs("CASA_PATH im.CASA_PATH",outputs="_casa_args")
 def CASA_VERSION_Template (path='$CASA_PATH'):
     path = interpolate_locals('path')
     path = im.argo.findImager(path)
@@ -31,22 +31,25 @@ _lwimager_known_args = {
 };
 
 # whenever the path changes, find out new version number, and build new set of arguments
-_lwimager_path_version = None,None;
+@template_inputs("LWIMAGER_PATH",outputs="_lwimager_args")
 def LWIMAGER_VERSION_Template ():
-  global _lwimager_path_version,_lwimager_args;
-  if LWIMAGER_PATH != _lwimager_path_version[0]:
-    _lwimager_path_version = LWIMAGER_PATH,lwimager_version();
-    _lwimager_args = set();
-    for version,args in _lwimager_known_args.items():
-      if version <= _lwimager_path_version[1][0]:
-        _lwimager_args.update(args); 
-  return _lwimager_path_version[1];
+  global _lwimager_args;
+  lwimager_path_version = lwimager_version();
+  _lwimager_args = set();
+  for version,args in _lwimager_known_args.items():
+    if version <= lwimager_path_version[0]:
+      _lwimager_args.update(args); 
+  return lwimager_path_version;
 
 rm_fr = x.rm.args("-fr");
 tigger_restore = x("tigger-restore");
 
 imagecalc = x("imagecalc");
 
+@template_inputs("im.npix im.cellsize im.mode im.stokes im.weight im.robust im.niter im.gain im.threshold "
+                 "im.wprojplanes im.cachesize im.ifrs im.fixed im.flux_rescale im.velocity im.no_weight_fov",
+                 outputs="npix cellsize mode stokes weight robust niter gain threshold "
+                 "wprojplanes cachesize ifrs fixed flux_rescale velocity no_weight_fov",cache=0)
 def STANDARD_IMAGING_OPTS_Template():
     global npix,cellsize,mode,stokes,weight,robust,niter,gain,threshold
     global wprojplanes,cachesize,ifrs,fixed,flux_rescale,velocity,no_weight_fov
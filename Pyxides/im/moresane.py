@@ -67,6 +67,10 @@ def deconv(dirty_image,psf_image,
     args = dict([ (arg,globals()[arg]) for arg in _moresane_args if arg in globals() and globals()[arg] is not None ]);
     args.update([ (arg,kw[arg]) for arg in _moresane_args if arg in kw ])
 
-    x.sh(argo.gen_run_cmd(path,args,suf='--',assign='=',pos_args=[dirty_image,psf_image,image_prefix]))
+    # size the core count from free job slots when running in a parallel per-loop, with corecount as the upper limit
+    with job_threads(args.get('corecount')) as ncores:
+        if ncores is not None:
+            args['corecount'] = ncores
+        x.sh(argo.gen_run_cmd(path,args,suf='--',assign='=',pos_args=[dirty_image,psf_image,image_prefix]))
 
 document_globals(deconv,'im*_IMAGE MORESANE_PATH im.MORESANE_PATH')
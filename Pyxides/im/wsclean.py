@@ -16,6 +16,8 @@ KEEP_GRIDDING_IMAGE = False
 # register ourselves with Pyxis and define the superglobals
 register_pyxis_module(superglobals="MS LSM DESTDIR");
 
+@template_inputs("im.npix im.cellsize im.mode im.stokes im.weight im.robust im.niter im.gain im.threshold",
+                 outputs="npix cellsize mode stokes weight robust niter gain threshold",cache=0)
 def STANDARD_IMAGER_OPTS_Template():
     """ Initialise standard imager options """
     global npix,cellsize,mode,stokes,weight,robust,niter,gain,threshold
@@ -55,6 +57,7 @@ _wsclean_known_args = {0:set('name predict size scale nwlayers minuvw maxuvw max
 # whenever the path changes, find out new version number, and build new set of arguments
 _wsclean_path_version = None,None;
 
+@template_inputs("WSCLEAN_PATH im.WSCLEAN_PATH",outputs="_wsclean_args")
 def WSCLEAN_VERSION_Template (path='$WSCLEAN_PATH'):
     """ initilise imager arguments """
 
@@ -146,7 +149,11 @@ def _run(msname='$MS',clean=False,path='${im.WSCLEAN_PATH}',**kw):
         args['niter'] = 0
 
     ms.FIELD is not None and args.setdefault('field',ms.FIELD)
-    x.sh(argo.gen_run_cmd(path,args,suf='-',assign=' ',pos_args=[msname] if not isinstance(msname,(list,tuple)) else msname))
+    # size the thread count from free job slots when running in a parallel per-loop, with -j as the upper limit
+    with job_threads(args.get('j')) as nthreads:
+        if nthreads is not None and 'j' in _wsclean_args:
+            args['j'] = nthreads
+        x.sh(argo.gen_run_cmd(path,args,suf='-',assign=' ',pos_args=[msname] if not isinstance(msname,(list,tuple)) else msname))
    
 def make_image(msname='$MS',image_prefix='${im.BASENAME_IMAGE}',column='${im.COLUMN}',
                mslist=None,         # if given, overrieds msname
@@ -50,8 +50,6 @@ def run (script="$SCRIPT",job="$JOB",config="$TDLCONFIG",section="$SECTION",save
   script,job,config,section,saveconfig = interpolate_locals("script job config section saveconfig");
   section = section or os.path.splitext(os.path.basename(script))[0];
   args = [ "-c $config [$section]" ] + list(args)
-  if MULTITHREAD > 1:
-      args = [ "--mt $MULTITHREAD" ] + args
   if saveconfig:
       args = [ "--save-config $saveconfig"  ] + args
   if isinstance(options, list):
@@ -62,12 +60,16 @@ def run (script="$SCRIPT",job="$JOB",config="$TDLCONFIG",section="$SECTION",save
     args += [ "%s=%s"%(a,b) for a,b in options.items() ] + \
         [ "$EXTRA_TDLOPTS $script =$job" ]; 
 
- # run pipeliner
-  if MEMPROF:
-    args.append("--memprof");
-    pipeliner_mprof(*args);
-  else:
-    pipeliner(*args);
+ # run pipeliner. Within parallel per-loops, MULTITHREAD is an upper limit, and the number of threads depends on
+ # free job slots
+  with job_threads(MULTITHREAD) as nthreads:
+    if nthreads > 1:
+      args = [ "--mt %d"%nthreads ] + args
+    if MEMPROF:
+      args.append("--memprof");
+      pipeliner_mprof(*args);
+    else:
+      pipeliner(*args);
 
 document_globals(run,"MULTITHREAD EXTRA_TDLOPTS SCRIPT JOB SECTION TDLCONFIG SAVECONFIG");
 
@@ -64,6 +64,10 @@ def ms (msname="$MS",subtable=None,write=False):
     raise ValueError("'msname' or global MS variable must be set and valid");
   if subtable:
     msname = table(msname,ack=False).getkeyword(subtable);
+  # in a dry run, tables are never written to
+  if write and Pyxis.Internals._plan is not None:
+    Pyxis.Internals._plan.record("write",table=msname);
+    write = False;
   tab = table(msname,readonly=not write,ack=False);
   return tab;
 
@@ -514,12 +518,10 @@ define('SPW_CENTRE_MHZ',0,"centre frequency of current spectral window, MHz");
 define('SPW_BANDWIDTH_MHZ',0,"bandwidth of current spectral window, MHz");
 
 ## whenever the MS or DDID changes, look up the corresponding info on channels and spectral windows 
-_msddid = None;
+@template_inputs("MS DDID",outputs="SPWID TOTAL_CHANNELS SPW_CENTRE_MHZ SPW_BANDWIDTH_MHZ")
 def _msddid_accessed_Template ():
-  global SPWID,TOTAL_CHANNELS,SPW_CENTRE_MHZ,SPW_BANDWIDTH_MHZ,_msddid;
-  msddid = II("$MS:$DDID");
-  if msddid != _msddid and II("$MS") and DDID is not None:
-    _msddid = msddid;
+  global SPWID,TOTAL_CHANNELS,SPW_CENTRE_MHZ,SPW_BANDWIDTH_MHZ;
+  if II("$MS") and DDID is not None:
     if not exists('$MS'):
       warn("$MS doesn't exist"); 
       return None;
@@ -535,8 +537,6 @@ def _msddid_accessed_Template ():
       chans = spwtab.getcol("CHAN_FREQ",SPWID,1)[0];
       SPW_CENTRE_MHZ = (chans[0]+chans[-1])*1e-6/2;
       SPW_BANDWIDTH_MHZ = spwtab.getcol("TOTAL_BANDWIDTH",SPWID,1)[0]*1e-6;
-      # make sure this is reevaluated
-      _chanspec_Template();
       info("$MS ddid $DDID is spwid $SPWID, $TOTAL_CHANNELS channels, centred on $SPW_CENTRE_MHZ MHz, bandwidth $SPW_BANDWIDTH_MHZ MHz"); 
     except:
       warn("Error accessing $MS");
@@ -546,7 +546,7 @@ def _msddid_accessed_Template ():
 
 ## whenever the channel range changes, setup strings for TDL & Owlcat channel selection (CHAN_TDL and CHAN_OWLCAT),
 ## and also CHANSTART,CHANSTEP,NUMCHANS
-_chanspec = None;
+@template_inputs("CHANRANGE DDID TOTAL_CHANNELS",outputs="CHAN_TDL CHAN_OWLCAT CHANSTART CHANSTEP NUMCHANS")
 def _chanspec_Template ():
   global CHAN_TDL,CHAN_OWLCAT,CHANSTART,CHANSTEP,NUMCHANS;
   chans = CHANRANGE;
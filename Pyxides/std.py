@@ -23,7 +23,7 @@ copy            = x.cp.args("-a");
 plotparms       = x("plot-parms.py").args("$PLOTPARMS_ARGS");
 fitstool        = x("fitstool.py");
 
-CASAPY_AUTO = xro.which("casapy").strip() or xro.which("casa").strip()
+CASAPY_AUTO = find_exec("casapy") or find_exec("casa") or ""
 
 v.define("CASAPY_ZAPLOGS",True,"clean casapy*log and ipython*log files after successful execution of runcasapy")
 v.define("CASAPY_ZAPLOGS_ALWAYS",False,"clean casapy*log and ipython*log files after any execution of runcasapy")
@@ -7,12 +7,21 @@ import os
 import os.path
 import time
 import math
-import multiprocessing
-import queue
+import signal
+import shutil
+import tempfile
+import json
+import hashlib
+import pickle
+import shlex
+import subprocess
+import importlib
+import select
+import re
 
 import Pyxis
 import Pyxis.Internals
-from Pyxis.Internals import _int_or_str,interpolate,assign
+from Pyxis.Internals import _int_or_str,interpolate,assign_many
 
 
 DEG = math.pi/180
@@ -47,7 +56,9 @@ a Python string, and are allowed to fail.""";
   xz = Pyxis.Internals.ShellExecutorFactory(allow_fail=True,bg=True);
   xz.__name__ = 'xz';
   xz.__doc__ = xz.doc_proto%dict(name='xz') + """Shell commands launched via 'xz' are run in the background,
-in parallel with the rest of the script. They are allowed to fail, with the script continuing regardless.""";
+in parallel with the rest of the script. They are allowed to fail, with the script continuing regardless.
+At most BG_JOBS commands run at a time, with the rest queued. Each call returns a handle: use e.g. job.wait()
+to wait for a command and get its exit code, or wait_all() to wait for all background commands.""";
 
   v = Pyxis.Internals.GlobalVariableSpace(context);
   object.__setattr__(v,'__name__','v');
@@ -78,6 +89,15 @@ def _II (*strings):
   return ret[0] if len(strings)<2 else ret;
 
 II = _II;  
+
+# made available to recipes (and used by the command line parser) via Pyxis.Commands
+assign = Pyxis.Internals.assign;
+
+# background job functions, made available to recipes via "from Pyxis.Commands import *"
+wait_all = Pyxis.Internals.wait_all;
+gather = Pyxis.Internals.gather;
+# likewise for sizing the thread count of multithreaded tools from the job slots of a per-loop
+job_threads = Pyxis.Internals.job_threads;
   
 _subprocess_id = None;  
   
@@ -92,12 +112,16 @@ def _message (*msg,**kw):
   sync = kw.get("sync");
   quiet = ( Pyxis.Context.get('QUIET') or kw.get("quiet") ) and not kw.get('critical'); 
   if sys.stdout is not sys.__stdout__:
-    if sync:
+    # logfiles set up by set_logfile() are append-only and written by a background thread, so no locking is needed,
+    # but sync messages are written out immediately
+    lock = sync and not isinstance(sys.stdout,Pyxis.Internals._LogSink);
+    if lock:
       fcntl.lockf(sys.stdout,fcntl.LOCK_EX);
       sys.stdout.seek(0,2);
-    print(output);
+    sys.stdout.write(output+"\n");
     if sync:
       sys.stdout.flush();
+    if lock:
       fcntl.lockf(sys.stdout,fcntl.LOCK_UN);
     if not quiet:
       sys.__stdout__.write(output+"\n");
@@ -225,6 +249,650 @@ def exists (filename):
   """Returns True if filename exists, interpolating the filename""";
   return filename and os.path.exists(_I(filename,2));
 
+# interval (in seconds) at which parallel per-loops check on their jobs
+PER_POLL_INTERVAL = 0.5;
+
+def _mem_available ():
+  """Returns available memory in bytes (MemAvailable in /proc/meminfo), or None if this is not known""";
+  try:
+    with open("/proc/meminfo") as f:
+      for line in f:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1])*1024;
+  except (IOError,OSError,ValueError):
+    pass;
+  return None;
+
+# previous I/O counters read by _io_pressure(), as a tuple of (source,time,counters)
+_io_counters = None;
+
+def _read_io_counters ():
+  """Helper function: returns (source,counters) for _io_pressure(). Counters are cumulative times, in seconds:
+  time that some task was stalled on I/O from /proc/pressure/io if available, else time spent doing I/O by each disk
+  from /proc/diskstats. Returns (None,None) if neither is available.""";
+  try:
+    with open("/proc/pressure/io") as f:
+      for line in f:
+        if line.startswith("some"):
+          fields = dict([ field.split("=",1) for field in line.split()[1:] ]);
+          return "psi",{ "some":int(fields["total"])*1e-6 };
+  except (IOError,OSError,ValueError,KeyError):
+    pass;
+  try:
+    counters = {};
+    with open("/proc/diskstats") as f:
+      for line in f:
+        fields = line.split();
+        if len(fields) > 12 and not fields[2].startswith(("loop","ram","zram")):
+          counters[fields[2]] = int(fields[12])*1e-3;
+    return "diskstats",counters;
+  except (IOError,OSError,ValueError):
+    return None,None;
+
+def _io_pressure ():
+  """Returns the I/O pressure since the previous call, as a percentage: the share of time that some task was
+  stalled on I/O, or else the utilisation of the busiest disk. Returns None if this can't be determined
+  (including on the first call).""";
+  global _io_counters;
+  source,counters = _read_io_counters();
+  if source is None:
+    return None;
+  now = time.time();
+  prev,_io_counters = _io_counters,(source,now,counters);
+  if prev is None or prev[0] != source or now - prev[1] < 1e-3:
+    return None;
+  busy = [ counters[key] - prev[2][key] for key in counters if key in prev[2] ];
+  return 100*max(busy)/(now-prev[1]) if busy else None;
+
+def _job_ceiling (default):
+  """Returns the current max number of parallel jobs: the number in JOBS_FILE if set (which can be edited
+  while a per-loop is running), else JOBS""";
+  filename = Pyxis.Context.get("JOBS_FILE");
+  if filename:
+    try:
+      with open(filename) as f:
+        return max(int(f.read().strip()),1);
+    except (IOError,OSError,ValueError):
+      pass;
+  return max(Pyxis.Context.get("JOBS",0) or default,1);
+
+def _job_need (name,value):
+  """Returns the declared resource need (JOB_MEM or JOB_CPUS) of the per-loop job for the given value, or None.
+  The setting can be a number, a dict of value -> number, or a callable taking the value.""";
+  need = Pyxis.Context.get(name);
+  if callable(need):
+    need = need(value);
+  elif isinstance(need,dict):
+    need = need.get(value,need.get(str(value)));
+  return float(need) if need is not None else None;
+
+def _iteration_history (varname):
+  """Returns a dict of value -> duration of the most recent successful iteration of a per-loop over 'varname',
+  from the PYXIS_EVENTS file.""";
+  filename = Pyxis.Internals._events_target();
+  durations = {};
+  if not filename or not os.path.exists(str(filename)):
+    return durations;
+  try:
+    with open(str(filename)) as f:
+      for line in f:
+        try:
+          record = json.loads(line);
+        except ValueError:
+          continue;
+        if record.get("event") == "iteration.end" and record.get("var") == varname and record.get("status") == "ok":
+          durations[str(record.get("value"))] = record.get("elapsed");
+  except (IOError,OSError) as exc:
+    _warn("error reading timing history from %s: %s"%(filename,exc));
+  return durations;
+
+def _value_size (value):
+  """Returns the on-disk size of a per-loop value naming a file or directory (e.g. an MS), or None""";
+  if not isinstance(value,str) or not os.path.exists(value):
+    return None;
+  try:
+    return Pyxis.Internals._path_size(value);
+  except OSError:
+    return None;
+
+def _order_by_cost (varname,values,order):
+  """Sorts per-loop values longest-first according to the JOB_ORDER setting. Values of unknown cost are put
+  first, since they may well be the longest.""";
+  if callable(order):
+    costs,how = [ order(value) for value in values ],"cost";
+  elif isinstance(order,dict):
+    costs,how = [ order.get(value,order.get(str(value))) for value in values ],"cost";
+  else:
+    order = str(order).lower();
+    if order not in ("size","history","longest"):
+      _warn("unknown JOB_ORDER=%s, running values in list order"%order);
+      return values;
+    costs,how = None,None;
+    if order in ("history","longest"):
+      history = _iteration_history(varname);
+      costs,how = [ history.get(str(value)) for value in values ],"duration in previous runs";
+    # if history is incomplete, fall back to sizes
+    if order == "size" or (order == "longest" and None in costs):
+      sizes = [ _value_size(value) for value in values ];
+      if order == "size" or None not in sizes:
+        costs,how = sizes,"size on disk";
+  if all([ cost is None for cost in costs ]):
+    _verbose(1,"JOB_ORDER=%s: no cost information for %s, running values in list order"%(order,varname));
+    return values;
+  ordered = sorted(zip(values,costs),key=lambda vc:(vc[1] is not None,-(vc[1] or 0)));
+  _verbose(1,"running values of %s longest-first by %s: %s"%(varname,how,
+           " ".join([ str(value) if cost is not None else "%s(?)"%value for value,cost in ordered ])));
+  return [ value for value,cost in ordered ];
+
+# (var,value) pairs of the per-loop iterations that this process is running within, innermost last
+_per_context = [];
+def _ledger_file ():
+  """Returns the per-loop ledger file given by PER_LEDGER, or None if not enabled. If PER_LEDGER is True, the
+  ledger is kept next to the current logfile. This is looked up afresh for every loop, since LOG (or whatever
+  PER_LEDGER refers to) may have changed since the last one.""";
+  ledger = Pyxis.Context.get("PER_LEDGER");
+  if isinstance(ledger,str) and ledger.lower() in ("0","false","no"):
+    return None;
+  if not ledger:
+    return None;
+  if isinstance(ledger,str) and ledger.lower() not in ("1","true","yes"):
+    return interpolate(ledger,Pyxis.Context);
+  logfile = Pyxis.Internals.get_logfile()[1];
+  return (os.path.splitext(logfile)[0] if logfile else "pyxis")+".ledger";
+
+def _ledger_key (varname,value,commands):
+  """Returns the ledger key of a per-loop value. This depends on the values of the enclosing loops, and on the
+  command list, so that a changed recipe starts afresh.""";
+  names = [ x if isinstance(x,str) else "%s.%s"%(getattr(x,"__module__",""),getattr(x,"__name__","?"))
+            for x in commands ];
+  key = [ (var,str(val)) for var,val in _per_context ] + [ (varname,str(value)),names ];
+  return hashlib.sha256(repr(key).encode("utf-8")).hexdigest();
+
+def _ledger_read (filename):
+  """Reads a per-loop ledger, returning a dict of key -> status of the last recorded run""";
+  status = {};
+  try:
+    with open(filename) as f:
+      for line in f:
+        try:
+          entry = json.loads(line);
+          status[entry["key"]] = entry["status"];
+        except (ValueError,KeyError,TypeError):
+          continue;   # a line may be truncated if we were killed while writing it
+  except (IOError,OSError):
+    pass;
+  return status;
+
+def _ledger_record (filename,key,varname,value,status):
+  """Appends the status ("ok" or "failed") of a per-loop value to the ledger""";
+  data = (json.dumps(dict(key=key,var=varname,value=str(value),status=status,time=time.time()))+"\n").encode("utf-8");
+  try:
+    fd = os.open(filename,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o644);
+    try:
+      os.write(fd,data);
+    finally:
+      os.close(fd);
+  except (IOError,OSError) as exc:
+    _warn("can't write to per-loop ledger %s: %s"%(filename,exc));
+
+# script used to start worker processes of the spawn and batch executors, and the fork server: imports Pyxis
+# quietly, then calls the given function of Pyxis.Commands
+_PER_BOOTSTRAP = """import sys,io,contextlib
+PYXIS_ROOT_NAMESPACE = True
+PYXIS_LOAD_CONFIG = PYXIS_AUTO_IMPORT_MODULES = False
+with contextlib.redirect_stdout(io.StringIO()):
+  import Pyxis
+import Pyxis.Commands
+Pyxis.Commands.%s
+""";
+
+def _per_worker_command (filename):
+  """Returns the command line of a worker process running the job saved in the given file""";
+  return [ sys.executable,"-c",_PER_BOOTSTRAP%"_per_job_main(sys.argv[1])",filename ];
+
+def _pyxis_path ():
+  """Returns the PYTHONPATH setting a worker process needs to import Pyxis""";
+  path = os.path.dirname(os.path.dirname(os.path.abspath(Pyxis.__file__)));
+  return os.pathsep.join([path]+[ x for x in os.environ.get("PYTHONPATH","").split(os.pathsep) if x and x != path ]);
+
+def _picklable_values (namespace,limit):
+  """Helper function: returns dict of name -> pickled value for the variables of a namespace that can be passed on
+  to a worker process. Functions, classes, modules, private names and the standard Pyxis objects are skipped, as
+  are values that pickle to more than 'limit' bytes, since the point is not to copy data into every job.""";
+  values = {};
+  for name,value in list(namespace.items()):
+    if name.startswith("_") or callable(value) or inspect.ismodule(value) or name in globals():
+      continue;
+    try:
+      data = pickle.dumps(value,pickle.HIGHEST_PROTOCOL);
+    except Exception:
+      _verbose(3,"can't pickle %s, not passing it on to jobs"%name);
+      continue;
+    if len(data) > limit:
+      _warn("%s is too big (%.1f MB) to pass on to jobs, see PER_SNAPSHOT_LIMIT"%(name,len(data)/2.**20));
+      continue;
+    values[name] = data;
+  return values;
+
+def _unpickle_values (values):
+  """Helper function: the inverse of _picklable_values(), skipping any values that can't be restored""";
+  result = {};
+  for name,data in values.items():
+    try:
+      result[name] = pickle.loads(data);
+    except Exception as exc:
+      _verbose(2,"can't restore %s in job: %s"%(name,exc));
+  return result;
+
+def _command_ref (command):
+  """Helper function: returns a reference to a per-loop command that can be resolved in a worker process""";
+  if isinstance(command,str):
+    return command;
+  module,name = getattr(command,"__module__",None),getattr(command,"__qualname__",getattr(command,"__name__",None));
+  if name and module == Pyxis.Context.get("__name__") and Pyxis.Context.get(name) is command:
+    return "context",name;
+  if not module or not name or "<" in name:
+    _abort("PYXIS: %r can't be passed to a per-loop job run by PER_EXECUTOR=%s. Use a named function from a recipe or module."%(
+           command,Pyxis.Context.get("PER_EXECUTOR")));
+  return "module",module,name;
+
+def _resolve_command (ref):
+  """Helper function: the inverse of _command_ref(), called in the worker process""";
+  if isinstance(ref,str):
+    return ref;
+  if ref[0] == "context":
+    return Pyxis.Context[ref[1]];
+  obj = importlib.import_module(ref[1]);
+  for attr in ref[2].split("."):
+    obj = getattr(obj,attr);
+  return obj;
+
+def _per_snapshot (spec):
+  """Returns what a per-loop job needs to run in a fresh Pyxis process: the loop spec, the recipes and modules to
+  load, and the values of the context and module globals (those that can be pickled).""";
+  namespaces = Pyxis.Internals._namespaces;
+  if spec['namespace'] is Pyxis.Context:
+    nsname = None;
+  else:
+    nsname = [ name for name,globs in namespaces.items() if globs is spec['namespace'] ];
+    if not nsname:
+      _abort("PYXIS: per(%s) loop variable is not in the context or a Pyxis module, can't pass it on to jobs"%spec['varname']);
+    nsname = nsname[0];
+  abspath = lambda path:path and os.path.abspath(path);
+  limit = float(Pyxis.Context.get("PER_SNAPSHOT_LIMIT",16))*2**20;
+  return dict(varname=spec['varname'],vname=spec['vname'],namespace=nsname,
+    commands=[ _command_ref(command) for command in spec['commands'] ],
+    shard_dir=abspath(spec['shard_dir']),stats_file=abspath(spec['stats_file']),
+    logfile=abspath(Pyxis.Internals.get_logfile()[1]),
+    cwd=os.getcwd(),sys_path=list(sys.path),config_files=list(Pyxis.Internals._config_files),
+    modules=[ module.__name__ for module in Pyxis.Internals._modules.values() ],
+    context=_picklable_values(Pyxis.Context,limit),
+    globals=dict([ (name,_picklable_values(globs,limit)) for name,globs in namespaces.items() if globs is not Pyxis.Context ]),
+    per_context=list(_per_context));
+
+def _run_per_job (spec,job_id,value):
+  """Runs the commands of a per-loop job for the given value, then exits. Called in a forked child, or in a
+  worker process (see _per_job_main).""";
+  global _subprocess_id;
+  varname = spec['varname'];
+  _subprocess_id = job_id;
+  job_pid = os.getpid();
+  _per_context.append((varname,value));
+  spec['shard_dir'] and Pyxis.Internals.set_log_shard(spec['shard_dir'],job_id,"%s=%s"%(varname,value));
+  _verbose(1,"started job #%d, per-loop, setting %s=%s"%(job_id,varname,value),sync=True);
+  try:
+    assign_many({spec['vname']:value},namespace=spec['namespace'],interpolate=False);
+    with Pyxis.Internals._event_span("iteration",var=varname,value=value):
+      Pyxis.Internals.run(*spec['commands']);
+  except:
+    # jobs of a nested per-loop exit through here too
+    if os.getpid() != job_pid:
+      raise;
+    traceback.print_exc();
+    _verbose(1,"job #%d (pid %d) aborted at %s=%s, exiting with error code 1"%(_subprocess_id,os.getpid(),varname,value),sync=True);
+    spec['restore']();
+    _verbose(2,"logfile is",Pyxis.Context.get('LOG'),sync=True);
+    _error("per-loop failed for %s"%value,sync=True);
+    sys.exit(1);
+  _verbose(2,"job #%d (pid %d) exiting normally"%(_subprocess_id,os.getpid()),sync=True);
+  sys.exit(0);
+
+def _per_job_main (filename):
+  """Entry point of worker processes started by the spawn and batch executors: loads the recipes and modules,
+  restores the state saved by _per_snapshot(), and runs the job.""";
+  with open(filename,"rb") as f:
+    job = pickle.load(f);
+  os.chdir(job['cwd']);
+  sys.path += [ path for path in job['sys_path'] if path not in sys.path ];
+  # log to the same file as the parent (the job then switches to its shard, if any)
+  if job['logfile']:
+    Pyxis.Context['LOG_FLUSH'] = False;
+    Pyxis.Internals._visited_logfiles.add(job['logfile']);
+    Pyxis.Internals.set_logfile(job['logfile'],quiet=True);
+  # the parent has already reported on loading all this
+  Pyxis.Context['VERBOSE'] = 0;
+  Pyxis.Internals.initconf(force=True,files=job['config_files'],directory=None);
+  for modname in job['modules']:
+    try:
+      importlib.import_module(modname);
+    except Exception as exc:
+      _warn("job can't import module %s: %s"%(modname,exc));
+  for modname,values in job['globals'].items():
+    if modname in Pyxis.Internals._namespaces:
+      Pyxis.Internals._namespaces[modname].update(_unpickle_values(values));
+  Pyxis.Context.update(_unpickle_values(job['context']));
+  # join the jobserver of the parent, if it passed one on
+  Pyxis.Internals._jobserver = Pyxis.Internals._jobserver_from_env();
+  _per_context[:] = job['per_context'];
+  spec = dict(job,commands=[ _resolve_command(ref) for ref in job['commands'] ],restore=lambda:None,
+              namespace=Pyxis.Context if job['namespace'] is None else Pyxis.Internals._namespaces[job['namespace']]);
+  try:
+    _run_per_job(spec,job['job_id'],job['value']);
+  finally:
+    job['stats_file'] and Pyxis.Internals._save_exec_stats(job['stats_file']);
+    Pyxis.Internals.flush_log();
+
+def _read_lines (fd,buffer):
+  """Helper function: reads what is available from a pipe, and returns the complete lines received so far, plus
+  the remaining partial line. Raises EOFError if the pipe has been closed.""";
+  data = os.read(fd,65536);
+  if not data:
+    raise EOFError;
+  lines = (buffer+data.decode("utf-8")).split("\n");
+  return lines[:-1],lines[-1];
+
+def _per_forkserver_main (command_fd,reply_fd):
+  """Main loop of the fork server used by PER_EXECUTOR="forkserver": forks a worker for each job received from
+  the parent Pyxis process, and reports back the pid of each worker, and its exit status and resource usage
+  when it exits. Exits when the parent closes the command pipe and all workers have exited.""";
+  reply = lambda **msg:os.write(reply_fd,(json.dumps(msg)+"\n").encode("utf-8"));
+  buffer,eof = "",False;
+  # Ctrl+C is handled by the parent, which then kills the workers
+  signal.signal(signal.SIGINT,signal.SIG_IGN);
+  workers = {};
+  while not eof or workers:
+    if not eof and select.select([command_fd],[],[],PER_POLL_INTERVAL/10)[0]:
+      try:
+        lines,buffer = _read_lines(command_fd,buffer);
+      except EOFError:
+        lines,eof = [],True;
+      for line in lines:
+        msg = json.loads(line);
+        # import modules here first, so that all workers share them
+        for modname in msg['modules']:
+          if modname not in sys.modules:
+            try:
+              importlib.import_module(modname);
+            except Exception:
+              pass;   # the worker will report it
+        pid = os.fork();
+        if not pid:
+          os.close(command_fd);
+          os.close(reply_fd);
+          signal.signal(signal.SIGINT,signal.default_int_handler);
+          Pyxis.Internals._on_parent_exit('SIGTERM')();
+          hasattr(os,'register_at_fork') or Pyxis.Internals._after_fork_in_child();
+          # this exits via SystemExit
+          _per_job_main(msg['job']);
+        workers[pid] = msg['job'];
+        reply(started=msg['job'],pid=pid);
+    elif eof:
+      time.sleep(PER_POLL_INTERVAL/10);
+    while workers:
+      pid,status,ru = os.wait4(-1,os.WNOHANG);
+      if not pid:
+        break;
+      status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128+os.WTERMSIG(status);
+      reply(exited=workers.pop(pid),status=status,usage=dict(utime=ru.ru_utime,stime=ru.ru_stime,
+            maxrss=ru.ru_maxrss*(1 if sys.platform == "darwin" else 1024)));
+
+class PerExecutor (object):
+  """Base class of per-loop executors, see PER_EXECUTOR. An executor launches the job for each value of a parallel
+  per-loop, and reports when it is done. Subclasses implement
+
+    launch(job_id,value): launches a job, and returns a handle for it
+    poll(handle): returns None while the job is running, else a tuple of (exit status,resource usage dict or None)
+    kill(handle,signum): kills (or cancels) a job
+
+  Executors that run jobs in fresh processes can use write_job() to save what they need, and run them via
+  _per_worker_command().""";
+  # local executors run jobs on this machine, so memory, CPU and job slot limits apply to them
+  local = True;
+  # True if the max RSS reported by poll() is that of the job itself. Forked processes report the high-water
+  # mark of the process they were forked from, so JOB_MEM is only learned from executors that set this
+  own_rss = False;
+  # directory for job files, removed by close()
+  job_dir = None;
+
+  def __init__ (self,spec):
+    self.spec = spec;
+    self._snapshot = None;
+
+  def write_job (self,job_id,value):
+    """Saves the job to a file, and returns the filename""";
+    if self._snapshot is None:
+      self._snapshot = _per_snapshot(self.spec);
+    filename = os.path.abspath(os.path.join(self.job_dir,"job%04d.pickle"%job_id));
+    with open(filename,"wb") as f:
+      pickle.dump(dict(self._snapshot,job_id=job_id,value=value),f,pickle.HIGHEST_PROTOCOL);
+    return filename;
+
+  def label (self,handle):
+    return str(handle);
+
+  def close (self):
+    self.job_dir and shutil.rmtree(self.job_dir,ignore_errors=True);
+
+class ForkExecutor (PerExecutor):
+  """Runs each job in a child process forked from this one""";
+  def launch (self,job_id,value):
+    pid = os.fork();
+    if not pid:
+      # reset log writer (done automatically on Python 3.7+, via os.register_at_fork)
+      hasattr(os,'register_at_fork') or Pyxis.Internals._after_fork_in_child();
+      _run_per_job(self.spec,job_id,value);
+    return pid;
+
+  def poll (self,pid):
+    wpid,status,ru = os.wait4(pid,os.WNOHANG);
+    if not wpid:
+      return None;
+    status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128+os.WTERMSIG(status);
+    return status,dict(utime=ru.ru_utime,stime=ru.ru_stime,maxrss=ru.ru_maxrss*(1 if sys.platform == "darwin" else 1024));
+
+  def kill (self,pid,signum):
+    os.kill(pid,signum);
+
+  def label (self,pid):
+    return "pid %d"%pid;
+
+class SpawnExecutor (PerExecutor):
+  """Runs each job in a fresh Python process, which loads the recipes and modules, and restores the context
+  from a snapshot. Jobs then don't share the memory, open tables and threads of this process.""";
+  def __init__ (self,spec):
+    PerExecutor.__init__(self,spec);
+    self.job_dir = tempfile.mkdtemp(prefix=".pyxis-jobs-",dir=".");
+
+  def launch (self,job_id,value):
+    filename = self.write_job(job_id,value);
+    return subprocess.Popen(_per_worker_command(filename),env=dict(os.environ,PYTHONPATH=_pyxis_path()),
+            preexec_fn=Pyxis.Internals._on_parent_exit('SIGTERM'),pass_fds=Pyxis.Internals._jobserver_pass_fds());
+
+  def poll (self,po):
+    usage = Pyxis.Internals._reap_child(po,block=False);
+    if usage is None:
+      return None;
+    return (po.returncode if po.returncode >= 0 else 128-po.returncode),usage;
+
+  def kill (self,po,signum):
+    try:
+      os.kill(po.pid,signum);
+    except OSError:
+      pass;
+
+  def label (self,po):
+    return "pid %d"%po.pid;
+
+class ForkServerExecutor (PerExecutor):
+  """Runs each job in a process forked from a small server process started for the loop, which has imported
+  Pyxis and the modules in use, but holds none of the memory, open tables and threads of this process. Jobs then
+  load the recipes and restore the context from a snapshot, as with SpawnExecutor, but without the startup cost
+  of a fresh interpreter.""";
+  own_rss = True;
+
+  def __init__ (self,spec):
+    PerExecutor.__init__(self,spec);
+    self.job_dir = tempfile.mkdtemp(prefix=".pyxis-jobs-",dir=".");
+    self.server = None;
+    # dicts of job file -> worker pid, and job file -> (exit status,resource usage) once the worker has exited
+    self.pids,self.results = {},{};
+
+  def _start_server (self):
+    command_r,command_w = os.pipe();
+    reply_r,reply_w = os.pipe();
+    self.server = subprocess.Popen([ sys.executable,"-c",_PER_BOOTSTRAP%"_per_forkserver_main(int(sys.argv[1]),int(sys.argv[2]))",
+              str(command_r),str(reply_w) ],env=dict(os.environ,PYTHONPATH=_pyxis_path()),
+              preexec_fn=Pyxis.Internals._on_parent_exit('SIGTERM'),
+              pass_fds=(command_r,reply_w)+Pyxis.Internals._jobserver_pass_fds());
+    os.close(command_r);
+    os.close(reply_w);
+    self.command_fd,self.reply_fd,self.buffer = command_w,reply_r,"";
+    _verbose(2,"started per-loop fork server with pid %d"%self.server.pid);
+
+  def _read_replies (self,timeout):
+    if not select.select([self.reply_fd],[],[],timeout)[0]:
+      return;
+    try:
+      lines,self.buffer = _read_lines(self.reply_fd,self.buffer);
+    except EOFError:
+      _abort("PYXIS: per-loop fork server exited unexpectedly");
+    for line in lines:
+      msg = json.loads(line);
+      if 'started' in msg:
+        self.pids[msg['started']] = msg['pid'];
+      else:
+        self.results[msg['exited']] = msg['status'],msg['usage'];
+
+  def launch (self,job_id,value):
+    self.server or self._start_server();
+    filename = self.write_job(job_id,value);
+    os.write(self.command_fd,(json.dumps(dict(job=filename,modules=self._snapshot['modules']))+"\n").encode("utf-8"));
+    while filename not in self.pids:
+      self._read_replies(None);
+    return filename;
+
+  def poll (self,filename):
+    self._read_replies(0);
+    return self.results.pop(filename,None);
+
+  def kill (self,filename,signum):
+    try:
+      os.kill(self.pids[filename],signum);
+    except OSError:
+      pass;
+
+  def label (self,filename):
+    return "pid %d"%self.pids[filename];
+
+  def close (self):
+    # the server exits once the command pipe is closed and its workers have exited
+    if self.server:
+      os.close(self.command_fd);
+      try:
+        self.server.wait(5);
+      except subprocess.TimeoutExpired:
+        self.server.kill();
+        self.server.wait();
+      os.close(self.reply_fd);
+    PerExecutor.close(self);
+
+_re_batch_header_key = re.compile(r"\{(job_id|value|var)\}");
+
+class BatchExecutor (PerExecutor):
+  """Submits each job to a batch queue, as a script running a fresh Pyxis process (see SpawnExecutor). The
+  job directory (and the log, if any) must be on a filesystem shared with the batch nodes. See PER_BATCH_SUBMIT
+  for the settings.""";
+  local = False;
+  # how often to ask the batch system whether a job is still there, in seconds
+  status_interval = 30;
+
+  def __init__ (self,spec):
+    PerExecutor.__init__(self,spec);
+    self.job_dir = tempfile.mkdtemp(prefix=".pyxis-jobs-",dir=".");
+    command = lambda name,default=None:shlex.split(str(Pyxis.Context.get(name) or default or "")) or None;
+    self.submit = command("PER_BATCH_SUBMIT","sbatch");
+    self.cancel = command("PER_BATCH_CANCEL");
+    self.status = command("PER_BATCH_STATUS");
+    self.header = Pyxis.Context.get("PER_BATCH_HEADER") or "";
+    # dicts of handle -> batch job ID, signal it was killed with, and time of last status check
+    self.batch_ids,self.killed,self.checked = {},{},{};
+
+  def launch (self,job_id,value):
+    filename = self.write_job(job_id,value);
+    base = os.path.splitext(filename)[0];
+    status = base+".status";
+    # only {job_id}, {value} and {var} are substituted, since scheduler directives use % (e.g. slurm-%j.out)
+    # and may use braces too
+    keys = dict(job_id=job_id,value=value,var=self.spec['varname']);
+    header = _re_batch_header_key.sub(lambda match:str(keys[match.group(1)]),self.header);
+    with open(base+".sh","w") as f:
+      f.write("#!/bin/bash\n%s\ncd %s\nunset MAKEFLAGS\nexport PYTHONPATH=%s\n%s\necho $? >%s && mv %s %s\n"%(
+              header,shlex.quote(os.getcwd()),shlex.quote(_pyxis_path()),
+              " ".join(map(shlex.quote,_per_worker_command(filename))),
+              shlex.quote(status+".tmp"),shlex.quote(status+".tmp"),shlex.quote(status)));
+    os.chmod(base+".sh",0o755);
+    try:
+      output = subprocess.check_output(self.submit+[base+".sh"],universal_newlines=True);
+    except (OSError,subprocess.CalledProcessError) as exc:
+      _abort("PYXIS: error submitting job with %s: %s"%(" ".join(self.submit),exc));
+    # the batch job ID is taken to be the last word of the output, as with sbatch and qsub
+    self.batch_ids[status] = output.split()[-1] if output.split() else None;
+    return status;
+
+  def poll (self,status):
+    if os.path.exists(status):
+      try:
+        with open(status) as f:
+          return int(f.read().strip()),None;
+      except (IOError,OSError,ValueError):
+        return 1,None;
+    if status in self.killed:
+      return 128+self.killed[status],None;
+    # check that the job is still queued or running, in case it died without leaving an exit status
+    batch_id = self.batch_ids.get(status);
+    if self.status and batch_id and time.time() - self.checked.get(status,0) > self.status_interval:
+      self.checked[status] = time.time();
+      try:
+        gone = not subprocess.check_output(self.status+[batch_id],stderr=subprocess.DEVNULL,universal_newlines=True).strip();
+      except (OSError,subprocess.CalledProcessError):
+        gone = True;
+      if gone and not os.path.exists(status):
+        _warn("batch job %s is no longer queued, but left no exit status"%batch_id);
+        return 1,None;
+    return None;
+
+  def kill (self,status,signum):
+    self.killed[status] = signum;
+    batch_id = self.batch_ids.get(status);
+    if self.cancel and batch_id:
+      subprocess.call(self.cancel+[batch_id],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL);
+    else:
+      _warn("can't cancel batch job %s: PER_BATCH_CANCEL is not set"%batch_id);
+
+  def label (self,status):
+    return "batch job %s"%self.batch_ids.get(status);
+
+_per_executors = dict(fork=ForkExecutor,spawn=SpawnExecutor,forkserver=ForkServerExecutor,batch=BatchExecutor);
+
+def _per_executor (spec):
+  """Returns the executor given by PER_EXECUTOR for a per-loop""";
+  executor = Pyxis.Context.get("PER_EXECUTOR") or "fork";
+  if isinstance(executor,str):
+    if executor not in _per_executors:
+      _abort("PYXIS: unknown PER_EXECUTOR=%s, use one of %s"%(executor,", ".join(sorted(_per_executors))));
+    executor = _per_executors[executor];
+  return executor(spec);
+
 def _per (varname,parallel,*commands):
   # default frame to look for vars is caller of caller
   frame = inspect.currentframe().f_back.f_back;
@@ -234,11 +902,16 @@ def _per (varname,parallel,*commands):
   def _restore ():
 #    if saveval is not None:
     _verbose(2,"restoring %s=%s"%(varname,saveval),sync=True);
-    assign(varname,saveval,namespace=namespace,interpolate=False);
+    assign_many({vname:saveval},namespace=namespace,interpolate=False);
   varlist = namespace.get(vname+"_List",None);
   cmdlist = ",".join([ x if isinstance(x,str) else getattr(x,"__name__","?") for x in commands ]);
   persist = Pyxis.Context.get("PERSIST");
   fail_list = [];
+  shard_dir = stats_file = executor = None;
+  # forked jobs (and their own jobs, if they run nested per-loops) unwind through this frame too, so the pid tells
+  # us whether we're the process that started the loop
+  owner_pid = os.getpid();
+  jobserver_started = False;
   if varlist is None:
     _verbose(1,"per(%s,%s): %s_List is empty"%(varname,cmdlist,varname));
     return;
@@ -247,19 +920,50 @@ def _per (varname,parallel,*commands):
       varlist = list(map(_int_or_str,varlist.split(",")));
     elif not isinstance(varlist,(list,tuple)):
       _abort("PYXIS: per(%s,%s): %s_List has invalid type %s"%(varname,cmdlist,str(type(varlist))));
+    # skip values completed by a previous run, according to the ledger
+    ledger = _ledger_file();
+    if ledger:
+      keys = dict([ (str(value),_ledger_key(varname,value,commands)) for value in varlist ]);
+      status = _ledger_read(ledger);
+      done = [ value for value in varlist if status.get(keys[str(value)]) == "ok" ];
+      if done:
+        _verbose(1,"per(%s,%s): skipping %s=%s, completed according to %s"%(varname,cmdlist,varname,",".join(map(str,done)),ledger));
+        varlist = [ value for value in varlist if value not in done ];
+        if not varlist:
+          return;
     nforks = Pyxis.Context.get("JOBS",0);
     stagger = Pyxis.Context.get("JOB_STAGGER",0);
+    # for parallel loops, start the longest values first, so that no job is left running on its own at the end
+    order = Pyxis.Context.get("JOB_ORDER");
+    if order and parallel and nforks > 1 and len(varlist) > 1:
+      varlist = _order_by_cost(varname,varlist,order);
     # unforked case
     _verbose(1,"per(%s,%s,persist=%d): iterating over %s=%s"%(varname,cmdlist,1 if persist else 0,varname," ".join(map(str,varlist))));
-    global _subprocess_id;
-    if not parallel or nforks < 2 or len(varlist) < 2 or _subprocess_id is not None:
+    # in a dry run, loops are iterated serially, but recorded as parallel if they would be
+    plan = Pyxis.Internals._plan;
+    # a per-loop nested in a parallel per-loop job can only run in parallel if there's a jobserver to share slots
+    # with the other jobs
+    nested = _subprocess_id is not None and Pyxis.Internals._jobserver is None;
+    if plan is not None or not parallel or nforks < 2 or len(varlist) < 2 or nested:
+      plan_node = plan and plan.record("per",var=varname,parallel=bool(parallel),values=[]);
       # do the actual iteration
       for value in varlist:
         _verbose(1,"per-loop, setting %s=%s"%(varname,value));
-        assign(vname,value,namespace=namespace,interpolate=False); 
+        assign_many({vname:value},namespace=namespace,interpolate=False);
+        _per_context.append((varname,value));
         try:
-          Pyxis.Internals.run(*commands);
+          with Pyxis.Internals._event_span("iteration",var=varname,value=value):
+            if plan_node:
+              with plan.value(plan_node,value):
+                Pyxis.Internals.run(*commands);
+            else:
+              Pyxis.Internals.run(*commands);
+          _per_context.pop();
+          ledger and not plan and _ledger_record(ledger,keys[str(value)],varname,value,"ok");
         except (Exception,SystemExit,KeyboardInterrupt) as exc:
+          _per_context.pop();
+          if ledger and not plan and not isinstance(exc,KeyboardInterrupt):
+            _ledger_record(ledger,keys[str(value)],varname,value,"failed");
           if persist:
             _warn("exception raised for %s=%s:\n"%(vname,value),
                 *traceback.format_exception(*sys.exc_info()));
@@ -272,104 +976,196 @@ def _per (varname,parallel,*commands):
         _restore();
         _abort("per-loop failed for %s"%(",".join([f[0] for f in fail_list])));
     else:
-      # else split varlist into forked subprocesses
-      nforks = min(nforks,len(varlist));
-      # create a queue for all variable values
-      varqueue = multiprocessing.Queue(len(varlist))
-      for x in varlist:
-        varqueue.put(x)
-      # distribute N values per each fork
-      _verbose(1,"splitting into %d jobs by %s, staggered by %ds"%(nforks,varname,stagger));
+      # else fork a subprocess per value, admitting values as the job ceiling and resources permit
+      pending = list(varlist);
+      adaptive = str(stagger).lower() == "auto";
+      if adaptive:
+        stagger_min = float(Pyxis.Context.get("JOB_STAGGER_MIN",1));
+        stagger_max = float(Pyxis.Context.get("JOB_STAGGER_MAX",60));
+        io_threshold = float(Pyxis.Context.get("JOB_STAGGER_IO",50));
+        _verbose(1,"running %d values of %s in up to %d parallel jobs, staggered by %g-%gs, until I/O pressure is below %g%%"%(
+                 len(pending),varname,nforks,stagger_min,stagger_max,io_threshold));
+      else:
+        stagger = float(stagger or 0);
+        _verbose(1,"running %d values of %s in up to %d parallel jobs, staggered by %gs"%(len(pending),varname,nforks,stagger));
+      staggers = [];
+      # each job logs to its own shards, which are merged into the log as each job finishes
+      logfile = Pyxis.Internals.get_logfile()[1];
+      if logfile and Pyxis.Context.get("LOG_SHARDS",True):
+        shard_dir = tempfile.mkdtemp(prefix=".pyxis-shards-",dir=os.path.dirname(logfile) or ".");
+      # jobs are run by the executor given by PER_EXECUTOR
+      spec = dict(varname=varname,vname=vname,namespace=namespace,commands=commands,shard_dir=shard_dir,restore=_restore);
+      executor = _per_executor(spec);
+      # jobs pass their resource usage totals on via this file
+      fd,stats_file = tempfile.mkstemp(prefix=".pyxis-stats-",dir=shard_dir or executor.job_dir);
+      os.close(fd);
+      spec['stats_file'] = stats_file;
+      # the top-level loop starts a jobserver, from which nested loops and multithreaded tools draw job slots.
+      # Each job beyond the first takes a token from it. (The first job uses the slot held by this process,
+      # which is only waiting on its jobs.)
+      jobserver_started = Pyxis.Internals._jobserver_start(nforks);
+      implicit_slot = True;
+      # tell job_threads() in the jobs that values are waiting, so that they don't claim the slots these need
+      Pyxis.Internals._jobserver_loop_state(len(pending),0);
       Pyxis.Internals.flush_log();
-      forked_pids = {};
+      # dict of job handle -> (job_id,value,memory need,CPU need,start time,jobserver token)
+      running = {};
+      # max memory and CPU use seen in a finished job, used for values with no declared needs
+      learned = dict(mem=None,cpus=None);
+      ncpus = os.cpu_count() or 1;
+      mem0 = _mem_available();
+      failed = [];
+      killed = set();
+      last_launch = 0;
+      held_back = None;
+
       try:
-        for job_id in range(nforks):
-          if job_id and stagger:
-            time.sleep(stagger);
-          # subvals is range of values to be iterated over by this subjob
-          pid = os.fork();
-          if not pid:
-            # child fork: run commands while something is on queue
-            _subprocess_id = job_id;
-            _verbose(1,"started job %d"%job_id,sync=True);
-            try:
-              fail_list = []
-              success_list = []
-              while True:
-                try:
-                  value = varqueue.get(False)
-                except queue.Empty:
-                  break
-                _verbose(1,"per-loop, setting %s=%s"%(varname,value),sync=True);
-                assign(vname,value,namespace=namespace,interpolate=False);
-                try:
-                  Pyxis.Internals.run(*commands);
-                  success_list.append(value)
-                except (Exception,SystemExit,KeyboardInterrupt) as exc:
-                  if persist:
-                    _warn("exception raised for %s=%s:\n"%(vname,value),
-                        sync=True,*traceback.format_exception(*sys.exc_info()));
-                    _warn("persistent mode is on (PERSIST=1), so continuing to end of %s_List"%vname,sync=True)
-                    fail_list.append((value,str(exc)));
-                  else:
-                    raise;
-              # any successes?
-              if success_list:
-                _verbose(1,"job #%d (pid %d): per-loop succeeded for %s"%(_subprocess_id,pid,
-                    ", ".join([str(f) for f in success_list])),sync=True)
-              # any fails?
-              if fail_list:
-                _restore();
-                _abort("job #%d (pid %d): per-loop failed for %s"%(_subprocess_id,pid,
-                    ", ".join([str(f[0]) for f in fail_list])),sync=True)
-            except:
-              traceback.print_exc();
-              _verbose(1,"job #%d (pid %d) aborted at %s=%s, exiting with error code 1"%(_subprocess_id,pid,varname,value),sync=True);
-              _restore();
-              _verbose(2,"logfile is",Pyxis.Context.get('LOG'),sync=True);
-              _error("per-loop failed for %s"%value,sync=True);
-              sys.exit(1);
-            _verbose(2,"job #%d (pid %d) exiting normally"%(_subprocess_id,os.getpid()),sync=True);
-            sys.exit(0);
-          else: # parent pid: append to list
-            _verbose(2,"launched job #%d with pid %d"%(job_id,pid),sync=True);
-            forked_pids[pid] = job_id
-        njobs = len(forked_pids);
-        _verbose(1,"%d jobs launched, waiting for finish"%len(forked_pids),sync=True);
-        failed = [];
-        while forked_pids:
-          pid,status = os.waitpid(-1,0);
-          if pid in forked_pids:
-            job_id = forked_pids.pop(pid);
-            status >>= 8;
-            if status:
-              failed.append(job_id);
-  #            success = False;
-              _error("job #%d exited with error status %d, waiting for %d more jobs to complete"%(job_id,status,len(forked_pids)),sync=True);
+        while pending or running:
+          # launch jobs for pending values while we can
+          while pending:
+            value = pending[0];
+            mem = _job_need("JOB_MEM",value);
+            mem = mem*2**30 if mem is not None else learned["mem"];
+            cpus = _job_need("JOB_CPUS",value);
+            cpus = cpus if cpus is not None else learned["cpus"];
+            # the first job is always admitted, so that the loop can't stall
+            if running:
+              if len(running) >= _job_ceiling(nforks):
+                break;
+              # launches are only staggered while ramping up to the full number of jobs, not when refilling a slot
+              ramped_up = len(varlist) - len(pending) >= _job_ceiling(nforks);
+              since = time.time() - last_launch;
+              pressure = None;
+              if not ramped_up and not adaptive and since < stagger:
+                break;
+              # adaptive staggering: wait for I/O to quieten down (if we can tell), but no less than the min delay,
+              # and no more than the max
+              if not ramped_up and adaptive and since < stagger_max:
+                pressure = _io_pressure();
+                if since < stagger_min or pressure is None or pressure > io_threshold:
+                  break;
+              reason = None;
+              avail = _mem_available() if mem and executor.local else None;
+              # memory declared or learned for running jobs counts against what was available at the start, since
+              # they may not have allocated it all yet
+              committed = sum([ x[2] or 0 for x in running.values() ]);
+              if avail is not None and (mem > avail or (mem0 and mem + committed > mem0)):
+                reason = "memory (%.1f GB needed, %.1f GB available, %.1f GB claimed by running jobs)"%(
+                          mem/2.**30,avail/2.**30,committed/2.**30);
+              elif executor.local and cpus and cpus + sum([ x[3] or 0 for x in running.values() ]) > ncpus:
+                reason = "CPUs (%.1f needed)"%cpus;
+              elif executor.local and hasattr(os,'getloadavg') and os.getloadavg()[0] > ncpus + 0.5:
+                reason = "CPUs (load average %.1f)"%os.getloadavg()[0];
+              if reason:
+                if held_back != value:
+                  _verbose(1,"holding back %s=%s with %d jobs running: not enough %s"%(varname,value,len(running),reason),sync=True);
+                  held_back = value;
+                break;
+            # take a job slot (jobs run elsewhere don't need one)
+            if not executor.local:
+              token = None;
+            elif implicit_slot:
+              token,implicit_slot = None,False;
+            else:
+              token = Pyxis.Internals.jobserver_acquire();
+              if token is None:
+                if held_back != value:
+                  _verbose(2,"holding back %s=%s with %d jobs running: no free job slots"%(varname,value,len(running)),sync=True);
+                  held_back = value;
+                break;
+            job_id = len(varlist) - len(pending);
+            pending.pop(0);
+            Pyxis.Internals._jobserver_loop_state(len(pending),len(running)+1);
+            handle = executor.launch(job_id,value);
+            _verbose(2,"launched job #%d (%s=%s) as %s"%(job_id,varname,value,executor.label(handle)),sync=True);
+            if running and adaptive and not ramped_up:
+              staggers.append(time.time()-last_launch);
+              _verbose(1,"launched job #%d (%s=%s) %.1fs after the previous one%s"%(job_id,varname,value,staggers[-1],
+                       "" if pressure is None else ", I/O pressure %.0f%%"%pressure),sync=True);
+            running[handle] = job_id,value,mem,cpus,time.time(),token;
+            last_launch = time.time();
+            # start a fresh I/O pressure measurement
+            adaptive and _io_pressure();
+          # reap finished jobs
+          reaped = False;
+          for handle in list(running.keys()):
+            result = executor.poll(handle);
+            if result is None:
+              continue;
+            reaped = True;
+            status,usage = result;
+            job_id,value,mem,cpus,t0,token = running.pop(handle);
+            # give back the job slot
+            if token is None:
+              implicit_slot = True;
             else:
-              _verbose(1,"job #%d finished, waiting for %d more jobs to complete"%(job_id,len(forked_pids)),sync=True);
+              Pyxis.Internals.jobserver_release(token);
+            shard_dir and Pyxis.Internals.merge_log_shards(shard_dir,job_id);
+            # learn resource needs from the job
+            if usage:
+              if executor.own_rss:
+                learned["mem"] = max(learned["mem"] or 0,usage["maxrss"]);
+              learned["cpus"] = max(learned["cpus"] or 0,(usage["utime"]+usage["stime"])/max(time.time()-t0,1e-3));
+            if handle in killed:
+              _verbose(1,"job #%d (%s=%s) killed"%(job_id,varname,value),sync=True);
+            elif status:
+              failed.append(value);
+              ledger and _ledger_record(ledger,keys[str(value)],varname,value,"failed");
+              _error("job #%d (%s=%s) exited with error status %d, %d jobs running, %d values pending"%
+                  (job_id,varname,value,status,len(running),len(pending)),sync=True);
+              if not persist and (running or pending):
+                _error("PERSIST=0, killing %d running jobs and dropping %d pending values"%(len(running),len(pending)),sync=True);
+                pending = [];
+                for handle1 in running.keys():
+                  killed.add(handle1);
+                  executor.kill(handle1,signal.SIGTERM);
+            else:
+              ledger and _ledger_record(ledger,keys[str(value)],varname,value,"ok");
+              _verbose(1,"job #%d (%s=%s) finished%s, %d jobs running, %d values pending"%
+                  (job_id,varname,value,", max RSS %.0f MB"%(usage["maxrss"]/2.**20) if usage else "",len(running),len(pending)),sync=True);
+          if reaped:
+            Pyxis.Internals._jobserver_loop_state(len(pending),len(running));
+          elif running:
+            time.sleep(PER_POLL_INTERVAL);
+        if staggers:
+          _verbose(1,"effective stagger between jobs was %.1fs on average (min %.1fs, max %.1fs)"%(
+                   sum(staggers)/len(staggers),min(staggers),max(staggers)),sync=True);
         if failed:
-          _abort("%d of %d jobs have failed"%(len(failed),njobs),sync=True);
-        else:     
+          _abort("per-loop failed for %s=%s"%(varname,",".join(map(str,failed))),sync=True);
+        else:
           _verbose(1,"all jobs finished ok",sync=True);
       except KeyboardInterrupt:
-        if _subprocess_id is None:
+        if os.getpid() == owner_pid:
           _restore();
-          _error("Caught Ctrl+C, waiting for %d jobs to exit"%len(forked_pids),sync=True);
-          import signal;
-          for pid in list(forked_pids.keys()):
-            os.kill(pid,signal.SIGINT);
-          while forked_pids:
-            pid,status = os.waitpid(-1,0);
-            if pid in forked_pids:
-              job_id = forked_pids.pop(pid);
-              _verbose(1,"job #%d exited with error status %d, waiting for %d more"%
-                  (job_id,status>>8,len(forked_pids)),sync=True);
+          _error("Caught Ctrl+C, waiting for %d jobs to exit"%len(running),sync=True);
+          for handle in list(running.keys()):
+            executor.kill(handle,signal.SIGINT);
+          while running:
+            for handle in list(running.keys()):
+              result = executor.poll(handle);
+              if result is not None:
+                job_id,token = running.pop(handle)[::5];
+                token is None or Pyxis.Internals.jobserver_release(token);
+                shard_dir and Pyxis.Internals.merge_log_shards(shard_dir,job_id);
+                _verbose(1,"job #%d exited with error status %d, waiting for %d more"%
+                    (job_id,result[0],len(running)),sync=True);
+            running and time.sleep(PER_POLL_INTERVAL);
         raise;
   finally:
     # note that children also execute this block with sys.exit()
-    if _subprocess_id is None:
+    if os.getpid() != owner_pid:
+      stats_file and Pyxis.Internals._save_exec_stats(stats_file);
+    else:
+      executor and Pyxis.Internals._jobserver_loop_state(None,None);
+      jobserver_started and Pyxis.Internals._jobserver_stop();
       _restore();
+      if stats_file:
+        Pyxis.Internals._load_exec_stats(stats_file);
+        os.unlink(stats_file);
+      if shard_dir:
+        Pyxis.Internals.merge_log_shards(shard_dir);
+        shutil.rmtree(shard_dir,ignore_errors=True);
+      executor and executor.close();
     Pyxis.Internals.flush_log();
 
 def per (varname,*commands):
@@ -430,8 +1226,6 @@ def makedir (dirname,no_interpolate=False):
     os.mkdir(parent);
     
     
-import tempfile   
-import pickle
 import fcntl
     
 class Safelist (object):
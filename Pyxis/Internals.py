@@ -12,7 +12,20 @@ import sys
 import fnmatch
 import shutil
 import shlex
+import functools
+import heapq
+import itertools
 import six
+import time
+import atexit
+import threading
+import collections
+import json
+import codecs
+import selectors
+import select
+import hashlib
+import tempfile
 
 import Pyxis
 
@@ -42,13 +55,93 @@ PYXIS_AUTO_IMPORT_MODULES: automatically import (into the global namespace) all
 directly or indirectly invoked by the pre-loaded recipes. Useful for interactive sessions. Default is True.
 
 JOBS: split out up to this many subprocesses to work in parallel, when executing per() commands. 
-Default is 1.
+Default is 1. The top-level parallel per() command starts a GNU make-compatible jobserver with JOBS slots
+(or joins the one of a 'make -jN' that Pyxis was run from). Per-loops nested inside parallel per-loop jobs then
+run in parallel too, drawing job slots from the jobserver, and wrappers of multithreaded tools (see job_threads())
+size their thread counts from the slots that are free, once no per-loop values are waiting for them.
+
+JOBS_FILE: if set, the file is read whenever a parallel per() command is about to launch a job, and the number
+in it (if any) is used in place of JOBS. This can be used to change the number of jobs of a running recipe.
+
+JOB_MEM, JOB_CPUS: memory (in GB) and number of CPUs needed by each job of a parallel per() command. Jobs are
+only launched if enough memory (MemAvailable) and CPUs are free. Can be a number, a dict of per-list value to
+number, or a callable taking the value. If not set, the most used by any finished job of the same loop is assumed
+(for memory, only with PER_EXECUTOR="forkserver", since forked and spawned jobs report the RSS of the main process).
+
+JOB_ORDER: if set, parallel per() commands start the values expected to take longest first, so that a big
+item that happens to come last in the list doesn't leave the other CPUs idle at the end. Set to "size" to go by the
+on-disk size of the values (e.g. MSs), "history" to go by their durations in previous runs (from PYXIS_EVENTS),
+"longest" to use history if known for all values and size otherwise, or to a dict of value -> cost or a callable
+taking the value and returning a cost. Values of unknown cost are started first. Jobs still pick up the next value
+as soon as a slot frees up.
+
+PER_EXECUTOR: how the jobs of parallel per() commands are run. "fork" (the default) forks a child process per
+job. "spawn" starts a fresh Python process per job, which loads the same recipes and modules, and receives a
+snapshot of the context and module variables (those that can be pickled, and are no bigger than PER_SNAPSHOT_LIMIT
+MB, default 16). Commands must then be strings, or named functions defined in recipes or modules. "forkserver"
+does the same, but forks each job from a small server process that has already imported Pyxis and the modules in
+use, which saves the startup time of a fresh Python process. Either way, jobs don't share the memory, open tables
+and threads of the main Pyxis process, and so use less memory than forked jobs. The max RSS of each job is logged
+when it finishes (on Linux, that of "spawn" jobs still counts the main process, which is briefly forked to start
+them, so "forkserver" shows the real saving). "batch" runs jobs like "spawn", but via job scripts submitted to a
+batch queue, see PER_BATCH_SUBMIT. Can also be set to a subclass of PerExecutor (see Pyxis.Commands) implementing
+another backend.
+
+PER_BATCH_SUBMIT: command used by PER_EXECUTOR="batch" to submit a job script (given as its last argument), e.g.
+"sbatch" (the default) or "qsub". The last word of its output is taken to be the job ID. PER_BATCH_CANCEL is the
+command to cancel a job given its ID (e.g. "scancel"), and PER_BATCH_STATUS the command to query a job, which must
+print nothing (or fail) once the job has left the queue (e.g. "squeue -h -j"). PER_BATCH_HEADER is inserted at the
+top of each job script, for directives such as "#SBATCH --mem=16G". It can refer to {var}, {value} and {job_id},
+e.g. "#SBATCH -J {var}-{value} -o slurm-%j.out" (nothing else is substituted; but as with any value assigned on
+the command line or via v.NAME, % is written as %% there). Job scripts are written to a .pyxis-jobs-* subdirectory
+of the current directory, which (along with the log) must be visible on the batch nodes. For testing, the
+pyxis-submit-local script runs jobs as local processes:
+use PER_BATCH_SUBMIT=pyxis-submit-local PER_BATCH_CANCEL="pyxis-submit-local --cancel"
+PER_BATCH_STATUS="pyxis-submit-local --status".
+
+BG_JOBS: run at most this many background commands (e.g. those launched via xz) at a time; any others are
+queued until a slot frees up. Default is 0, meaning use JOBS (if >1), else the number of CPUs.
 
 JOB_STAGGER: stagger launch of subprocesses by this many seconds. Can be useful to e.g. de-syncronize
-disk access in subprocesses. Default is 10.
+disk access in subprocesses. Default is 10. If set to "auto", the next subprocess is launched as soon as I/O
+pressure (from /proc/pressure/io, or else disk utilisation from /proc/diskstats) is below JOB_STAGGER_IO percent
+(default 50), but no sooner than JOB_STAGGER_MIN (default 1) and no later than JOB_STAGGER_MAX (default 60) seconds
+after the previous one. Only the initial launches are staggered: once JOBS subprocesses are running, a new one
+is launched as soon as another one finishes.
+
+PYXIS_EVENTS: if set to a filename (here or in the environment), start and end events for commands, per-loop
+iterations and external programs are appended to it in JSON-lines format, with monotonic timestamps.
+
+LOG_SHARDS: if True, subprocesses of parallel per() commands write their logs to separate shards, which
+are merged into the log as one block per loop value when each job finishes. Default is True.
+
+EXEC_STATS: if True, a summary of the resource usage (CPU time, max RSS, context switches, disk I/O) of all
+external commands, totalled per tool, is logged on exit. Default is False. Note that on Linux, the max RSS of a
+process counts the Pyxis process it was forked from, so small values are not meaningful.
+
+COMMAND_CACHE_DIR: directory in which results of cached commands (e.g. x._cached.tool(...), or calls with
+cache=True) are kept. Default is ~/.cache/pyxis/commands.
+
+COMMAND_CACHE_SIZE: max total size of the command cache, in GB. Least recently used results are discarded
+beyond this. Default is 20.
+
+REBUILD: if True, commands decorated with produces() are re-run even if their outputs are up to date. Can
+also be set to a list of command names (or patterns) to re-run. Default is False. Same as pyxis --force.
+
+BUILD_STATE: file in which records of the runs of commands decorated with produces() are kept. Default is
+.pyxis-build.json.
 
 PERSIST: if False, then per() commands (such as per_ms) will abort processing on any error. If True,
 per commands will carry on with other items in the list, and will only report the error afterwards.
+
+PER_LEDGER: if True, per() commands record each value completed successfully (or failed) in a ledger file next
+to the log, and skip values already completed when the recipe is re-run, e.g. after a crash. Can also be set to
+the name of the ledger file (any string other than 1, true or yes). Values are matched by loop variable, the values of any enclosing loops, and the
+list of commands run per value, so changing the latter starts the loop afresh. Delete the ledger to start over.
+Default is False.
+
+PYXIS_PROFILE_TEMPLATES: if True (or if set in the environment), collects timing statistics on template
+evaluation, and prints a report on exit. Same as running pyxis --profile-templates.
 """
 
 # set of protected variables -- assignments to these via templates or assign() will be ignored
@@ -75,7 +168,13 @@ def init (context):
   context.setdefault("OUTDIR",".");
   context.setdefault("JOBS",0);
   context.setdefault("JOB_STAGGER",10);
+  context.setdefault("BG_JOBS",0);
+  context.setdefault("LOG_SHARDS",True);
+  context.setdefault("EXEC_STATS",False);
+  context.setdefault("REBUILD",False);
   context.setdefault("PERSIST",0);
+  context.setdefault("PER_LEDGER",False);
+  context.setdefault("PER_EXECUTOR","fork");
   context.setdefault("PYXIS_LOAD_CONFIG",True);
   context.setdefault("PYXIS_AUTO_IMPORT_MODULES",True);
   # set default verbosity to 1
@@ -86,14 +185,22 @@ def init (context):
   Pyxis._predefined_names = set(context.keys());
   Pyxis.Commands._init(context);
   # loaded modules
-  global _namespaces,_superglobals,_modules;
+  global _namespaces,_superglobals,_superglobal_index,_superglobal_values,_modules;
   _namespaces = dict();
   _superglobals = dict();
+  # reverse index: superglobal name -> list of module namespaces using it, and the last propagated values
+  _superglobal_index = dict();
+  _superglobal_values = dict();
   _modules = dict();
   # The "v" and "" namespaces correspond to the global context
   # All variables of that context are superglobals.
   _namespaces['v'] = context;
   _superglobals[id(context)] = context;
+  # dependency graph of templates
+  global _template_graph;
+  _template_graph = _TemplateGraph();
+  if context.get("PYXIS_PROFILE_TEMPLATES") or os.environ.get("PYXIS_PROFILE_TEMPLATES"):
+    enable_template_profile(report_at_exit=True);
   # report verbosity
   global _verbose_startup_message;
   if preset_verbosity is None and context['VERBOSE'] == 1:
@@ -119,8 +226,58 @@ def _int_or_str (x):
     
 def interpolate_args (args,kws,frame,convert_lists=False): 
   """Helper function to interpolate argument list and keywords using the local dictionary, plus Pyxis.Context globals""";
-  return [ interpolate(arg,frame,convert_lists=convert_lists) for arg in args ], \
-         dict([ (kw,interpolate(arg,frame,convert_lists=convert_lists)) for kw,arg in kws.items() ]);
+  # one scope is shared by all arguments, so the frame's locals are materialized once at most
+  scope = _make_scope(frame);
+  return [ interpolate(arg,scope,convert_lists=convert_lists) for arg in args ], \
+         dict([ (kw,interpolate(arg,scope,convert_lists=convert_lists)) for kw,arg in kws.items() ]);
+
+class Scope (object):
+  """A Scope is an explicit chain of dicts in which interpolate() looks up variables (in order, followed 
+  by the global Pyxis context). A Scope can be passed to interpolate() and friends in place of a frame, in
+  which case no frame inspection is done at all. E.g.:
+  
+    scope = Scope(dict(msname="foo.ms"),globals())
+    interpolate("$msname:$DDID",scope)
+  """;
+  def __init__ (self,*maps):
+    self.maps = list(maps);
+    self.dicts = self.maps + [ Pyxis.Context ];
+    
+  def new_child (self,mapping=None):
+    """Returns a new Scope with the given dict (or a new empty dict) in front of this one""";
+    return Scope(mapping if mapping is not None else {},*self.maps);
+
+class _FrameScope (object):
+  """Lookup scope formed by the locals and globals of a frame and its callers (to a depth of 'depth'),
+  plus the global Pyxis context. Accessing frame.f_locals is expensive, since it materializes the locals
+  dict, so this is only done when a variable is actually looked up for the first time.""";
+  __slots__ = ("frame","depth","_dicts");
+  
+  def __init__ (self,frame,depth=1):
+    self.frame,self.depth = frame,depth;
+    self._dicts = None;
+    
+  @property
+  def dicts (self):
+    if self._dicts is None:
+      lookups = [];
+      frame,depth = self.frame,self.depth;
+      while depth>=0 and frame:
+        lookups += [ frame.f_locals,frame.f_globals ];
+        frame = frame.f_back
+        depth -= 1
+      lookups.append(Pyxis.Context);
+      self._dicts = lookups;
+      self.frame = None;
+    return self._dicts;
+
+def _make_scope (frame,depth=1):
+  """Helper function: makes a lookup scope object for the given frame, dict or scope""";
+  if isinstance(frame,(Scope,_FrameScope)):
+    return frame;
+  elif isinstance(frame,dict):
+    return Scope(frame);
+  return _FrameScope(frame,depth);
   
 class ShellExecutor (object):    
   """This is a ShellExecutor object, which is associated with a particular shell command, and can be
@@ -134,10 +291,11 @@ the object. ShellExecutors are typically created via the Pyxis x, xo or xz built
       ls(x=1)          # runs "ls x=1"
   """;
   
-  def __init__ (self,name,path,frame,allow_fail=False,get_output=False,bg=False,verbose=1,args0=(),kws0={},args1=(),kws1={},doc=False):
+  def __init__ (self,name,path,frame,allow_fail=False,get_output=False,bg=False,verbose=1,args0=(),kws0={},args1=(),kws1={},doc=False,cache=False):
     self.name,self.path = name,path;
     self.allow_fail = allow_fail;
     self.bg  = bg;
+    self.cache = cache;
     self.argframe = frame;
     self.get_output = get_output;
     self.verbose = verbose;
@@ -156,8 +314,9 @@ the object. ShellExecutors are typically created via the Pyxis x, xo or xz built
     
   def args (self,*args,**kws):
     """Creates instance of executor with additional args. Local variables of caller are interpolated."""
-    args0,kws0 = interpolate_args(self._pre_args,self._pre_kws,self.argframe);
-    args1,kws1 = interpolate_args(self._post_args,self._post_kws,self.argframe);
+    argscope = _make_scope(self.argframe);
+    args0,kws0 = interpolate_args(self._pre_args,self._pre_kws,argscope);
+    args1,kws1 = interpolate_args(self._post_args,self._post_kws,argscope);
     before = kws.pop("before",None);
     after = kws.pop("after",None);
     kws0.update(kws);
@@ -166,7 +325,7 @@ the object. ShellExecutors are typically created via the Pyxis x, xo or xz built
     if after is not None:
       args1 += [ after ] if isinstance(after,str) else list(after);
     return ShellExecutor(self.name,self.path,inspect.currentframe().f_back,self.allow_fail,
-        self.get_output,self.bg,self.verbose,(args0+list(args)),kws0,args1,kws1);
+        self.get_output,self.bg,self.verbose,(args0+list(args)),kws0,args1,kws1,cache=self.cache);
 
   def __str__ (self):
     return " ".join([self.path or ""]+self._pre_args+["%s=%s"%(a,b) for a,b in self._pre_kws.items()]);
@@ -176,24 +335,32 @@ the object. ShellExecutors are typically created via the Pyxis x, xo or xz built
     
   def __call__ (self,*args,**kws):
     """Runs the associated shell command, with additional supplied arguments. Normal arguments are simply converted
-    to strings. Keywords are converted to key=value arguments. Local variables of the caller are interpolated."""
+    to strings. Keywords are converted to key=value arguments. Local variables of the caller are interpolated.
+    The cache, cache_inputs and cache_outputs keywords enable result caching, see _call_exec() for details."""
+    if self.path is None and _plan is not None:
+      # in a dry run, a command that is not installed here can still be planned
+      self.path = self.name;
     if self.path is None:
       if self.allow_fail:
         _abort("PYXIS: shell command '%s' not found"%self.name);
       _warn("PYXIS: shell command '%s' not found"%self.name);
     else:
-      args0,kws0 = interpolate_args(self._pre_args,self._pre_kws,self.argframe,convert_lists=True);
-      args1,kws1 = interpolate_args(self._post_args,self._post_kws,self.argframe,convert_lists=True);
+      argscope = _make_scope(self.argframe);
+      args0,kws0 = interpolate_args(self._pre_args,self._pre_kws,argscope,convert_lists=True);
+      args1,kws1 = interpolate_args(self._post_args,self._post_kws,argscope,convert_lists=True);
       args,kws = interpolate_args(args,kws,inspect.currentframe().f_back,convert_lists=True);
       kws0.update(kws);
+      if self.cache:
+        kws0.setdefault('cache',True);
       return _call_exec(self.path,get_output=self.get_output,allow_fail=self.allow_fail,bg=self.bg,verbose=self.verbose,
         args=args0+args+args1,kws1=kws1,**kws0);
 
 class ShellExecutorFactory (object):
   """This object can be used to create proxies for shell commands called ShellExecutors."""
-  def __init__ (self,allow_fail=False,bg=False,get_output=False,verbose=0):
+  def __init__ (self,allow_fail=False,bg=False,get_output=False,verbose=0,cache=False):
     self.allow_fail = allow_fail;
     self.bg = bg;
+    self.cache = cache;
     self.get_output = get_output;
     self.verbose = verbose;
     self.doc_proto = """The '%(name)s' built-in provides an interface for shell commands. Invoking
@@ -215,7 +382,7 @@ class ShellExecutorFactory (object):
       path = command if os.access(command,os.X_OK) else None;
     else:
       path = find_exec(command);
-    return ShellExecutor(command,path,None,self.allow_fail,self.get_output,self.bg,self.verbose);
+    return ShellExecutor(command,path,None,self.allow_fail,self.get_output,self.bg,self.verbose,cache=self.cache);
     
   def __call__ (self,*args,**kws):
     """An alternative way to make ShellExecutors, e.g. as x("command arg1 arg2").
@@ -226,7 +393,17 @@ class ShellExecutorFactory (object):
     elif len(args) == 1:
       args = args[0].split(" ");
     return ShellExecutor(args[0],args[0],None,allow_fail=self.allow_fail,bg=self.bg,
-                verbose=self.verbose,get_output=self.get_output,args0=args[1:],kws0=kws);
+                verbose=self.verbose,get_output=self.get_output,args0=args[1:],kws0=kws,cache=self.cache);
+
+  @property
+  def _cached (self):
+    """Returns a version of this factory whose ShellExecutors cache their results, e.g.
+      x._cached.lwimager(...,cache_inputs="$MS",cache_outputs="$RESTORED_IMAGE")
+    (the underscore keeps it from hiding a tool called "cached"). See _call_exec() for details.""";
+    factory = ShellExecutorFactory(self.allow_fail,self.bg,self.get_output,self.verbose,cache=True);
+    factory.__name__ = getattr(self,"__name__","x")+"._cached";
+    factory.doc_proto = self.doc_proto;
+    return factory;
     
   def sh (self,*args,**kws):
     """Directly invokes the shell with a command and arguments"""
@@ -236,37 +413,39 @@ class ShellExecutorFactory (object):
     flush_log();
     #
     quiet = kws.pop("quiet",False)
-    # if stdout/stderr is not a file (as is the case under ipython notebook, then
-    # subprocess.Popen() fails. Therefore, in these cases, or if get_output is true, we
-    # pipe the output into here via communicate()
-    if _ispy2:
-      stdout = subprocess.PIPE if self.get_output or type(sys.stdout) is not file else sys.stdout;
-      stderr = subprocess.PIPE if type(sys.stderr) is not file else sys.stderr;
-    else:
-      from _io import TextIOWrapper
-      stdout = subprocess.PIPE if self.get_output or type(sys.stdout) is not TextIOWrapper else sys.stdout;
-      stderr = subprocess.PIPE if type(sys.stderr) is not TextIOWrapper else sys.stderr;
-    po = subprocess.Popen(["/bin/bash","-c"]+list(commands), preexec_fn=_on_parent_exit('SIGTERM'),
-        shell=False,stdout=stdout,stderr=stderr);
-    # if piping either output stream, capture it here
-    if stdout is subprocess.PIPE or stderr is subprocess.PIPE:
-      output,err_output = po.communicate();
-      if not self.get_output and output is not None and not quiet:
-        sys.stdout.write(output);
-        output = None;
-      if err_output is not None and not quiet:
-        sys.stderr.write(err_output);
-    else:
-      po.wait();
-      output = po.returncode;
-    if po.returncode:
-      if self.allow_fail:
-        _warn("PYXIS: '%s' returns error code %d"%(commands[0],po.returncode));
+    line_callback = kws.pop("line_callback",None);
+    if _plan is not None:
+      cmdwords = " ".join(commands).split();
+      _plan.record("exec",argv=list(commands),tool=os.path.basename(cmdwords[0]) if cmdwords else "sh");
+      return "" if self.get_output else 0;
+    with _event_span("sh",argv=list(commands)) as span:
+      # if stdout/stderr is not a file (as is the case under ipython notebook, then
+      # subprocess.Popen() fails. Therefore, in these cases, or if get_output is true, we
+      # pipe the output into here, and forward it line by line
+      piped = line_callback is not None;
+      stdout = subprocess.PIPE if self.get_output or piped or not _is_file_stream(sys.stdout) else sys.stdout;
+      stderr = subprocess.PIPE if piped or not _is_file_stream(sys.stderr) else sys.stderr;
+      t0 = time.monotonic();
+      po = subprocess.Popen(["/bin/bash","-c"]+list(commands), preexec_fn=_on_parent_exit('SIGTERM'),
+          shell=False,stdout=stdout,stderr=stderr,pass_fds=_jobserver_pass_fds());
+      # if piping either output stream, capture it here
+      if stdout is subprocess.PIPE or stderr is subprocess.PIPE:
+        output = _stream_output(po,forward_stdout=not self.get_output and not quiet,forward_stderr=not quiet,
+                                capture=self.get_output,line_callback=line_callback);
       else:
-        _abort("PYXIS: '%s' returns error code %d"%(commands[0],po.returncode));
-    else:
-      _verbose(self.verbose+1,"'%s' succeeded"%commands[0]);
-    return output;
+        _reap_child(po);
+        output = po.returncode;
+      cmdwords = " ".join(commands).split();
+      usage = _record_exec_stats(cmdwords[0] if cmdwords else "sh",po,time.monotonic()-t0);
+      span.update(returncode=po.returncode,**usage);
+      if po.returncode:
+        if self.allow_fail:
+          _warn("PYXIS: '%s' returns error code %d"%(commands[0],po.returncode));
+        else:
+          _abort("PYXIS: '%s' returns error code %d"%(commands[0],po.returncode));
+      else:
+        _verbose(self.verbose+1,"'%s' succeeded"%commands[0]);
+      return output;
       
   def __repr__ (self):
     name = self.__name__;
@@ -278,12 +457,12 @@ class _DictAccessor (object):
     object.__setattr__(self,'namespace',namespace);
     
   def __call__ (self,name,default=""):
-    if isinstance(default,str):
+    if isinstance(default,str) and default:
       default = interpolate(default,inspect.currentframe().f_back);
     return object.__getattribute__(self,'namespace').get(name,default);
     
   def __getattr__ (self,name,default=""):
-    if isinstance(default,str):
+    if isinstance(default,str) and default:
       default = interpolate(default,inspect.currentframe().f_back);
     return object.__getattribute__(self,'namespace').get(name,default);
     
@@ -308,6 +487,8 @@ class GlobalVariableSpace (_DictAccessor):
   v.define('VARNAME',value,doctext): assigns to variable VARNAME, and sets a documentation string
   v.doc('VARNAME'): returns the documentation string for a variable, or '' if none
   v.doc('VARNAME',doctext): sets the documentation string for a variable
+  v.batch(): returns a context manager that defers template evaluation until all assignments
+    inside the "with" block are done, e.g. "with v.batch(): v.MS = 'foo.ms'; ms.DDID = 1"
   """;
   
   def __init__ (self,namespace):
@@ -331,6 +512,11 @@ class GlobalVariableSpace (_DictAccessor):
     if doc:
       ns.setdefault('_symdocs',{})[name] = doc;
   
+  def batch (self):
+    """Returns a context manager for a batch of assignments. Templates are only re-evaluated (and
+    superglobals propagated) once the batch is done.""";
+    return batch();
+
   def doc (self,name,text=None):
     """doc(name) gets the documentation string for a variable, or '' if none is set.
     doc(name,text) sets the documentation string for the variable.""";
@@ -362,6 +548,8 @@ def interpolate (arg,frame,depth=1,ignore=set(),skip=set(),convert_lists=False):
   * the global Pyxis context. 
   
   Alternatively, if frame is a dict, then lookup happens in frame, then the global Pyxis context.
+  If frame is a Scope, lookup happens in its chain of dicts, then the global Pyxis context.
+  In both cases, no frames are inspected.
   
   If arg is a string, does interpolation and returns new string.
   
@@ -370,33 +558,24 @@ def interpolate (arg,frame,depth=1,ignore=set(),skip=set(),convert_lists=False):
     
   If set, 'ignore' is a container of symbols which will interpolate to an empty string.
   """;
-  # setup lookup dictionaries based on frame and depth
-  if isinstance(frame,dict):
-    lookups = [ frame,Pyxis.Context ];
-  else:
-    lookups = [];
-    while depth>=0 and frame:
-      lookups += [ frame.f_locals,frame.f_globals ];
-      frame = frame.f_back
-      depth -= 1
-    lookups.append(Pyxis.Context);
+  # setup lookup scope based on frame and depth. Frame locals are only materialized when first needed
+  lookups = _make_scope(frame,depth);
   # convert lists to strings
   if isinstance(arg,(list,tuple)) and convert_lists:
     arg = ",".join(map(str,arg));
   # interpolate either a single string, or a dict recursively
   if isinstance(arg,dict):
     arg,arg0 = arg.copy(),arg;
+    lookups = lookups.dicts;
     if arg0 is not lookups[0]:
       lookups = [arg] + lookups;
-    defdict = DictProxy(lookups,ignore);
   # interpolate until things stop changing, but quit after 20 loops
     for count in range(20):
       updates = {};
       for key,value in arg.items():
-        # interpolate string variables
+        # interpolate string variables. Note that a value never interpolates a reference to itself
         if key not in skip and isinstance(value,str):
-          defdict.ignores = [value];
-          newvalue = SmartTemplate(value).safe_substitute(defdict);
+          newvalue = _render_template(_compile_template(value),lookups,(value,));
 #          print "%s: %s->%s"%(key,value,newvalue);
           if newvalue != value:
             updates[key] = newvalue;
@@ -408,12 +587,36 @@ def interpolate (arg,frame,depth=1,ignore=set(),skip=set(),convert_lists=False):
     return arg;
   # strings are interpolated
   elif isinstance(arg,str):
-    defdict = DictProxy(lookups,ignore);
-    return SmartTemplate(str(arg)%defdict).safe_substitute(defdict);
+    arg = str(arg);
+    # old-style %(NAME)s substitutions are done first, the result is then compiled as a $-template
+    if '%' in arg:
+      arg = arg%DictProxy(lookups.dicts,ignore);
+    return _render_template(_compile_template(arg),lookups,ignore);
   # all other types returned as-is
   else:
     return arg;
 
+def _interpolate_names (arg,names,frame,depth=1):
+  """Helper function: equivalent to interpolate(arg,frame,depth) for a dict such as a frame's locals, but only
+  interpolates the entries given by 'names', and returns a list of their values. References to other entries
+  (and whatever these refer to in turn) are still followed, but the rest of the dict is neither copied nor
+  interpolated.""";
+  lookups = _make_scope(frame,depth).dicts;
+  if arg is not lookups[0]:
+    lookups = [arg] + lookups;
+  values = [];
+  for name in names:
+    value = arg.get(name);
+    # interpolate until things stop changing, but quit after 20 loops
+    if isinstance(value,str):
+      for count in range(20):
+        newvalue = _render_template(_compile_template(value),lookups,(value,));
+        if newvalue == value:
+          break;
+        value = newvalue;
+    values.append(value);
+  return values;
+
 # RE pattern matching the [PREFIX<][NAMESPACES.]NAME[?DEFAULT][:BASE|DIR|FILE|BASEPATH][>SUFFIX] syntax
 _substpattern = \
   "(?i)((?P<prefix>[^{}]+)<)?(?P<name>[._a-z][._a-z0-9]*)(\\?(?P<defval>[^}\\$]*?))?(:(?P<command>BASE|DIR|FILE|BASEPATH))?(>(?P<suffix>[^{}]+))?"
@@ -421,51 +624,119 @@ _substpattern = \
 class SmartTemplate (string.Template):
   pattern = "(?P<escaped>\\$\\$)|(\\$(?P<named>[_a-z][_a-z0-9]*))|(\\${{(?P<braced>%s)}})|(?P<invalid>\\$)".format(_substpattern);
 
-class DictProxy (object):
-  itempattern = re.compile(_substpattern+"$");
-  
-  def __init__ (self,dicts,ignores):
-    self.dicts = dicts;
-    self.ignores = frozenset(ignores);
-    
-  def __getitem__ (self,item):
-    # parse the item as a [PREFIX<]NAME[?DEFAULT][:BASE][>suffix] combo
-    match = DictProxy.itempattern.match(item);
-    if not match:
-      return ""#,item;
-    prefix,name,defval,command,suffix = match.group("prefix","name","defval","command","suffix");
-    if name in self.ignores:
-      return "";
-    # is there an explicit namespace? otherwise use the default "merged" one
+# max number of distinct strings kept in the compiled template cache
+TEMPLATE_CACHE_SIZE = 4096;
+
+class _LookupNode (object):
+  """A compiled [PREFIX<][NAMESPACE.]NAME[?DEFAULT][:COMMAND][>SUFFIX] reference""";
+  __slots__ = ("prefix","fullname","namespace","name","defval","command","suffix");
+
+  def __init__ (self,prefix,name,defval,command,suffix):
+    self.prefix = prefix or "";
+    self.suffix = suffix or "";
+    self.defval = defval;
+    self.command = command and command.upper();
+    self.fullname = name;
+    # is there an explicit namespace? otherwise the default "merged" one is used
     if '.' in name:
-      namespace,name = name.rsplit(".",1);
-      namespace = _namespaces.get(namespace);
-      if namespace is None:
-        return ""; #,item;
-      value = namespace.get(name,defval);
+      self.namespace,self.name = name.rsplit(".",1);
     else:
-      for dd in self.dicts:
+      self.namespace,self.name = None,name;
+
+  def lookup (self,dicts,ignores):
+    """Looks up the reference in the given list of dicts, and returns the substituted string""";
+    if self.fullname in ignores:
+      return "";
+    name = self.name;
+    if self.namespace is None:
+      for dd in dicts:
         value = dd.get(name);
         if value is not None:
           break;
+    else:
+      namespace = _namespaces.get(self.namespace);
+      if namespace is None:
+        return "";
+      value = namespace.get(name,self.defval);
     if value is None or value == '':
-      value = defval;
+      value = self.defval;
     # check for commands
-    if isinstance(value,str) and command:
+    command = self.command;
+    if command and isinstance(value,str):
       # for dir/file.ext, returns "file"
-      if command.upper() == "BASE":
+      if command == "BASE":
         value = value and os.path.basename(value);
         value = value and os.path.splitext(value)[0];
       # for dir/file.ext, returns "dir/file"
-      elif command.upper() == "BASEPATH":
+      elif command == "BASEPATH":
         value = value and os.path.splitext(value)[0];
       # for dir/file.ext, returns "dir"
-      elif command.upper() == "DIR":
+      elif command == "DIR":
         value = (value and os.path.dirname(value)) or ".";
       # for dir/file.ext, returns "file.ext"
-      elif command.upper() == "FILE":
+      elif command == "FILE":
         value = value and os.path.basename(value);
-    return (prefix or "")+str(value)+(suffix or "") if value not in ('',None) else "";
+    return self.prefix+str(value)+self.suffix if value not in ('',None) else "";
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_item (item):
+  """Parses a [PREFIX<]NAME[?DEFAULT][:BASE][>SUFFIX] item into a _LookupNode, or returns None if invalid""";
+  match = DictProxy.itempattern.match(item);
+  if not match:
+    return None;
+  return _LookupNode(*match.group("prefix","name","defval","command","suffix"));
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template (text):
+  """Compiles a $-template string into a tuple of nodes. Each node is either a literal string, 
+  or a _LookupNode (or None, for an unparseable reference, which interpolates to an empty string).
+  Results are cached, so each distinct string is only parsed once.""";
+  nodes = [];
+  literal = "";
+  pos = 0;
+  for match in SmartTemplate.pattern.finditer(text):
+    literal += text[pos:match.start()];
+    pos = match.end();
+    escaped,named,braced = match.group("escaped","named","braced");
+    if escaped is not None:
+      literal += "$";
+    elif named is not None or braced is not None:
+      if literal:
+        nodes.append(literal);
+        literal = "";
+      nodes.append(_compile_item(named if named is not None else braced));
+    # invalid "$" is left as is
+    else:
+      literal += match.group();
+  literal += text[pos:];
+  if literal:
+    nodes.append(literal);
+  return tuple(nodes);
+
+def _render_template (nodes,dicts,ignores):
+  """Renders a compiled template (see _compile_template) using the given list of lookup dicts, or a scope""";
+  if len(nodes) == 1 and type(nodes[0]) is str:
+    return nodes[0];
+  elif not nodes:
+    return "";
+  if type(dicts) is not list:
+    dicts = dicts.dicts;
+  return "".join([ node if type(node) is str else (node.lookup(dicts,ignores) if node is not None else "") 
+                   for node in nodes ]);
+
+class DictProxy (object):
+  itempattern = re.compile(_substpattern+"$");
+  
+  def __init__ (self,dicts,ignores):
+    self.dicts = dicts;
+    self.ignores = frozenset(ignores);
+    
+  def __getitem__ (self,item):
+    # parse the item as a [PREFIX<]NAME[?DEFAULT][:BASE][>suffix] combo
+    node = _compile_item(item);
+    if node is None:
+      return ""#,item;
+    return node.lookup(self.dicts,self.ignores);
     
   def __contains__ (self,item):
     return True;
@@ -493,6 +764,8 @@ def assign (name,value,namespace=None,default_namespace=None,interpolate=True,fr
   if name in namespace.setdefault('__pyxis_protected_variables',set()):
     _verbose(verbose_level,"ignoring assign('%s.%s',...): protected variable"%(modname,name));
     return;
+  if _template_profile is not None:
+    _template_profile.assigns += 1;
   # interpolate if asked to, unless this is a template, which are never interpolated
   if interpolate and not name.endswith("_Template"):
     value1 = Pyxis.Internals.interpolate(value,frame);
@@ -508,10 +781,9 @@ def assign (name,value,namespace=None,default_namespace=None,interpolate=True,fr
 #  namespace[name] = value1;
 #  _verbose(verbose_level,"setting %s.%s=%s"%(modname,name,value1));
   # get superglobals associated with this namespace: if the variable is one of them, then propagate the new value
-  # across all other namespaces using that superglobal
-  superglobs = _superglobals.get(id(namespace),[]);
-  if name in superglobs:
-    namespaces += [ ns for ns in _namespaces.values() if name in _superglobals.get(id(ns)) and ns is not namespace ];
+  # across all other namespaces using that superglobal. Inside a batch, this is deferred until commit.
+  if not _batch_depth:
+    namespaces += _superglobal_namespaces(namespace,name);
   # now assign
   for ns in namespaces:
     nsname = ns['__name__'] if ns is not Pyxis.Context else "v";
@@ -520,9 +792,92 @@ def assign (name,value,namespace=None,default_namespace=None,interpolate=True,fr
     # if assigning a template, make sure the template is re-enabled
     if name.endswith("_Template"):
       ns.get('__pyxis_template_ids',{}).pop(name[:-len("_Template")],None);
-  # reprocess templates
+  # reprocess templates, unless deferred by a batch
+  if _batch_depth:
+    _batch_pending[id(namespace),name] = namespace,name;
+    return;
   assign_templates();
 
+def assign_many (values,namespace=None,default_namespace=None,interpolate=True,frame=None,autoimport=False,verbose_level=2):
+  """Assigns a dict of name:value pairs (see assign() for details), then reevaluates templates once. Intermediate
+  states are never seen by templates, e.g. assign_many(dict(MS="foo.ms",DDID=1))."""
+  frame = frame or inspect.currentframe().f_back;
+  with batch():
+    for name,value in values.items():
+      assign(name,value,namespace=namespace,default_namespace=default_namespace,interpolate=interpolate,
+             frame=frame,autoimport=autoimport,verbose_level=verbose_level);
+
+_batch_depth = 0;
+# dict of (id(namespace),name) -> (namespace,name) pairs assigned inside the current batch
+_batch_pending = {};
+
+class _AssignmentBatch (object):
+  """Context manager returned by batch()""";
+  def __enter__ (self):
+    global _batch_depth;
+    _batch_depth += 1;
+    return self;
+
+  def __exit__ (self,*exc_info):
+    global _batch_depth;
+    _batch_depth -= 1;
+    if not _batch_depth:
+      _commit_batch();
+    return False;
+
+def batch ():
+  """Returns a context manager for a batch of assignments. Inside the batch, assign() and unset() only
+  touch the given namespace: superglobal propagation and template evaluation are deferred until the
+  (outermost) batch exits. E.g.:
+  
+    with v.batch():
+      v.MS = "foo.ms"
+      ms.DDID = 1
+  """;
+  return _AssignmentBatch();
+
+def _commit_batch ():
+  """Helper function: propagates superglobals assigned inside a batch, then reevaluates templates""";
+  pending = list(_batch_pending.values());
+  _batch_pending.clear();
+  for namespace,name in pending:
+    value = namespace.get(name,_MISSING);
+    for ns in _superglobal_namespaces(namespace,name):
+      if value is _MISSING:
+        ns.pop(name,None);
+        ns.get('__pyxis_template_ids',{}).pop(name,None);
+      else:
+        ns[name] = value;
+        if name.endswith("_Template"):
+          ns.get('__pyxis_template_ids',{}).pop(name[:-len("_Template")],None);
+  assign_templates();
+
+def _superglobal_namespaces (namespace,name):
+  """Helper function: if name is a superglobal of namespace, returns list of all other namespaces using
+  that superglobal, else an empty list.""";
+  if name not in _superglobals.get(id(namespace),()):
+    return [];
+  # the global context has every one of its variables as a superglobal
+  namespaces = [ Pyxis.Context ] if namespace is not Pyxis.Context and name in Pyxis.Context else [];
+  return namespaces + [ ns for ns in _superglobal_index.get(name,()) if ns is not namespace ];
+
+def _index_superglobal (globs,sym):
+  """Helper function: adds module namespace given by globs to the list of subscribers of superglobal sym""";
+  subscribers = _superglobal_index.setdefault(sym,[]);
+  if not any([ ns is globs for ns in subscribers ]):
+    subscribers.append(globs);
+
+def _sync_superglobals ():
+  """Helper function: propagates superglobals that have changed in the global context since the last call
+  to all modules using them.""";
+  for name,subscribers in _superglobal_index.items():
+    value = Pyxis.Context.get(name,_MISSING);
+    if value is not _superglobal_values.get(name,_MISSING):
+      _superglobal_values[name] = value;
+      if value is not _MISSING:
+        for ns in subscribers:
+          ns[name] = value;
+
 def unset (name,namespace=None,frame=None,verbose_level=2):
   """Unsets variable. Reactivates any templates associated with variable."""
   frame = frame or inspect.currentframe().f_back;
@@ -532,21 +887,23 @@ def unset (name,namespace=None,frame=None,verbose_level=2):
   # get list of namespaces from which to unset
   namespaces = [ namespace ];
   # get superglobals associated with this namespace: if the variable is one of them, then propagate the un-setting
-  # across all other namespaces using that superglobal
-  superglobs = _superglobals.get(id(namespace),[]);
-  if name in superglobs:
-    namespaces += [ ns for ns in _namespaces.values() if name in _superglobals.get(id(ns)) and ns is not namespace ];
+  # across all other namespaces using that superglobal. Inside a batch, this is deferred until commit.
+  if not _batch_depth:
+    namespaces += _superglobal_namespaces(namespace,name);
   # now loop over all namespaces in which to unset
   for ns in namespaces:
     modname = ns.get('__name__',"???") if ns is not Pyxis.Context else "v";
     if name in ns:
-      _verbose(verbose_level,"unsetting %s.%s"%(modname,name,value1));
+      _verbose(verbose_level,"unsetting %s.%s"%(modname,name));
       ns.pop(name);
     tmpldict = ns.get('__pyxis_template_ids',{});
     if name in tmpldict:
       tmpldict.pop(name);
       _verbose(verbose_level,"  and re-enabling associated template %s.%s_Template"%(modname,name));
-  # reprocess templates
+  # reprocess templates, unless deferred by a batch
+  if _batch_depth:
+    _batch_pending[id(namespace),name] = namespace,name;
+    return;
   assign_templates();
 
 
@@ -577,121 +934,613 @@ class DependsHandler (object):
       result |= hdl.check(value);
     return result;
     
+# marks a variable that is not defined in its namespace
+_MISSING = object();
+
+# matches the item of an old-style %(NAME)s substitution
+_re_percent_item = re.compile("%\\(([^)]*)\\)");
+
+def _template_references (value):
+  """Helper function: returns list of [NAMESPACE.]NAME references made by a template, or None
+  if these can't be determined (i.e. for callable templates without declared inputs).""";
+  if callable(value) and getattr(value,'_pyxis_template_inputs',None) is not None:
+    return list(value._pyxis_template_inputs);
+  elif isinstance(value,str):
+    strings = [ value ];
+  elif isinstance(value,tuple):
+    strings = [ value[0] ] if value and isinstance(value[0],str) else [];
+    if len(value) > 1 and isinstance(value[1],(list,tuple,dict)):
+      for pair in ( value[1] if not isinstance(value[1],dict) else iter(value[1].items()) ):
+        if isinstance(pair,(list,tuple)) and pair and isinstance(pair[0],str):
+          strings.append(pair[0]);
+  elif isinstance(value,list):
+    strings = [ val for val in value if isinstance(val,str) ];
+  elif callable(value):
+    return None;
+  else:
+    strings = [];
+  refs = [];
+  for text in strings:
+    nodes = list(_compile_template(text));
+    if '%' in text:
+      nodes += [ _compile_item(item) for item in _re_percent_item.findall(text) ];
+    refs += [ node.fullname for node in nodes if isinstance(node,_LookupNode) ];
+  return refs;
+
+def _value_changed (oldvalue,value):
+  """Helper function: returns True if value differs from oldvalue""";
+  if oldvalue is value:
+    return False;
+  if oldvalue is _MISSING or value is _MISSING:
+    return True;
+  try:
+    return bool(oldvalue != value);
+  except:
+    return True;
+
+class _TemplateNode (object):
+  """Describes one X_Template variable of a namespace, and the variables it depends on""";
+  __slots__ = ("nsname","var","varname","value","inputs","output","outputs","index","fresh");
+
+  def __init__ (self,nsname,var,value,inputs,output,side_outputs=()):
+    self.nsname,self.var,self.value = nsname,var,value;
+    self.varname = var[:-len("_Template")];
+    # inputs is a set of (nsname,name) keys, or None if unknown (callable templates)
+    self.inputs,self.output = inputs,output;
+    # outputs also includes any other variables declared as set by (callable) templates
+    self.outputs = [ output ] + [ key for key in side_outputs if key != output ];
+    self.index = None;
+    self.fresh = True;
+
+  def __str__ (self):
+    return "%s.%s"%(self.nsname,self.var);
+
+class _TemplateGraph (object):
+  """Keeps track of all templates in all Pyxis namespaces, and of the dependencies between them.
+  Each variable is identified by a (nsname,name) key, where nsname is "v" for the global context.
+  The graph is only rebuilt when templates are (re)defined; changes to variables are detected by
+  comparing against a snapshot of the values of all variables that templates refer to, so only the
+  (transitive) dependents of changed variables are ever re-evaluated.""";
+
+  def __init__ (self):
+    # list of _TemplateNodes, in topological order
+    self.nodes = [];
+    # dict of nsname -> dict of var -> template value
+    self.defs = {};
+    # dict of nsname -> number of symbols in namespace at last scan
+    self.nslen = {};
+    # dict of key -> list of _TemplateNodes referring to that key
+    self.dependents = {};
+    # dict of key -> _TemplateNode producing that key
+    self.producers = {};
+    # dict of key -> (value,copy) as of the last evaluation
+    self.snapshot = {};
+    # set of template cycles that have already been reported
+    self.reported_cycles = set();
+    self.stale = True;
+
+  def invalidate (self):
+    """Forces a rescan of all namespaces for templates, e.g. when superglobals are (re)registered""";
+    self.stale = True;
+    self.nslen = {};
+
+  @staticmethod
+  def key (nsname,name):
+    """Returns canonical key for name in namespace: superglobals always map to the global context""";
+    ns = _namespaces.get(nsname);
+    if ns is not None and ns is not Pyxis.Context and name in _superglobals.get(id(ns),()):
+      return "v",name;
+    return nsname,name;
+
+  def _input_keys (self,nsname,refs):
+    """Converts list of template references into a set of keys""";
+    inputs = set();
+    for ref in refs:
+      if '.' in ref:
+        inputs.add(self.key(*ref.rsplit(".",1)));
+      # unqualified names are looked up in the template's namespace, then in the global context
+      else:
+        inputs.add(self.key(nsname,ref));
+        inputs.add(("v",ref));
+    return inputs;
+
+  def refresh (self):
+    """Rescans namespaces that have changed for new or modified templates, and rebuilds the graph if needed""";
+    for nsname,ns in list(_namespaces.items()):
+      defs = self.defs.get(nsname);
+      # quick check: same number of symbols, and all known templates unchanged
+      if defs is not None and self.nslen.get(nsname) == len(ns) and \
+          all([ ns.get(var,_MISSING) is value for var,value in defs.items() ]):
+        continue;
+      self.nslen[nsname] = len(ns);
+      newdefs = dict([ (var,value) for var,value in list(ns.items()) if var.endswith("_Template") ]);
+      if defs is None or len(newdefs) != len(defs) or \
+          any([ defs.get(var,_MISSING) is not value for var,value in newdefs.items() ]):
+        self.defs[nsname] = newdefs;
+        self.stale = True;
+    if self.stale:
+      self.rebuild();
+
+  def rebuild (self):
+    """Rebuilds the dependency graph and topological order of templates""";
+    self.stale = False;
+    oldnodes = dict([ ((node.nsname,node.var),node) for node in self.nodes ]);
+    nodes = [];
+    self.producers = {};
+    for nsname,defs in self.defs.items():
+      for var,value in defs.items():
+        refs = _template_references(value);
+        inputs = self._input_keys(nsname,refs) if refs is not None else None;
+        side_outputs = [ self.key(*name.rsplit(".",1)) if '.' in name else self.key(nsname,name)
+                         for name in getattr(value,'_pyxis_template_outputs',()) ];
+        node = _TemplateNode(nsname,var,value,inputs,self.key(nsname,var[:-len("_Template")]),side_outputs);
+        # a template that hasn't changed since the last rebuild doesn't need to be re-evaluated
+        old = oldnodes.get((nsname,var));
+        if old is not None and old.value is value and not old.fresh:
+          node.fresh = False;
+        nodes.append(node);
+    # declared side outputs are added first, so that a template's own variable always takes precedence
+    for node in nodes:
+      for key in node.outputs[1:]:
+        self.producers[key] = node;
+    for node in nodes:
+      self.producers[node.output] = node;
+    # topological sort (Kahn's algorithm), preserving definition order where possible
+    depends_on = dict([ (id(node),set()) for node in nodes ]);
+    self.dependents = {};
+    for node in nodes:
+      for key in (node.inputs or ()):
+        self.dependents.setdefault(key,[]).append(node);
+        producer = self.producers.get(key);
+        if producer is not None:
+          depends_on[id(node)].add(producer);
+    order = [];
+    ready = [ node for node in nodes if not depends_on[id(node)] ];
+    while ready:
+      node = ready.pop(0);
+      order.append(node);
+      for dep in set(itertools.chain(*[ self.dependents.get(key,[]) for key in node.outputs ])):
+        deps = depends_on[id(dep)];
+        if node in deps:
+          deps.discard(node);
+          if not deps:
+            ready.append(dep);
+    # anything left over is part of, or depends on, a reference cycle: evaluate it last, and iteratively
+    cyclic = [ node for node in nodes if depends_on[id(node)] ];
+    if cyclic and frozenset(map(str,cyclic)) not in self.reported_cycles:
+      self.reported_cycles.add(frozenset(map(str,cyclic)));
+      _warn("PYXIS: templates %s contain (or depend on) a reference cycle"%", ".join(map(str,cyclic)));
+    self.nodes = order + cyclic;
+    for index,node in enumerate(self.nodes):
+      node.index = index;
+    # start watching any new keys
+    for key in itertools.chain(self.dependents.keys(),self.producers.keys()):
+      if key not in self.snapshot:
+        self.snapshot[key] = (_MISSING,None);
+
+  def changed_keys (self,keys=None):
+    """Returns set of keys (of all watched keys, or of the given ones) whose values have changed since the
+    last call, and updates the snapshot""";
+    changed = set();
+    for key in list(self.snapshot.keys() if keys is None else keys):
+      oldvalue,oldcopy = self.snapshot.get(key,(_MISSING,None));
+      ns = _namespaces.get(key[0]);
+      value = ns.get(key[1],_MISSING) if ns is not None else _MISSING;
+      # mutable containers can be modified in-place, so these are compared against a copy
+      if oldcopy is not None:
+        if _value_changed(oldcopy,value):
+          changed.add(key);
+      elif value is oldvalue:
+        continue;
+      elif _value_changed(oldvalue,value):
+        changed.add(key);
+      self.update_snapshot(key,value);
+    return changed;
+
+  def up_to_date (self):
+    """Returns True if no templates have been (re)defined, and none of the variables they refer to have
+    changed since the last evaluation. This is a read-only check, the snapshot is not updated.""";
+    if self.stale:
+      return False;
+    for nsname,ns in _namespaces.items():
+      defs = self.defs.get(nsname);
+      if defs is None or self.nslen.get(nsname) != len(ns) or \
+          not all([ ns.get(var,_MISSING) is value for var,value in defs.items() ]):
+        return False;
+    for key,(oldvalue,oldcopy) in self.snapshot.items():
+      ns = _namespaces.get(key[0]);
+      value = ns.get(key[1],_MISSING) if ns is not None else _MISSING;
+      if oldcopy is not None:
+        if _value_changed(oldcopy,value):
+          return False;
+      elif value is not oldvalue and _value_changed(oldvalue,value):
+        return False;
+    return True;
+
+  def update_snapshot (self,key,value):
+    self.snapshot[key] = (value,type(value)(value) if type(value) in (list,dict,set) else None);
+
+  def evaluate (self):
+    """Evaluates all templates affected by changes since the last call, in topological order""";
+    self.refresh();
+    queue = [];
+    queued = set();
+    def enqueue (node):
+      if node.index not in queued:
+        queued.add(node.index);
+        heapq.heappush(queue,node.index);
+    def enqueue_key (key):
+      for node in self.dependents.get(key,()):
+        enqueue(node);
+      # a template is also checked when its own variable changes (to disable it on explicit assignment,
+      # or re-enable it when unset)
+      node = self.producers.get(key);
+      if node is not None and node.output == key:
+        enqueue(node);
+    for node in self.nodes:
+      if node.fresh:
+        enqueue(node);
+    changed = self.changed_keys();
+    profile = _template_profile;
+    for count in range(100):
+      for key in changed:
+        enqueue_key(key);
+      # callable templates with unknown inputs are evaluated whenever anything else has changed
+      if count == 0 or changed:
+        for node in self.nodes:
+          if node.inputs is None:
+            enqueue(node);
+      if not queue:
+        break;
+      if profile is not None:
+        profile.passes += 1;
+      changed = set();
+      while queue:
+        index = heapq.heappop(queue);
+        queued.discard(index);
+        node = self.nodes[index];
+        node.fresh = False;
+        outputs = self.changed_keys(node.outputs[1:]);
+        if profile is not None:
+          stats = profile.start(node);
+        if _evaluate_template(node):
+          self.update_snapshot(node.output,_namespaces[node.output[0]].get(node.output[1]));
+          outputs.add(node.output);
+        # check declared side outputs of the template
+        outputs |= self.changed_keys(node.outputs[1:]);
+        if profile is not None:
+          profile.stop(stats,bool(outputs));
+        for key in outputs:
+          for dep in self.dependents.get(key,()):
+            # dependents further down the order are evaluated in this pass, others (i.e. cycles) in the next one
+            if dep.index > index:
+              enqueue(dep);
+            else:
+              changed.add(key);
+      # catch any variables changed as side effects of templates
+      changed |= self.changed_keys();
+      if not changed:
+        break;
+    else:
+      _abort("Too many template assignment steps. This can be caused by templates that cross-reference each other");
+
+_template_graph = _TemplateGraph();
+
+class _TemplateProfile (object):
+  """Collects statistics on template evaluation, see enable_template_profile()""";
+  # audit events that are counted as I/O done by a callable template
+  io_events = frozenset(("open","os.listdir","os.scandir","os.system","os.exec","os.posix_spawn",
+                         "os.spawn","subprocess.Popen","socket.connect"));
+
+  def __init__ (self):
+    # dict of (nsname,var) -> [evaluations,changed,seconds,io_events,is_callable]
+    self.templates = {};
+    # number of assign() calls, assign_templates() calls (total and skipped) and evaluation passes
+    self.assigns = self.calls = self.skipped = self.passes = 0;
+    # stats entry of the template currently being evaluated
+    self.current = None;
+    # I/O is detected via an audit hook (Python 3.8+), which can't be removed once added, so this is only done once
+    if hasattr(sys,'addaudithook') and not getattr(_TemplateProfile,'_hooked',False):
+      _TemplateProfile._hooked = True;
+      sys.addaudithook(_TemplateProfile._audit);
+
+  @staticmethod
+  def _audit (event,args):
+    profile = _template_profile;
+    if profile is not None and profile.current is not None and event in _TemplateProfile.io_events:
+      profile.current[3] += 1;
+
+  def start (self,node):
+    stats = self.templates.get((node.nsname,node.var));
+    if stats is None:
+      stats = self.templates[node.nsname,node.var] = [0,0,0.,0,callable(node.value)];
+    self.current = stats;
+    stats[2] -= time.time();
+    return stats;
+
+  def stop (self,stats,changed):
+    stats[2] += time.time();
+    stats[0] += 1;
+    stats[1] += int(changed);
+    self.current = None;
+
+_template_profile = None;
+
+def enable_template_profile (enable=True,report_at_exit=False):
+  """Enables (or disables) collection of template evaluation statistics, see template_profile_report().
+  Statistics are reset each time this is called. If report_at_exit is True, the report is printed when
+  Pyxis exits.""";
+  global _template_profile;
+  _template_profile = _TemplateProfile() if enable else None;
+  if enable and report_at_exit:
+    atexit.unregister(_report_template_profile_at_exit);
+    atexit.register(_report_template_profile_at_exit);
+
+def _report_template_profile_at_exit ():
+  # subprocesses of per() loops don't report
+  if _template_profile is not None and Pyxis.Commands._subprocess_id is None:
+    sys.__stderr__.write(template_profile_report()+"\n");
+
+def template_profile_report ():
+  """Returns a text table of template evaluation statistics collected since enable_template_profile().
+  Templates that have been re-evaluated without ever changing their result are flagged as NOCHANGE,
+  callable templates that open files, run subprocesses, etc. are flagged as IO.""";
+  profile = _template_profile;
+  if profile is None:
+    return "template profiling is not enabled";
+  lines = [ "Template evaluation profile: %d assign() calls, %d assign_templates() calls (%d skipped as up to date), "
+            "%d evaluation passes (%.2f per assign)"%(profile.assigns,profile.calls,profile.skipped,profile.passes,
+              profile.passes/float(profile.assigns or 1)) ];
+  format = "  %-48s %8s %8s %10s %10s  %s";
+  lines.append(format%("template","evals","changed","total ms","mean ms","flags"));
+  namespaces = {};
+  for (nsname,var),(nevals,nchanged,secs,nio,is_callable) in sorted(profile.templates.items(),key=lambda x:-x[1][2]):
+    flags = [];
+    if nevals > 1 and not nchanged:
+      flags.append("NOCHANGE");
+    if nio and is_callable:
+      flags.append("IO(%d)"%nio);
+    lines.append(format%("%s.%s"%(nsname,var),nevals,nchanged,"%.3f"%(secs*1000),"%.3f"%(secs*1000/nevals)," ".join(flags)));
+    nsstats = namespaces.setdefault(nsname,[0,0,0.]);
+    nsstats[0] += nevals;
+    nsstats[1] += nchanged;
+    nsstats[2] += secs;
+  lines.append(format%("namespace","evals","changed","total ms","mean ms",""));
+  for nsname,(nevals,nchanged,secs) in sorted(namespaces.items(),key=lambda x:-x[1][2]):
+    lines.append(format%(nsname,nevals,nchanged,"%.3f"%(secs*1000),"%.3f"%(secs*1000/nevals),""));
+  return "\n".join(lines);
+
+def _evaluate_template (node):
+  """Helper function: evaluates a template, and assigns the result to its variable.
+  Returns True if the variable has changed.""";
+  modname,var,varname,value = node.nsname,node.var,node.varname,node.value;
+  context = _namespaces[modname];
+  superglobs = _superglobals[id(context)];
+  templdict = context.setdefault("__pyxis_template_ids",{});
+  # skip protected variables in global context
+  if varname in context.setdefault('__pyxis_protected_variables',set()):
+    _verbose(3,"ignoring template assignment of %s.%s: protected variable"%(modname,varname));
+    return False;
+  # get old value of variable
+  oldvalue = varvalue = context.get(varname);
+  # check if template is defined in the wrong place, superglobal templates must be defined
+  # in the superglobal context
+  if varname in superglobs and context is not Pyxis.Context:
+    _abort("%s.%s defined for superglobal v.%s. Fix your scripts please: use v.%s instead"%
+            (modname,var,varname,var));
+  # check if template is still active
+  if varname in templdict:
+    idvar = templdict[varname];
+    # check if template has been disabled by setting __pyxis_template_ids[var] = None
+    if idvar is None:
+      _verbose(3,"template for %s.%s has been disabled, ignoring"%(modname,var));
+      return False;
+    # check if variable has been explicitly assigned to since the last time the template
+    # got evaluated (i.e. if the id has changed). If so, disable template
+    if idvar != id(oldvalue):
+      _verbose(3,"value for %s.%s has been explicitly set [%x, was %x], disabling template"%(modname,var,id(oldvalue),idvar));
+      templdict[varname] = None;
+      return False;
+  # catch all template errors below
+  try:
+    # string templates are simply interpolated 
+    if isinstance(value,str):
+      varvalue = interpolate(value,context);
+    # templates of the form
+    # SELECT_EXPR,{pattern:value,pattern:value,...}  [,ELSEVALUE]
+    # or SELECT_EXPR,[ (pattern,value),(pattern,value),... ]  [,ELSEVALUE]
+    elif isinstance(value,tuple):
+      if len(value) not in (2,3) or not isinstance(value[0],str) or not isinstance(value[1],(list,tuple,dict)):
+        raise TypeError("invalid select clause");
+      select_expr = interpolate(value[0],context);
+      # loop through patterns, if one matches the select expression, return that value
+      for pair in ( value[1] if not isinstance(value[1],dict) else iter(value[1].items()) ):
+        if len(pair) != 2 or not isinstance(pair[0],str):
+          raise TypeError("invalid element in select clause");
+        if fnmatch.fnmatch(select_expr,interpolate(pair[0],context)):
+          varvalue = pair[1];
+          break;
+      # no patterns match? Look for ELSEVALUE, if defined
+      else:
+        if len(value) == 3:
+          varvalue = value[2];
+        elif isinstance(value[1],dict) and 'default' in value[1]:
+          varvalue = value[1]['default'];
+    # list templates are interpolated per-element
+    elif isinstance(value,list):
+      varvalue = [ interpolate(val,context) for val in value ];
+    # callable templates are called directly
+    elif callable(value):
+      varvalue = value();
+  except:
+    traceback.print_exc();
+    _warn("PYXIS: error evaluating template %s"%var);
+  if varvalue is oldvalue or not _value_changed(oldvalue,varvalue):
+    return False;
+  # set value, and set id in templdict for later comparison
+  context[varname] = varvalue;
+  templdict[varname] = id(varvalue); 
+  # if variable is superglobal, propagate it to all namespaces using it
+  for ns in _superglobal_namespaces(context,varname):
+    ns[varname] = varvalue;
+  _verbose(3,"%s templated value %s.%s=%s [%x]"%("initialized" if oldvalue is None else "updated",modname,varname,varvalue,id(varvalue)));
+  return True;
+
 _in_assign_templates = False;
 
-def assign_templates ():
+def assign_templates (if_changed=False):
   """For every variable in a Pyxis module (or the global context) that ends with "_Template", assigns value 
-  to it by interpolating the template.""";
+  to it by interpolating the template. Only templates that depend (directly or indirectly) on variables
+  that have changed since the last call are re-evaluated.
+  If if_changed=True, nothing is evaluated unless some templates or the variables they refer to have changed.
+  (Normally, callable templates without declared inputs are always re-evaluated.)""";
   ## non-reentrant, otherwise any call to Pyxis methods from within a template is liable to cause recursion
   global _in_assign_templates;
-  if _in_assign_templates:
+  if _in_assign_templates or _batch_depth:
     return;
   _in_assign_templates = True;
-  for count in range(100):
-    updated = False;
-    for modname,context in list(_namespaces.items()):
-      superglobs = _superglobals[id(context)];
-      newvalues = {};
-      templdict = context.setdefault("__pyxis_template_ids",{});
-      # interpolate new values for each variable that has a _Template equivalent
-      for var,value in list(context.items()):
-        if var.endswith("_Template"):
-          varname = var[:-len("_Template")];
-          # skip protected variables in global context
-          if varname in context.setdefault('__pyxis_protected_variables',set()):
-            _verbose(3,"ignoring template assignment of %s.%s: protected variable"%(modname,varname));
-            continue;
-          # get old value of variable
-          oldvalue = varvalue = context.get(varname);
-          # check if template is defined in the wrong place, superglobal templates must be defined
-          # in the superglobal context
-          if varname in superglobs and context is not Pyxis.Context:
-            _abort("%s.%s defined for superglobal v.%s. Fix your scripts please: use v.%s instead"%
-                    (modname,var,varname,var));
-          # check if template is still active
-          if varname in templdict:
-            idvar = templdict[varname];
-            # check if template has been disabled by setting __pyxis_template_ids[var] = None
-            if idvar is None:
-              _verbose(3,"template for %s.%s has been disabled, ignoring"%(modname,var));
-              continue;
-            # check if variable has been explicitly assigned to since the last time the template
-            # got evaluated (i.e. if the id has changed). If so, disable template
-            if idvar != id(oldvalue):
-              _verbose(3,"value for %s.%s has been explicitly set [%x, was %x], disabling template"%(modname,var,id(oldvalue),idvar));
-              templdict[varname] = None;
-              continue;
-          # catch all template errors below
-          try:
-            # string templates are simply interpolated 
-            if isinstance(value,str):
-              varvalue = interpolate(value,context);
-            # templates of the form
-            # SELECT_EXPR,{pattern:value,pattern:value,...}  [,ELSEVALUE]
-            # or SELECT_EXPR,[ (pattern,value),(pattern,value),... ]  [,ELSEVALUE]
-            elif isinstance(value,tuple):
-              if len(value) not in (2,3) or not isinstance(value[0],str) or not isinstance(value[1],(list,tuple,dict)):
-                raise TypeError("invalid select clause");
-              select_expr = interpolate(value[0],context);
-              # loop through patterns, if one matches the select expression, return that value
-              for pair in ( value[1] if not isinstance(value[1],dict) else iter(value[1].items()) ):
-                if len(pair) != 2 or not isinstance(pair[0],str):
-                  raise TypeError("invalid element in select clause");
-                if fnmatch.fnmatch(select_expr,interpolate(pair[0],context)):
-                  varvalue = pair[1];
-                  break;
-              # no patterns match? Look for ELSEVALUE, if defined
-              else:
-                if len(value) == 3:
-                  varvalue = value[2];
-                elif isinstance(value[1],dict) and 'default' in value[1]:
-                  varvalue = value[1]['default'];
-            # list templates are interpolated per-element
-            elif isinstance(value,list):
-              varvalue = [ interpolate(val) for val in value ];
-            # callable templates are called directly
-            elif callable(value):
-              varvalue = value();
-          except:
-            traceback.print_exc();
-            _warn("PYXIS: error evaluating template %s"%var);
-          if varvalue is not oldvalue:
-            newvalues[varname] = varvalue;
-      # update dict
-      for var,value in newvalues.items():
-        oldval = context.get(var);
-        if oldval != value:
-          updated = True;
-          # set value, and set id in templdict for later comparison
-          context[var] = value;
-          templdict[var] = id(value); 
-          # if variable is superglobal, propagate it to global context
-          if var in superglobs:
-            Pyxis.Context[var] = value;
-          _verbose(3,"%s templated value %s.%s=%s [%x]"%("initialized" if oldval is None else "updated",modname,var,value,id(value)));
-    if not updated:
-      break;
-  else:
-    _abort("Too many template assignment steps. This can be caused by templates that cross-reference each other");
-  # propagate superglobals
-  for ns in _namespaces.values():
-    if ns is not Pyxis.Context:
-      for var in _superglobals.get(id(ns)):
-        if var in Pyxis.Context:
-          ns[var] = Pyxis.Context[var];
-  # set logger, in case LOG value has changed
-  set_logfile(Pyxis.Context.get('LOG',None));
-  _in_assign_templates = False;
+  try:
+    # propagate superglobals that have changed (before, so that module templates see the new values,
+    # and after, in case templates have changed any as a side effect)
+    _sync_superglobals();
+    if _template_profile is not None:
+      _template_profile.calls += 1;
+    if not (if_changed and _template_graph.up_to_date()):
+      _template_graph.evaluate();
+      _sync_superglobals();
+    elif _template_profile is not None:
+      _template_profile.skipped += 1;
+    # set logger, in case LOG value has changed
+    set_logfile(Pyxis.Context.get('LOG',None));
+  finally:
+    _in_assign_templates = False;
 
 _current_logfile = None;
 _current_logobj = None;
 _warned_nolog = None;
 _visited_logfiles = set();
 
+# max number of pending writes to the logfile. When exceeded, the writer flushes the log itself
+LOG_QUEUE_SIZE = 10000;
+# interval (in seconds) at which the background thread writes out pending log messages
+LOG_WRITE_INTERVAL = 0.1;
+
+class _LogSink (object):
+  """File-like object that stands in for sys.stdout and sys.stderr when logging to a file.
+  Writes are appended to a bounded queue, which a background thread writes out in batches. The file is
+  opened in O_APPEND mode, so writes from forked jobs and child processes sharing the same log never
+  overwrite each other, and no locking or seeking is needed. flush() writes out the queue immediately.
+  fileno() does the same, so that the output of child processes (which write to the file descriptor
+  directly) is correctly ordered with respect to preceding messages.""";
+
+  def __init__ (self,filename,mode="a"):
+    self.name,self.mode = filename,mode;
+    self.encoding,self.errors = "utf-8","replace";
+    flags = os.O_WRONLY|os.O_CREAT|os.O_APPEND|(os.O_TRUNC if mode == "w" else 0);
+    self._fd = os.open(filename,flags,0o666);
+    self.closed = False;
+    # number of write() calls, and of actual writes to the file
+    self.nmessages = self.nwrites = 0;
+    self._reset();
+
+  def _reset (self):
+    self._queue = collections.deque();
+    self._lock = threading.Lock();
+    self._closing = threading.Event();
+    self._thread = None;
+
+  def write (self,text):
+    if text:
+      self._queue.append(text);
+      self.nmessages += 1;
+      if len(self._queue) > LOG_QUEUE_SIZE:
+        self.flush();
+      elif self._thread is None:
+        self._thread = threading.Thread(target=self._writer,name="pyxis-log");
+        self._thread.daemon = True;
+        self._thread.start();
+    return len(text);
+
+  def writelines (self,lines):
+    for line in lines:
+      self.write(line);
+
+  def _writer (self):
+    """Background thread: periodically writes out everything that is queued up""";
+    closing = self._closing;
+    while not closing.wait(LOG_WRITE_INTERVAL):
+      self.flush();
+
+  def flush (self):
+    que = self._queue;
+    if not que:
+      return;
+    with self._lock:
+      items = [];
+      try:
+        while True:
+          items.append(que.popleft());
+      except IndexError:
+        pass;
+      data = "".join(items).encode(self.encoding,self.errors);
+      try:
+        while data:
+          data = data[os.write(self._fd,data):];
+          self.nwrites += 1;
+      except OSError as exc:
+        sys.__stderr__.write("PYXIS: error writing to log %s: %s\n"%(self.name,exc));
+
+  def fileno (self):
+    self.flush();
+    return self._fd;
+
+  def seek (self,*args):
+    return 0;
+
+  def isatty (self):
+    return False;
+
+  def writable (self):
+    return True;
+
+  def close (self):
+    if not self.closed:
+      if self._thread is not None:
+        self._closing.set();
+        self._thread.join();
+      self.flush();
+      self.closed = True;
+      os.close(self._fd);
+
+  def _after_fork (self):
+    """Called in a forked child: the writer thread does not survive the fork, and the lock may have been
+    left held, so start afresh. Anything still queued up belongs to the parent.""";
+    self._reset();
+
+def _after_fork_in_child ():
+  global _exec_stats,_exec_stats_lock;
+  if isinstance(_current_logobj,_LogSink):
+    _current_logobj._after_fork();
+  _bg_after_fork_in_child();
+  # resource usage totals start afresh, and the lock may have been left held
+  _exec_stats,_exec_stats_lock = {},threading.Lock();
+
+if hasattr(os,'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child);
+
+def _is_file_stream (stream):
+  """Helper function: returns True if stream can be handed to a child process as its stdout/stderr""";
+  if _ispy2:
+    return type(stream) is file;
+  from _io import TextIOWrapper
+  return type(stream) is TextIOWrapper or type(stream) is _LogSink;
+
 def flush_log ():
   global _current_logobj,_current_logfile;
   _current_logobj and _current_logobj.flush();
 
+atexit.register(flush_log);
+
 def update_log ():
   global _current_logobj,_current_logfile;
   _current_logobj and _current_logobj.seek(0,2);
@@ -722,6 +1571,7 @@ def set_logfile (filename,quiet=False):
       return;
     if not quiet:
       _info("redirecting log output to %s"%(filename or "console"),console=True);
+    oldlog = _current_logobj;
     if filename is None:
       sys.stdout,sys.stderr = sys.__stdout__,sys.__stderr__;
       _current_logobj = None;
@@ -736,9 +1586,12 @@ def set_logfile (filename,quiet=False):
         if filename in _visited_logfiles:
           mode = "a";
       Pyxis.ModSupport.makedir(os.path.dirname(filename),no_interpolate=True);
-      _current_logobj = sys.stdout = sys.stderr = open(filename,mode);
+      if _log_shard is not None:
+        _current_logobj = sys.stdout = sys.stderr = _open_log_shard(filename);
+      else:
+        _current_logobj = sys.stdout = sys.stderr = _LogSink(filename,mode);
       hdr = Pyxis.Context.get("LOG_HEADER");
-      if filename not in _visited_logfiles and hdr:
+      if filename not in _visited_logfiles and hdr and _log_shard is None:
         _info(hdr,quiet=True);
         _visited_logfiles.add(filename);
 #    if _current_logfile:
@@ -747,6 +1600,333 @@ def set_logfile (filename,quiet=False):
 #    else:
 #      _info("log started");
     _current_logfile = filename;
+    if oldlog is not None:
+      oldlog.close();
+
+# forked per-loop jobs write their logs to shards, which are merged into the real log by the parent.
+# This is set to [directory,job_id,title,sequence_number] in jobs, see set_log_shard()
+_log_shard = None;
+_LOG_SHARD_MAGIC = "## PYXIS LOG SHARD\t";
+
+def set_log_shard (directory,job_id,title):
+  """Called in forked jobs: redirects log output to a new shard file in the given directory, until the next call.
+  The title (e.g. "MS=foo.ms") is used when merging the shard into the real log, see merge_log_shards().""";
+  global _log_shard,_current_logobj;
+  seq = _log_shard[3]+1 if _log_shard is not None else 0;
+  _log_shard = [ directory,job_id,title,seq ];
+  # if logging to a file, reopen it as a shard
+  if _current_logfile is not None and isinstance(_current_logobj,_LogSink):
+    oldlog = _current_logobj;
+    _current_logobj = sys.stdout = sys.stderr = _open_log_shard(_current_logfile);
+    oldlog.close();
+
+def _open_log_shard (filename):
+  """Helper function: opens the next shard for the given logfile, and returns its _LogSink""";
+  directory,job_id,title,seq = _log_shard;
+  _log_shard[3] += 1;
+  sink = _LogSink(os.path.join(directory,"job%04d-%06d.log"%(job_id,seq)),"w");
+  # header is JSON, since the path and title may contain anything
+  sink.write(_LOG_SHARD_MAGIC+json.dumps(dict(logfile=filename,job_id=job_id,title=title,
+                                              started=time.strftime("%Y/%m/%d %H:%M:%S")))+"\n");
+  return sink;
+
+def merge_log_shards (directory,job_id=None):
+  """Merges log shards (written by forked jobs, see set_log_shard()) into the logfiles they were meant for,
+  as one block per shard, and deletes them. If job_id is given, only merges shards of that job.""";
+  pattern = "job*.log" if job_id is None else "job%04d-*.log"%job_id;
+  for shard in sorted(glob.glob(os.path.join(directory,pattern))):
+    try:
+      with open(shard,errors="replace") as ff:
+        header = ff.readline();
+        if not header.startswith(_LOG_SHARD_MAGIC):
+          continue;
+        header = json.loads(header[len(_LOG_SHARD_MAGIC):]);
+        filename,jobid,title,started = header['logfile'],header['job_id'],header['title'],header['started'];
+        text = ff.read();
+      ended = time.strftime("%Y/%m/%d %H:%M:%S",time.localtime(os.path.getmtime(shard)));
+      os.unlink(shard);
+    except (IOError,OSError,ValueError,KeyError) as exc:
+      _warn("error reading log shard %s: %s"%(shard,exc));
+      continue;
+    if not text:
+      continue;
+    if text[-1] != "\n":
+      text += "\n";
+    text = "==== job #%s, %s: output from %s to %s ====\n%s==== end of job #%s, %s ====\n"%(
+              jobid,title,started,ended,text,jobid,title);
+    # write through the current log, if that is where this goes, to keep the ordering
+    if filename == _current_logfile and _current_logobj is not None:
+      _current_logobj.write(text);
+    else:
+      try:
+        with open(filename,"a") as ff:
+          ff.write(text);
+      except (IOError,OSError) as exc:
+        _warn("error merging log shard %s into %s: %s"%(shard,filename,exc));
+
+# structured event log, see PYXIS_EVENTS. Open file descriptor and name of the events file
+_events_fd = None;
+_events_file = None;
+
+def _events_target ():
+  """Helper function: returns name of events file, or None if events are not being recorded""";
+  return Pyxis.Context.get("PYXIS_EVENTS") or os.environ.get("PYXIS_EVENTS") or None;
+
+def _emit_event (event,**fields):
+  """Appends an event record to the PYXIS_EVENTS file, if one is set""";
+  global _events_fd,_events_file;
+  filename = _events_target();
+  if not filename:
+    return;
+  filename = str(filename);
+  try:
+    if filename != _events_file:
+      if _events_fd is not None:
+        os.close(_events_fd);
+        _events_fd = None;
+      _events_file = filename;
+      _events_fd = os.open(filename,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o666);
+    record = dict(event=event,t=time.monotonic(),time=time.time(),pid=os.getpid(),
+                  job=Pyxis.Commands._subprocess_id);
+    record.update(fields);
+    # each record is written in one go, so that records from forked jobs don't get mixed up
+    os.write(_events_fd,(json.dumps(record,default=str)+"\n").encode("utf-8"));
+  except (IOError,OSError) as exc:
+    _warn("error writing event to %s: %s"%(filename,exc));
+
+class _EventSpan (object):
+  """Context manager that emits EVENT.start and EVENT.end events around a block. The end event carries the
+  elapsed (monotonic) time and a status of "ok", "exit N" or the exception name. Use update() to add fields
+  to the end event.""";
+  __slots__ = ("event","fields","end_fields","t0");
+
+  def __init__ (self,event,fields):
+    self.event,self.fields,self.end_fields = event,fields,{};
+
+  def update (self,**fields):
+    self.end_fields.update(fields);
+
+  def __enter__ (self):
+    _emit_event(self.event+".start",**self.fields);
+    self.t0 = time.monotonic();
+    return self;
+
+  def __exit__ (self,exctype,exc,tb):
+    fields = dict(self.fields,elapsed=time.monotonic()-self.t0);
+    if exctype is None:
+      fields['status'] = "ok";
+    elif issubclass(exctype,SystemExit):
+      fields['status'] = "exit %s"%(exc.code,);
+    else:
+      fields['status'] = exctype.__name__;
+    fields.update(self.end_fields);
+    _emit_event(self.event+".end",**fields);
+    return False;
+
+class _NoEventSpan (object):
+  """Stands in for an _EventSpan when events are not being recorded""";
+  def update (self,**fields):
+    pass;
+  def __enter__ (self):
+    return self;
+  def __exit__ (self,exctype,exc,tb):
+    return False;
+
+_no_event_span = _NoEventSpan();
+
+def _event_span (event,**fields):
+  """Returns a context manager that records EVENT.start and EVENT.end events around a block, see PYXIS_EVENTS""";
+  return _EventSpan(event,fields) if _events_target() else _no_event_span;
+
+# dry-run plan being recorded (see enable_plan()), or None
+_plan = None;
+
+def _load_plan_history (filename):
+  """Helper function: reads the durations of past external commands from a PYXIS_EVENTS file.
+  Returns two dicts: argv -> list of durations, and tool name -> list of durations.""";
+  by_argv,by_tool = {},{};
+  if not filename or not os.path.exists(str(filename)):
+    return by_argv,by_tool;
+  try:
+    with open(str(filename)) as f:
+      for line in f:
+        try:
+          record = json.loads(line);
+        except ValueError:
+          continue;
+        if record.get("event") in ("exec.end","sh.end","exec.exit") and record.get("elapsed") is not None:
+          argv = record.get("argv") or [];
+          by_argv.setdefault(tuple(argv),[]).append(record["elapsed"]);
+          tool = record.get("tool") or (argv and os.path.basename(argv[0]));
+          tool and by_tool.setdefault(tool,[]).append(record["elapsed"]);
+  except (IOError,OSError) as exc:
+    _warn("error reading timing history from %s: %s"%(filename,exc));
+  return by_argv,by_tool;
+
+class _Plan (object):
+  """Records what a dry run of a recipe would do, see enable_plan(). The plan is a list of steps, each step
+  being a dict with a 'type' of "exec" (an external command: argv, tool, bg, cached, est), "write" (a table
+  opened for writing), or "per" (a per-loop: var, parallel, and values, a list of dicts of value, steps and
+  an optional error).""";
+  def __init__ (self,json_file=None):
+    self.steps = [];
+    self.stack = [ self.steps ];
+    self.history = _load_plan_history(_events_target());
+    self.json_file = json_file;
+    # set if the dry run has ended with an error
+    self.error = None;
+
+  def estimate (self,argv,tool):
+    """Returns estimated duration of a command from the timing history (same command, failing that same tool),
+    or None if the command has not been seen before.""";
+    times = self.history[0].get(tuple(argv)) or self.history[1].get(tool);
+    return sum(times)/len(times) if times else None;
+
+  def record (self,kind,**fields):
+    step = dict(type=kind,**fields);
+    if kind == "exec":
+      step.setdefault("tool",os.path.basename(step["argv"][0]));
+      step["est"] = 0 if step.get("cached") else self.estimate(step["argv"],step["tool"]);
+    self.stack[-1].append(step);
+    return step;
+
+  def value (self,node,value):
+    """Returns a context manager for recording one iteration of the per-loop given by node""";
+    return _PlanValue(self,node,value);
+
+class _PlanValue (object):
+  """Context manager for recording one iteration of a per-loop into the plan. Errors raised by the iteration
+  (e.g. by a recipe relying on the output of a command that wasn't run) are noted in the plan, and the dry run
+  carries on with the next value.""";
+  def __init__ (self,plan,node,value):
+    self.plan,self.entry = plan,dict(value=value,steps=[]);
+    node["values"].append(self.entry);
+
+  def __enter__ (self):
+    self.plan.stack.append(self.entry["steps"]);
+    return self;
+
+  def __exit__ (self,exctype,exc,tb):
+    self.plan.stack.pop();
+    if exctype is not None and not issubclass(exctype,KeyboardInterrupt):
+      self.entry["error"] = "%s: %s"%(exctype.__name__,exc);
+      _warn("dry run: error for value %s (%s), carrying on"%(self.entry["value"],self.entry["error"]));
+      return True;
+    return False;
+
+def enable_plan (enable=True,report_at_exit=False,json_file=None):
+  """Enables (or disables) dry-run mode. In this mode, external commands are not run but recorded into a plan,
+  tables are opened read-only, and per-loops run serially (but are planned as parallel, where applicable).
+  If report_at_exit is True, the plan and an estimate of its wall time (based on timings recorded in the
+  PYXIS_EVENTS file, if any) is printed when Pyxis exits, and written as a DAG to json_file, if given.""";
+  global _plan;
+  _plan = _Plan(json_file) if enable else None;
+  if enable and report_at_exit:
+    atexit.unregister(_report_plan_at_exit);
+    atexit.register(_report_plan_at_exit);
+
+def _plan_cost (steps,jobs,stagger,nested=False):
+  """Helper function: estimates wall time of a list of plan steps, given JOBS and JOB_STAGGER.
+  Returns tuple of estimated time and number of commands with unknown duration.""";
+  total,unknown = 0.,0;
+  for step in steps:
+    if step["type"] == "exec" and not step.get("bg"):
+      if step["est"] is None:
+        unknown += 1;
+      else:
+        total += step["est"];
+    elif step["type"] == "per":
+      # parallel loops run up to 'jobs' forked subprocesses at a time, one per value, with staggered starts.
+      # Loops nested inside these run serially.
+      parallel = step["parallel"] and not nested and jobs > 1 and len(step["values"]) > 1;
+      costs = [];
+      for entry in step["values"]:
+        cost,nunk = _plan_cost(entry["steps"],jobs,stagger,nested=nested or parallel);
+        costs.append(cost);
+        unknown += nunk;
+      if parallel:
+        workers = [ i*stagger for i in range(min(jobs,len(costs))) ];
+        heapq.heapify(workers);
+        for cost in costs:
+          heapq.heappush(workers,heapq.heappop(workers)+cost);
+        total += max(workers);
+      else:
+        total += sum(costs);
+  return total,unknown;
+
+def _format_duration (secs):
+  if secs < 60:
+    return "%.1fs"%secs;
+  secs = int(round(secs));
+  return "%dh%02dm%02ds"%(secs//3600,(secs%3600)//60,secs%60) if secs >= 3600 else "%dm%02ds"%(secs//60,secs%60);
+
+def plan_report ():
+  """Returns the dry-run plan (see enable_plan()) as text, with estimated wall time for various values of JOBS""";
+  if _plan is None:
+    return "dry-run mode is not enabled";
+  lines = [];
+  def describe (steps,indent):
+    for step in steps:
+      if step["type"] == "exec":
+        est = "?" if step["est"] is None else ("cached" if step.get("cached") else _format_duration(step["est"]));
+        lines.append("%s%s%s  [%s]"%(indent,"(bg) " if step.get("bg") else ""," ".join(step["argv"]),est));
+      elif step["type"] == "write":
+        lines.append("%swrite table %s"%(indent,step["table"]));
+      elif step["type"] == "per":
+        lines.append("%s%s %s: %d values"%(indent,"pper" if step["parallel"] else "per",step["var"],len(step["values"])));
+        for entry in step["values"]:
+          lines.append("%s  %s=%s:%s"%(indent,step["var"],entry["value"],"  ERROR "+entry["error"] if "error" in entry else ""));
+          describe(entry["steps"],indent+"    ");
+  lines.append("Dry-run plan:");
+  describe(_plan.steps,"  ");
+  if _plan.error:
+    lines.append("  (dry run ended prematurely: %s)"%_plan.error);
+  jobs0 = Pyxis.Context.get("JOBS",0) or 1;
+  stagger = Pyxis.Context.get("JOB_STAGGER",0) or 0;
+  # with adaptive staggering, assume the minimum delay
+  if str(stagger).lower() == "auto":
+    stagger = float(Pyxis.Context.get("JOB_STAGGER_MIN",1));
+  for jobs in sorted(set([1,2,4,8,16,jobs0])):
+    cost,unknown = _plan_cost(_plan.steps,jobs,stagger);
+    lines.append("Estimated wall time with JOBS=%d, JOB_STAGGER=%s: %s%s"%(jobs,stagger,_format_duration(cost),
+        "  <-- current setting" if jobs == jobs0 else ""));
+  if unknown:
+    lines.append("(%d command(s) have no timing history in PYXIS_EVENTS, and are counted as taking no time)"%unknown);
+  return "\n".join(lines);
+
+def plan_dag ():
+  """Returns the dry-run plan as a DAG: a list of nodes (dicts), where each node's 'deps' gives the ids of the
+  nodes it must wait for. Iterations of parallel per-loops are independent branches.""";
+  nodes = [];
+  def walk (steps,deps,context):
+    for step in steps:
+      if step["type"] == "per":
+        ends = [];
+        for entry in step["values"]:
+          ends += walk(entry["steps"],deps,dict(context,**{step["var"]:entry["value"]}));
+          if not step["parallel"]:
+            deps = ends;
+            ends = [];
+        deps = ends or deps;
+      else:
+        node = dict(step,id=len(nodes),deps=list(deps),context=context);
+        nodes.append(node);
+        deps = [ node["id"] ];
+    return deps;
+  walk(_plan.steps if _plan else [],[],{});
+  return nodes;
+
+def _report_plan_at_exit ():
+  if _plan is None or Pyxis.Commands._subprocess_id is not None:
+    return;
+  sys.__stdout__.write(plan_report()+"\n");
+  if _plan.json_file:
+    try:
+      with open(_plan.json_file,"w") as f:
+        json.dump(dict(nodes=plan_dag(),jobs=Pyxis.Context.get("JOBS",0),stagger=Pyxis.Context.get("JOB_STAGGER",0)),
+                  f,indent=1,default=str);
+    except (IOError,OSError) as exc:
+      _warn("error writing plan to %s: %s"%(_plan.json_file,exc));
 
 _initconf_done = False;  
 _config_files = [];
@@ -849,6 +2029,9 @@ def register_superglobal (frame,sym):
       return;
     _verbose(2,"defining superglobal %s in module '%s'"%(sym,modname));
     _sgs.add(sym);
+    if globs is not Pyxis.Context:
+      _index_superglobal(globs,sym);
+    _template_graph.invalidate();
   else:
     _verbose(3,"'%s' is not a registered module, ignoring superglobal '%s'"%(modname,sym));
   
@@ -875,24 +2058,673 @@ def report_symbols (pkgname,superglobs,syms):
     if temps:
       _verbose(2,"%s templates for:"%pkgname," ".join(temps));
     
+# results of find_exec(), as a dict of PATH -> (time of last check, mtimes of PATH directories, dict of cmd -> result)
+_exec_cache = {};
+# PATH directories are re-checked for modifications at most this often (in seconds)
+EXEC_CACHE_TTL = 1.0;
+
+def _path_mtimes (dirs):
+  """Helper function: returns tuple of modification times of the given directories (None for missing ones)""";
+  mtimes = [];
+  for path in dirs:
+    try:
+      mtimes.append(os.stat(path or ".").st_mtime);
+    except OSError:
+      mtimes.append(None);
+  return tuple(mtimes);
+
 def find_exec (cmd):
-  """Finds shell executable in PATH"""
-  for path in os.environ["PATH"].split(":"):
+  """Finds shell executable in PATH. Results are cached per value of PATH, and discarded when any directory in
+  PATH is modified (i.e. when executables are added or removed)."""
+  pathvar = os.environ.get("PATH","");
+  dirs = pathvar.split(":");
+  now = time.time();
+  checked,mtimes,results = _exec_cache.get(pathvar,(None,None,None));
+  if checked is None or now - checked > EXEC_CACHE_TTL:
+    newmtimes = _path_mtimes(dirs);
+    if newmtimes != mtimes:
+      results = {};
+    _exec_cache[pathvar] = now,newmtimes,results;
+  if cmd in results:
+    return results[cmd];
+  for path in dirs:
     filename = os.path.join(path,cmd);
     if os.access(filename,os.X_OK):
-      return filename;
-  return None;
-  
-_bg_processes = [];  
+      break;
+  else:
+    filename = None;
+  results[cmd] = filename;
+  return filename;
   
+# The jobserver hands out job slots to parallel per-loops (including nested ones) and to multithreaded tools, so
+# that all processes of a run stay within JOBS between them. It follows the GNU make protocol: a pipe holds one
+# token (byte) per free slot, while each process implicitly owns one slot. It is passed on to child processes via
+# MAKEFLAGS, so Pyxis run from 'make -jN' joins make's jobserver, and make run from Pyxis joins ours.
+# Set to a tuple of (read fd,write fd,total number of slots), or None if no jobserver is active.
+_jobserver = None;
+# True if this process created the jobserver
+_jobserver_owner = False;
+# MAKEFLAGS in effect before we started a jobserver
+_jobserver_makeflags = None;
+# per-loops sharing a jobserver record their number of pending values and running jobs in files in this directory
+# (named by pid), so that job_threads() knows when it may claim extra slots. It is passed on to child processes
+# via the environment.
+_JOBSERVER_LOOPS_VAR = "PYXIS_JOBSERVER_LOOPS";
+
+_re_jobserver_auth = re.compile(r"--jobserver-(?:auth|fds)=(?:(\d+),(\d+)|fifo:(\S+))");
+_re_make_jobs = re.compile(r"(?:^|\s)-j\s*(\d+)");
+
+def _jobserver_from_env ():
+  """Helper function: returns jobserver given by MAKEFLAGS in the environment, or None""";
+  makeflags = os.environ.get("MAKEFLAGS","");
+  match = _re_jobserver_auth.search(makeflags);
+  if not match:
+    return None;
+  try:
+    if match.group(3):
+      rfd = os.open(match.group(3),os.O_RDWR);
+      wfd = rfd;
+    else:
+      rfd,wfd = int(match.group(1)),int(match.group(2));
+      os.fstat(rfd),os.fstat(wfd);
+  except (OSError,ValueError):
+    return None;   # fds were not passed on to us, so ignore
+  njobs = _re_make_jobs.search(makeflags);
+  return rfd,wfd,int(njobs.group(1)) if njobs else (os.cpu_count() or 1);
+
+def _jobserver_start (jobs):
+  """Helper function: starts a jobserver with the given number of slots, unless one is already active (or given in
+  the environment). Returns True if one was started.""";
+  global _jobserver,_jobserver_owner,_jobserver_makeflags;
+  if _jobserver is None:
+    _jobserver = _jobserver_from_env();
+  if _jobserver is not None:
+    return False;
+  rfd,wfd = os.pipe();
+  os.write(wfd,b"+"*(jobs-1));
+  _jobserver,_jobserver_owner = (rfd,wfd,jobs),True;
+  _jobserver_makeflags = os.environ.get("MAKEFLAGS");
+  os.environ["MAKEFLAGS"] = " -j%d --jobserver-fds=%d,%d --jobserver-auth=%d,%d"%(jobs,rfd,wfd,rfd,wfd);
+  os.environ[_JOBSERVER_LOOPS_VAR] = tempfile.mkdtemp(prefix="pyxis-jobserver-");
+  _verbose(2,"started jobserver with %d slots"%jobs);
+  return True;
+
+def _jobserver_stop ():
+  """Helper function: shuts down a jobserver started by _jobserver_start()""";
+  global _jobserver,_jobserver_owner;
+  if _jobserver is not None and _jobserver_owner:
+    os.close(_jobserver[0]);
+    os.close(_jobserver[1]);
+    if _jobserver_makeflags is None:
+      os.environ.pop("MAKEFLAGS",None);
+    else:
+      os.environ["MAKEFLAGS"] = _jobserver_makeflags;
+    shutil.rmtree(os.environ.pop(_JOBSERVER_LOOPS_VAR,None) or "",ignore_errors=True);
+    _jobserver,_jobserver_owner = None,False;
+
+def _jobserver_pass_fds ():
+  """Helper function: returns fds of the jobserver, to be passed on to external commands""";
+  return tuple(set(_jobserver[:2])) if _jobserver is not None else ();
+
+def jobserver_acquire ():
+  """Takes a free slot (token) from the jobserver, without blocking. Returns the token, or None if no slot is free,
+  or there's no jobserver.""";
+  if _jobserver is None:
+    return None;
+  # reading from a non-blocking duplicate of the pipe leaves the shared pipe itself blocking, as make expects
+  try:
+    fd = os.open("/proc/self/fd/%d"%_jobserver[0],os.O_RDONLY|os.O_NONBLOCK);
+  except OSError:
+    fd = None;
+  try:
+    if fd is None and not select.select([_jobserver[0]],[],[],0)[0]:
+      return None;
+    token = os.read(_jobserver[0] if fd is None else fd,1);
+    return token or None;
+  except (BlockingIOError,InterruptedError):
+    return None;
+  finally:
+    fd is None or os.close(fd);
+
+def jobserver_release (token):
+  """Returns a token taken by jobserver_acquire() to the jobserver""";
+  if token and _jobserver is not None:
+    os.write(_jobserver[1],token);
+
+def _jobserver_loop_state (pending,running):
+  """Helper function: records the number of pending values and running jobs of the per-loop run by this process,
+  for job_threads(). If pending is None, the record is removed.""";
+  dirname = os.environ.get(_JOBSERVER_LOOPS_VAR);
+  if not dirname or _jobserver is None:
+    return;
+  filename = os.path.join(dirname,str(os.getpid()));
+  try:
+    if pending is None:
+      os.unlink(filename);
+    else:
+      # write and rename, so that readers never see a partial record
+      with open(filename+".tmp","w") as f:
+        f.write("%d %d\n"%(pending,running));
+      os.rename(filename+".tmp",filename);
+  except (IOError,OSError):
+    pass;
+
+def _jobserver_loop_totals ():
+  """Helper function: returns the total number of pending values and running jobs of the per-loops sharing the
+  jobserver, or None if these are not known (e.g. if the jobserver is make's).""";
+  dirname = os.environ.get(_JOBSERVER_LOOPS_VAR);
+  if not dirname or not os.path.isdir(dirname):
+    return None;
+  pending = running = 0;
+  for name in os.listdir(dirname):
+    if name.isdigit():
+      try:
+        with open(os.path.join(dirname,name)) as f:
+          npend,nrun = list(map(int,f.read().split()));
+      except (IOError,OSError,ValueError):
+        continue;
+      pending += npend;
+      running += nrun;
+  return pending,running;
+
+class job_threads (object):
+  """Context manager for sizing the thread count of multithreaded tools. Within a per-loop job (or any process
+  sharing a jobserver), claims job slots that are free in addition to the one the job already holds, up to
+  'max' threads in total, and releases them on exit. Each slot is worth CPUs/JOBS threads. E.g.
+
+    with job_threads(NTHREADS) as nthreads:
+      x.wsclean(...,j=nthreads)
+
+  No extra slots are claimed while the per-loops sharing the jobserver still have values waiting, since these
+  need the slots to run at all. If 'max' is None, a job claims no more than its fair share of the slots, given
+  the number of running jobs. If there is no jobserver, nthreads is simply 'max' (which may be None, meaning
+  leave it to the tool).""";
+  def __init__ (self,max=None):
+    # max may come from the command line or a config file as a string
+    self.max = int(max) if max not in (None,"") else None;
+    self.tokens = [];
+
+  def __enter__ (self):
+    if _jobserver is None:
+      return self.max;
+    total = _jobserver[2];
+    per_slot = max((os.cpu_count() or 1)//total,1);
+    # if there's no record of the per-loops (i.e. make's jobserver), assume all slots are in use
+    pending,running = _jobserver_loop_totals() or (0,total);
+    if pending:
+      nclaim = 0;
+    elif self.max is None:
+      nclaim = max(total//max(running,1),1) - 1;
+    else:
+      nclaim = total;
+    nthreads = per_slot;
+    while len(self.tokens) < nclaim and (self.max is None or nthreads < self.max):
+      token = jobserver_acquire();
+      if token is None:
+        break;
+      self.tokens.append(token);
+      nthreads += per_slot;
+    nthreads = nthreads if self.max is None else min(nthreads,self.max);
+    _verbose(2,"claimed %d extra job slot(s), using %d threads"%(len(self.tokens),nthreads));
+    return nthreads;
+
+  def __exit__ (self,exctype,exc,tb):
+    for token in self.tokens:
+      jobserver_release(token);
+    self.tokens = [];
+    return False;
+
+def _proc_io (pid):
+  """Helper function: returns dict of I/O counters from /proc/PID/io, or an empty dict if these are not available""";
+  try:
+    with open("/proc/%d/io"%pid) as f:
+      return dict([ (key.strip(),int(value)) for key,value in [ line.split(":",1) for line in f if ":" in line ] ]);
+  except (IOError,OSError,ValueError):
+    return {};
+
+def _reap_child (po,block=True):
+  """Helper function: waits for a child process to exit (or merely checks, if block=False), reaps it, and sets
+  po.returncode and po.rusage. The latter is a dict of resource usage (CPU, max RSS, context switches, plus I/O from
+  /proc, where available). Returns po.rusage, or None if the process is still running.""";
+  if po.returncode is not None:
+    return getattr(po,'rusage',{});
+  if not hasattr(os,'wait4'):
+    if (po.wait() if block else po.poll()) is None:
+      return None;
+    po.rusage = {};
+    return po.rusage;
+  io = {};
+  try:
+    # wait for the process to exit without reaping it, so that its /proc/PID/io can still be read
+    if hasattr(os,'waitid'):
+      if os.waitid(os.P_PID,po.pid,os.WEXITED|os.WNOWAIT|(0 if block else os.WNOHANG)) is None:
+        return None;
+      io = _proc_io(po.pid);
+    pid,status,ru = os.wait4(po.pid,0 if block else os.WNOHANG);
+    if not pid:
+      return None;
+  except ChildProcessError:
+    # already reaped elsewhere (e.g. by a waitpid(-1) in per()), so no usage is available
+    po.wait();
+    po.rusage = {};
+    return po.rusage;
+  po.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status);
+  # ru_maxrss is in kilobytes on Linux, bytes on macOS
+  po.rusage = dict(utime=ru.ru_utime,stime=ru.ru_stime,maxrss=ru.ru_maxrss*(1 if sys.platform == "darwin" else 1024),
+                   nvcsw=ru.ru_nvcsw,nivcsw=ru.ru_nivcsw);
+  if "read_bytes" in io:
+    po.rusage.update(read_bytes=io["read_bytes"],write_bytes=io.get("write_bytes",0));
+  return po.rusage;
+
+# resource usage of external commands, as dict of tool name -> dict of totals (see _record_exec_stats)
+_exec_stats = {};
+_exec_stats_lock = threading.Lock();
+_EXEC_STATS_SUMS = ("runs","failed","wall","utime","stime","nvcsw","nivcsw","read_bytes","write_bytes");
+
+def _record_exec_stats (cmdname,po,elapsed):
+  """Helper function: adds resource usage of a finished child process to the per-tool totals. Returns its usage dict.""";
+  usage = getattr(po,'rusage',None) or {};
+  record = dict(usage,runs=1,failed=int(bool(po.returncode)),wall=elapsed);
+  _merge_exec_stats({os.path.basename(cmdname):dict(record,maxrss=usage.get("maxrss",0))});
+  return dict(usage,tool=os.path.basename(cmdname));
+
+def _merge_exec_stats (stats):
+  """Helper function: merges dict of tool -> totals into the per-tool totals""";
+  with _exec_stats_lock:
+    for tool,record in stats.items():
+      totals = _exec_stats.setdefault(tool,dict(maxrss=0));
+      for key in _EXEC_STATS_SUMS:
+        if record.get(key) is not None:
+          totals[key] = totals.get(key,0) + record[key];
+      totals["maxrss"] = max(totals["maxrss"],record.get("maxrss") or 0);
+
+def _save_exec_stats (filename):
+  """Helper function: appends the per-tool totals to a file as one JSON line. Used by subprocesses of per() loops
+  to pass their totals on to the parent. The totals are then cleared, so that a job which is itself running
+  a nested per-loop does not pass them on twice.""";
+  with _exec_stats_lock:
+    if not _exec_stats:
+      return;
+    data = (json.dumps(_exec_stats)+"\n").encode("utf-8");
+    _exec_stats.clear();
+  fd = os.open(filename,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o600);
+  try:
+    os.write(fd,data);
+  finally:
+    os.close(fd);
+
+def _load_exec_stats (filename):
+  """Helper function: merges per-tool totals saved by _save_exec_stats() into our own""";
+  try:
+    with open(filename) as f:
+      for line in f:
+        line.strip() and _merge_exec_stats(json.loads(line));
+  except (IOError,OSError,ValueError) as exc:
+    _warn("error reading resource usage from %s: %s"%(filename,exc));
+
+def exec_stats_report ():
+  """Returns a text table of resource usage by the external commands run so far (including those run by
+  subprocesses of per() loops), totalled per tool.""";
+  with _exec_stats_lock:
+    stats = [ (tool,dict(totals)) for tool,totals in _exec_stats.items() ];
+  if not stats:
+    return "no external commands were run";
+  MB = float(2**20);
+  format = "  %-24s %6s %6s %10s %10s %10s %10s %12s %10s %10s";
+  lines = [ "Resource usage of external commands:",
+            format%("tool","runs","failed","wall s","user s","sys s","max RSS MB","ctx sw v/i","read MB","write MB") ];
+  for tool,totals in sorted(stats,key=lambda x:-x[1].get("wall",0)):
+    io = lambda key:"%.1f"%(totals[key]/MB) if key in totals else "-";
+    lines.append(format%(tool,totals.get("runs",0),totals.get("failed",0),"%.1f"%totals.get("wall",0),
+        "%.1f"%totals.get("utime",0),"%.1f"%totals.get("stime",0),"%.1f"%(totals["maxrss"]/MB),
+        "%d/%d"%(totals.get("nvcsw",0),totals.get("nivcsw",0)),io("read_bytes"),io("write_bytes")));
+  return "\n".join(lines);
+
+def _report_exec_stats_at_exit ():
+  # subprocesses of per() loops pass their totals on to the parent instead
+  if _exec_stats and Pyxis.Context.get("EXEC_STATS",False) and Pyxis.Commands._subprocess_id is None:
+    _verbose(1,exec_stats_report());
+
+atexit.register(_report_exec_stats_at_exit);
+
+class BackgroundJob (object):
+  """A handle for a shell command launched in the background (e.g. via xz), somewhat like a future.
+  Background commands are run by a pool (see BG_JOBS), so the command may be queued for a while
+  before it actually starts. wait() waits for it to finish and returns its exit code, e.g.:
+
+    job = xz.wsclean(...)
+    ...                         # do something else meanwhile
+    job.wait()
+  """;
+  def __init__ (self,args,cmdname,allow_fail=True,verbose=1):
+    self.args,self.cmdname = args,cmdname;
+    self.allow_fail,self.verbose = allow_fail,verbose;
+    self.po = None;
+    self.returncode = None;
+    self.error = None;
+    self.cancelled = False;
+    self._done = threading.Event();
+
+  @property
+  def pid (self):
+    return self.po and self.po.pid;
+
+  def running (self):
+    """Returns True if the command has been started, and has not finished yet""";
+    return self.po is not None and not self._done.is_set();
+
+  def done (self):
+    """Returns True if the command has finished (or was cancelled)""";
+    return self._done.is_set();
+
+  def cancel (self):
+    """Removes the command from the queue. Returns False if it has already been started.""";
+    with _bg_cond:
+      if self.po is not None or self._done.is_set() or self not in _bg_queue:
+        return False;
+      _bg_queue.remove(self);
+      self.cancelled = True;
+      self._done.set();
+    _verbose(self.verbose,"cancelled background command '%s'"%" ".join(self.args));
+    return True;
+
+  def wait (self,timeout=None):
+    """Waits for the command to finish, and returns its exit code (or None on timeout, or if cancelled).
+    If the command could not be started, raises the error here. If the command was not allowed to fail,
+    and has failed, aborts.""";
+    if not self._done.wait(timeout):
+      return None;
+    if self.error is not None:
+      raise self.error;
+    if self.returncode and not self.allow_fail:
+      _abort("%s returned error code %d"%(self.cmdname,self.returncode));
+    return self.returncode;
+
+  result = wait;
+
+  def __repr__ (self):
+    state = "cancelled" if self.cancelled else "failed to start" if self.error is not None else \
+            ("exit %s"%self.returncode if self.done() else
+            ("running, pid %d"%self.po.pid if self.po else "queued"));
+    return "BackgroundJob: %s (%s)"%(" ".join(self.args),state);
+
+# background jobs waiting to be started, and currently running
+_bg_queue = collections.deque();
+_bg_running = [];
+_bg_cond = threading.Condition();
+_bg_thread = None;
+# interval (in seconds) at which the pool checks on running background commands
+BG_POLL_INTERVAL = 0.1;
+
+def _bg_limit ():
+  """Returns the max number of concurrently running background commands: BG_JOBS if set, else JOBS if >1,
+  else the number of CPUs""";
+  nlim = Pyxis.Context.get("BG_JOBS",0) or 0;
+  if nlim < 1:
+    nlim = Pyxis.Context.get("JOBS",0) or 0;
+    if nlim < 2:
+      nlim = os.cpu_count() or 1;
+  return nlim;
+
+def _bg_submit (job):
+  """Helper function: adds job to the background pool, starting the pool thread if needed. Returns the job.""";
+  global _bg_thread;
+  with _bg_cond:
+    _bg_queue.append(job);
+    if len(_bg_running) >= _bg_limit():
+      _verbose(job.verbose,"queueing '%s' for background execution (%d commands already running)"%
+               (" ".join(job.args),len(_bg_running)));
+    # the thread that launches the processes must stay alive, since their PDEATHSIG is tied to it
+    if _bg_thread is None:
+      _bg_thread = threading.Thread(target=_bg_dispatcher,name="pyxis-bg");
+      _bg_thread.daemon = True;
+      _bg_thread.start();
+    _bg_cond.notify_all();
+  return job;
+
+def _bg_launch (job):
+  """Helper function: starts the process of a background job. Called by the pool thread, with _bg_cond held.""";
+  flush_log();
+  try:
+    job.po = subprocess.Popen(job.args,preexec_fn=_on_parent_exit('SIGTERM'),pass_fds=_jobserver_pass_fds());
+  except Exception as exc:
+    job.error = exc;
+    job._done.set();
+    _warn("failed to start '%s' in background: %s"%(" ".join(job.args),exc));
+    return;
+  job.t0 = time.monotonic();
+  _bg_running.append(job);
+  _emit_event("exec.spawn",argv=job.args,child_pid=job.po.pid);
+  _verbose(job.verbose,"executing '%s' in background: pid %d"%(" ".join(job.args),job.po.pid));
+
+def _bg_dispatcher ():
+  """Body of the pool thread: starts queued jobs while there are free slots, and reaps finished ones""";
+  with _bg_cond:
+    while True:
+      while _bg_queue and len(_bg_running) < _bg_limit():
+        _bg_launch(_bg_queue.popleft());
+      for job in list(_bg_running):
+        if _reap_child(job.po,block=False) is not None:
+          _bg_running.remove(job);
+          job.returncode = job.po.returncode;
+          usage = _record_exec_stats(job.cmdname,job.po,time.monotonic()-job.t0);
+          _emit_event("exec.exit",argv=job.args,child_pid=job.po.pid,returncode=job.returncode,
+                      elapsed=time.monotonic()-job.t0,**usage);
+          if job.returncode:
+            _warn("%s (pid %d) returned error code %d"%(job.cmdname,job.po.pid,job.returncode));
+          else:
+            _verbose(job.verbose+1,"%s (pid %d) succeeded"%(job.cmdname,job.po.pid));
+          job._done.set();
+      # loop again straight away if a slot has freed up, else sleep until there's something to check on
+      if _bg_queue and len(_bg_running) < _bg_limit():
+        continue;
+      _bg_cond.wait(BG_POLL_INTERVAL if _bg_running else None);
+
+def _bg_after_fork_in_child ():
+  """Called in a forked child: background jobs belong to the parent, and the pool thread does not survive the fork""";
+  global _bg_queue,_bg_running,_bg_cond,_bg_thread;
+  _bg_queue = collections.deque();
+  _bg_running = [];
+  _bg_cond = threading.Condition();
+  _bg_thread = None;
+
+def _bg_report_at_exit ():
+  if _bg_queue:
+    _warn("%d queued background command(s) were never started, since Pyxis is exiting"%len(_bg_queue));
+
+atexit.register(_bg_report_at_exit);
+
+def _bg_jobs ():
+  """Returns list of all queued and running background jobs""";
+  with _bg_cond:
+    return list(_bg_running) + list(_bg_queue);
+
+def gather (*jobs,**kw):
+  """Waits for the given background jobs (as returned by xz commands, or lists of these) to finish.
+  Returns a list of their exit codes. If timeout=N is given, waits at most N seconds in total, with
+  the exit code of unfinished jobs being None.""";
+  timeout = kw.pop('timeout',None);
+  if kw:
+    raise TypeError("gather() got unexpected keyword argument(s) %s"%", ".join(kw.keys()));
+  joblist = [];
+  for job in jobs:
+    if isinstance(job,(list,tuple)):
+      joblist += list(job);
+    elif job is not None:
+      joblist.append(job);
+  deadline = timeout is not None and time.time() + timeout;
+  return [ job.wait(None if deadline is False else max(deadline-time.time(),0)) for job in joblist ];
+
+def wait_all (timeout=None):
+  """Waits for all background commands (e.g. those launched via xz) to finish, including queued ones.
+  Returns a list of their exit codes.""";
+  return gather(_bg_jobs(),timeout=timeout);
+
+# files up to this size are fingerprinted by content, larger ones (and directories) by size and mtime
+COMMAND_CACHE_HASH_LIMIT = 256*2**20;
+# content hashes of input files, as dict of (path,size,mtime) -> hash
+_command_cache_hashes = {};
+
+def _command_cache_dir ():
+  return os.path.abspath(os.path.expanduser(str(Pyxis.Context.get("COMMAND_CACHE_DIR","~/.cache/pyxis/commands"))));
+
+def _split_path_list (paths):
+  """Helper function: splits a list of paths given as a string (separated by commas or whitespace) or a list""";
+  if isinstance(paths,str):
+    paths = re.split(r"[,\s]+",paths);
+  return [ str(path) for path in (paths or []) if path ];
+
+def _fingerprint_path (path,hash_files=True):
+  """Helper function: returns a fingerprint of the given file or directory, for use in a cache key. If hash_files
+  is False, files that have not been hashed already are not read, and None is returned for them.""";
+  if not os.path.exists(path):
+    return None;
+  if os.path.isdir(path):
+    entries = [];
+    for root,dirs,files in os.walk(path):
+      dirs.sort();
+      for name in sorted(files):
+        st = os.stat(os.path.join(root,name));
+        entries.append((os.path.relpath(os.path.join(root,name),path),st.st_size,st.st_mtime));
+    return hashlib.sha256(repr(entries).encode("utf-8")).hexdigest();
+  st = os.stat(path);
+  if st.st_size > COMMAND_CACHE_HASH_LIMIT:
+    return st.st_size,st.st_mtime;
+  ident = os.path.abspath(path),st.st_size,st.st_mtime;
+  digest = _command_cache_hashes.get(ident);
+  if digest is None:
+    if not hash_files:
+      return None;
+    sha = hashlib.sha256();
+    with open(path,"rb") as f:
+      for chunk in iter(lambda:f.read(2**20),b""):
+        sha.update(chunk);
+    digest = _command_cache_hashes[ident] = sha.hexdigest();
+  return digest;
+
+def _command_cache_key (argv,inputs,hash_files=True):
+  """Helper function: returns cache key for a command, based on its arguments, the identity of the binary, the current
+  directory, and fingerprints of its inputs. If hash_files is False, returns None rather than read any input files
+  that have not been hashed yet.""";
+  fingerprints = [];
+  for path in inputs:
+    fingerprint = _fingerprint_path(path,hash_files);
+    if fingerprint is None and not hash_files and os.path.isfile(path):
+      return None;
+    fingerprints.append((path,fingerprint));
+  try:
+    st = os.stat(argv[0]);
+    binary = os.path.realpath(argv[0]),st.st_size,st.st_mtime;
+  except OSError:
+    binary = argv[0];
+  key = (list(argv),binary,os.getcwd(),fingerprints);
+  return hashlib.sha256(repr(key).encode("utf-8")).hexdigest();
+
+def _path_size (path):
+  if os.path.isdir(path):
+    return sum([ os.lstat(os.path.join(root,name)).st_size for root,dirs,files in os.walk(path) for name in files ]);
+  return os.lstat(path).st_size;
+
+def _remove_path (path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path);
+  elif os.path.lexists(path):
+    os.unlink(path);
+
+def _copy_path (src,dest):
+  if os.path.isdir(src):
+    shutil.copytree(src,dest,symlinks=True);
+  else:
+    shutil.copy2(src,dest);
+
+def _command_cache_restore (key):
+  """Helper function: restores outputs of a cached command. Returns its metadata dict, or None if not in cache.""";
+  entry = os.path.join(_command_cache_dir(),key);
+  metafile = os.path.join(entry,"meta.json");
+  if not os.path.exists(metafile):
+    return None;
+  try:
+    with open(metafile) as f:
+      meta = json.load(f);
+    for num,path in enumerate(meta["outputs"]):
+      _remove_path(path);
+      _copy_path(os.path.join(entry,"out%d"%num),path);
+    # mark as recently used
+    os.utime(metafile,None);
+  except (IOError,OSError,ValueError,KeyError) as exc:
+    _warn("error restoring cached outputs from %s, will re-run the command: %s"%(entry,exc));
+    return None;
+  return meta;
+
+def _command_cache_store (key,argv,outputs,output):
+  """Helper function: saves copies of the outputs of a command to the cache""";
+  cachedir = _command_cache_dir();
+  tmpdir = None;
+  try:
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir);
+    tmpdir = tempfile.mkdtemp(prefix=".tmp-",dir=cachedir);
+    size = 0;
+    for num,path in enumerate(outputs):
+      if not os.path.exists(path):
+        _warn("declared output %s of %s does not exist, not caching"%(path,argv[0]));
+        return;
+      _copy_path(path,os.path.join(tmpdir,"out%d"%num));
+      size += _path_size(path);
+    with open(os.path.join(tmpdir,"meta.json"),"w") as f:
+      json.dump(dict(argv=argv,outputs=outputs,output=output if isinstance(output,str) else None,
+                     size=size,time=time.time()),f);
+    # the rename is atomic, so concurrent jobs never see a partial entry
+    try:
+      os.rename(tmpdir,os.path.join(cachedir,key));
+      tmpdir = None;
+    except OSError:
+      pass;  # already cached by someone else
+  except (IOError,OSError) as exc:
+    _warn("error caching outputs of %s: %s"%(argv[0],exc));
+  finally:
+    tmpdir and shutil.rmtree(tmpdir,ignore_errors=True);
+  _command_cache_evict();
+
+def _command_cache_evict ():
+  """Helper function: removes least recently used cache entries, until the cache fits into COMMAND_CACHE_SIZE""";
+  cachedir = _command_cache_dir();
+  limit = float(Pyxis.Context.get("COMMAND_CACHE_SIZE",20))*2**30;
+  entries = [];
+  for name in os.listdir(cachedir):
+    metafile = os.path.join(cachedir,name,"meta.json");
+    try:
+      with open(metafile) as f:
+        entries.append((os.stat(metafile).st_mtime,json.load(f).get("size",0),name));
+    except (IOError,OSError,ValueError):
+      continue;
+  total = sum([ size for _,size,_ in entries ]);
+  for _,size,name in sorted(entries):
+    if total <= limit:
+      break;
+    _verbose(2,"evicting %s from command cache"%name);
+    shutil.rmtree(os.path.join(cachedir,name),ignore_errors=True);
+    total -= size;
+
 def _call_exec (path,args,kws1={},**kws):
   """Helper function: calls external program with the given arguments and keywords
-  (each kw dict element is turned into a name=value argument)""";
+  (each kw dict element is turned into a name=value argument).
+
+  If cache=True is given, the result is cached (see COMMAND_CACHE_DIR). The cache key is formed from the
+  arguments, the binary, the current directory, and fingerprints of the files or directories given by
+  cache_inputs (a list, or a string separated by commas or whitespace). Copies of the cache_outputs files or
+  directories are saved with a successful run, and restored in place of re-running the command if the key
+  is found in the cache. Only use this for deterministic commands.""";
   allow_fail = kws.pop('allow_fail',False);
   bg = kws.pop('bg',False);
   verbose = kws.pop('verbose',1);
   get_output = kws.pop('get_output',None);
   quiet = kws.pop('quiet',None);
+  # optional callback, called as line_callback(line,stream) for every line of output
+  line_callback = kws.pop('line_callback',None);
+  cache = kws.pop('cache',False);
+  cache_inputs = _split_path_list(kws.pop('cache_inputs',None));
+  cache_outputs = _split_path_list(kws.pop('cache_outputs',None));
   # default is to split each argument at whitespace, but split_args=False passes them as-is
   split = kws.pop('split_args',True);
   # build list of arguments
@@ -910,46 +2742,56 @@ def _call_exec (path,args,kws1={},**kws):
   cmdname = args[1] if args[0] == "time" or args[0] == "/usr/bin/time" else args[0];
   # run command
   args = [ x for x in args if x ];
+  if _plan is not None:
+    # a dry run doesn't hash input files just to tell if a command is cached, so unless their hashes are already
+    # known, the command is reported as not cached
+    cache_key = cache and _command_cache_key(args,cache_inputs,hash_files=False);
+    _plan.record("exec",argv=args,bg=bool(bg),
+                 cached=bool(cache_key) and os.path.exists(os.path.join(_command_cache_dir(),cache_key)));
+    _verbose(verbose,"dry run: not executing '%s'"%" ".join(args));
+    if bg:
+      job = BackgroundJob(args,cmdname,allow_fail,verbose);
+      job.returncode = 0;
+      job._done.set();
+      return job;
+    return "" if get_output else 0;
+  if cache and bg:
+    _verbose(verbose,"results of background commands are not cached");
+    cache = False;
+  if cache:
+    cache_key = _command_cache_key(args,cache_inputs);
+    meta = _command_cache_restore(cache_key);
+    if meta is not None:
+      _emit_event("exec.cached",argv=args,key=cache_key);
+      _verbose(verbose,"'%s': found in command cache, restored %d output(s)"%(" ".join(args),len(meta["outputs"])));
+      return meta["output"] if get_output else 0;
   flush_log();
   if bg:
-    global _bg_processes;
-    po = subprocess.Popen(args,preexec_fn=_on_parent_exit('SIGTERM'));
-    _bg_processes.append(po);
-    _verbose(verbose,"executing '%s' in background: pid %d"%(" ".join(args),po.pid));
-  else:
+    return _bg_submit(BackgroundJob(args,cmdname,allow_fail,verbose));
+  with _event_span("exec",argv=args) as span:
     _verbose(verbose,"executing '%s':"%(" ".join(args)));
     stdout,stderr = sys.stdout,sys.stderr;
-    if quiet:
-      stdout = stderr = open('/dev/null','wb')
     # if stdout/stderr is not a file (as is the case under ipython notebook, then
     # subprocess.Popen() fails. Therefore, in these cases, or if get_output is true, we
-    # pipe the output into here via communicate()
-    if _ispy2:
-      is_not_std_file = type(stdout) is not file or type(stderr) is not file
-    else:
-      from _io import TextIOWrapper
-      is_not_std_file = type(stdout) is not TextIOWrapper or type(stderr) is not TextIOWrapper
-    if get_output or is_not_std_file:
+    # pipe the output into here, and forward it line by line
+    is_not_std_file = not _is_file_stream(stdout) or not _is_file_stream(stderr);
+    if get_output or line_callback or is_not_std_file:
       stdout = stderr = subprocess.PIPE;
-    if _ispy2:
-      type(stdout) is file and stdout.flush();
-      type(stderr) is file and stderr.flush();
-    else:
-      from _io import TextIOWrapper
-      type(stdout) is TextIOWrapper and stdout.flush();
-      type(stderr) is TextIOWrapper and stderr.flush();
+    elif quiet:
+      stdout = stderr = subprocess.DEVNULL;
+    _is_file_stream(stdout) and stdout.flush();
+    _is_file_stream(stderr) and stderr.flush();
+    t0 = time.monotonic();
     po = subprocess.Popen(args,preexec_fn=_on_parent_exit('SIGTERM'),
-      stdout=stdout,stderr=stderr);
+      stdout=stdout,stderr=stderr,pass_fds=_jobserver_pass_fds());
     if stdout is subprocess.PIPE:
-      output,err_output = po.communicate();
-      if not get_output:
-        sys.stdout.write(output.decode('ascii'));
-        output = None;
-      sys.stderr.write(err_output.decode('ascii'));
+      output = _stream_output(po,forward_stdout=not get_output and not quiet,forward_stderr=not quiet,
+                              capture=get_output,line_callback=line_callback);
     else:
-      po.wait();
+      _reap_child(po);
       output = po.returncode;
-      err_output = None;
+    usage = _record_exec_stats(cmdname,po,time.monotonic()-t0);
+    span.update(returncode=po.returncode,**usage);
     if po.returncode:
       if allow_fail:
         _warn("%s returned error code %d"%(cmdname,po.returncode));
@@ -957,9 +2799,70 @@ def _call_exec (path,args,kws1={},**kws):
         _abort("%s returned error code %d"%(cmdname,po.returncode));
     else:
       _verbose(verbose+1,"%s succeeded"%cmdname);
+      if cache:
+        _command_cache_store(cache_key,args,cache_outputs,output);
     return output;
 
 
+# max number of trailing lines of output returned by commands whose output is captured (e.g. via xr)
+EXEC_OUTPUT_TAIL = 100000;
+# partial lines longer than this (e.g. progress bars without a newline) are forwarded as they are
+_STREAM_MAX_PARTIAL = 65536;
+
+def _stream_output (po,forward_stdout=True,forward_stderr=True,capture=False,line_callback=None,tail=None):
+  """Helper function: reads the piped stdout and/or stderr of a process as output arrives, and waits for it to finish.
+  Each line is forwarded to sys.stdout/sys.stderr (i.e. the log), if asked to, and passed to line_callback(line,stream)
+  (with stream being "stdout" or "stderr"). If capture is True, returns the last 'tail' (default EXEC_OUTPUT_TAIL)
+  lines of stdout as a string, so memory use stays bounded however much a process outputs, else returns None.
+  Output is decoded as UTF-8, with undecodable bytes replaced.""";
+  captured = collections.deque(maxlen=EXEC_OUTPUT_TAIL if tail is None else tail) if capture else None;
+  nlines = [0];
+  selector = selectors.DefaultSelector();
+  for pipe,name,forward in (po.stdout,"stdout",forward_stdout),(po.stderr,"stderr",forward_stderr):
+    if pipe is not None:
+      # data is [stream name, output object or None, decoder, partial line]
+      output = (sys.stdout if name == "stdout" else sys.stderr) if forward else None;
+      selector.register(pipe,selectors.EVENT_READ,[name,output,codecs.getincrementaldecoder("utf-8")("replace"),""]);
+  def emit (name,output,line):
+    output is not None and output.write(line);
+    if line_callback is not None:
+      line_callback(line[:-1] if line.endswith("\n") else line,name);
+    if captured is not None and name == "stdout":
+      captured.append(line);
+      nlines[0] += 1;
+  try:
+    while selector.get_map():
+      for key,events in selector.select():
+        name,output,decoder,partial = data = key.data;
+        chunk = os.read(key.fileobj.fileno(),65536);
+        if chunk:
+          lines = (partial+decoder.decode(chunk)).split("\n");
+          partial = lines.pop();
+          for line in lines:
+            emit(name,output,line+"\n");
+          if len(partial) > _STREAM_MAX_PARTIAL:
+            emit(name,output,partial);
+            partial = "";
+          data[3] = partial;
+        # EOF: flush out any partial line
+        else:
+          selector.unregister(key.fileobj);
+          key.fileobj.close();
+          partial += decoder.decode(b"",final=True);
+          if partial:
+            emit(name,output,partial);
+  finally:
+    # if interrupted (e.g. by an exception in the callback), close remaining pipes so the process can't block on them
+    for key in list(selector.get_map().values()):
+      key.fileobj.close();
+    selector.close();
+    _reap_child(po);
+  if captured is None:
+    return None;
+  if nlines[0] > len(captured):
+    _warn("output of '%s' truncated to its last %d lines"%(po.args[0] if isinstance(po.args,list) else po.args,len(captured)));
+  return "".join(captured);
+
 ## Function to ensure that child processes are killed when Pyxis is killed, see subprocess.Popen calls above
 ## source: http://www.evans.io/posts/killing-child-processes-on-parent-exit-prctl/
 import signal
@@ -1079,56 +2982,58 @@ def run (*commands):
   # _debug("running",commands);
   frame = inspect.currentframe().f_back;
   for step,command in enumerate(commands):
-    # if command is callable, call directly
-    if not callable(command):
-      # interpolate the command
-      command = command.strip();
-      _verbose(1,"running command %s"%command);
-      # syntax 1: VAR=VALUE or VAR+=VALUE
-      match = _re_assign.match(command);
-      if match:
-        name,op,value = match.groups();
-        # assign variable -- note that templates are not interpolated
-        Pyxis.Commands.assign(name,_parse_cmdline_value(value),frame=frame,append=(op=="+="),autoimport=True);
-        continue;
-      # syntax 2: command(args) or command[args]. command can have a "?" prefix to make success optional
-      match = _re_command1.match(command) or _re_command2.match(command);
-      if match:
-        comname,comargs = match.groups();
-        # split up arguments
-        args = [];
-        kws = {};
-        for arg in re.split(",," if comargs.find(",,") >=0 else ",",comargs):
-          arg = interpolate(arg,frame).strip();
-          match = re.match("^(\w+)=(.*)$",arg);
-          if match:
-            kws[match.group(1)] = _parse_cmdline_value(match.group(2));
-          else:
-            args.append(_parse_cmdline_value(arg));
-        # if command is 'help', disable logging
-        logfile = None;
-        if comname == "help":
-#          comname = 'pydoc.render_doc'
-          if _current_logobj:
-            logfile = _current_logfile;
-            set_logfile(None);
+    name = command.strip() if not callable(command) else getattr(command,"__name__",str(command));
+    with _event_span("command",command=name,step=step):
+      # if command is callable, call directly
+      if not callable(command):
+        # interpolate the command
+        command = command.strip();
+        _verbose(1,"running command %s"%command);
+        # syntax 1: VAR=VALUE or VAR+=VALUE
+        match = _re_assign.match(command);
+        if match:
+          name,op,value = match.groups();
+          # assign variable -- note that templates are not interpolated
+          Pyxis.Commands.assign(name,_parse_cmdline_value(value),frame=frame,append=(op=="+="),autoimport=True);
+          continue;
+        # syntax 2: command(args) or command[args]. command can have a "?" prefix to make success optional
+        match = _re_command1.match(command) or _re_command2.match(command);
+        if match:
+          comname,comargs = match.groups();
+          # split up arguments
+          args = [];
+          kws = {};
+          for arg in re.split(",," if comargs.find(",,") >=0 else ",",comargs):
+            arg = interpolate(arg,frame).strip();
+            match = re.match("^(\w+)=(.*)$",arg);
+            if match:
+              kws[match.group(1)] = _parse_cmdline_value(match.group(2));
+            else:
+              args.append(_parse_cmdline_value(arg));
+          # if command is 'help', disable logging
+          logfile = None;
+          if comname == "help":
+  #          comname = 'pydoc.render_doc'
+            if _current_logobj:
+              logfile = _current_logfile;
+              set_logfile(None);
+          _initconf_done or initconf(force=True);  # make sure config is loaded
+          comcall = find_command(comname,inspect.currentframe().f_back,autoimport=True);
+          result = comcall(*args,**kws);
+          assign_templates();
+          if comname == 'pydoc.render_doc':
+            print("help:",result);
+          # reset logging, if disabled for 'help'
+          if logfile:
+            set_logfile(logfile);
+          continue;
+        # syntax 3: standalone command. This better be found!
         _initconf_done or initconf(force=True);  # make sure config is loaded
-        comcall = find_command(comname,inspect.currentframe().f_back,autoimport=True);
-        result = comcall(*args,**kws);
-        assign_templates();
-        if comname == 'pydoc.render_doc':
-          print("help:",result);
-        # reset logging, if disabled for 'help'
-        if logfile:
-          set_logfile(logfile);
-        continue;
-      # syntax 3: standalone command. This better be found!
-      _initconf_done or initconf(force=True);  # make sure config is loaded
-      comcall = find_command(command,inspect.currentframe().f_back);
-    # fall through here if command is callable
-    else:
-      comcall = command;
-      _verbose(1,"running command %s"%command.__name__);
-    comcall();
-    assign_templates();
+        comcall = find_command(command,inspect.currentframe().f_back);
+      # fall through here if command is callable
+      else:
+        comcall = command;
+        _verbose(1,"running command %s"%command.__name__);
+      comcall();
+      assign_templates();
   
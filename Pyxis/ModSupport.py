@@ -1,13 +1,16 @@
 """Pyxis.ModSupport: functions for programming Pyxides modules"""
 
 import fnmatch
+import glob
+import os
+import time
 import inspect, traceback
 
 import Pyxis
 from Pyxis import *
 
 from Pyxis.Commands import _verbose,_warn,_abort,makedir
-from Pyxis.Internals import _superglobals,_namespaces,_modules
+from Pyxis.Internals import _superglobals,_namespaces,_modules,Scope,find_exec,job_threads
 
   
 def register_pyxis_module (superglobals=""):
@@ -35,6 +38,9 @@ def register_pyxis_module (superglobals=""):
   _verbose(1,"registered module '%s'"%modname);
   _namespaces[modname] = globs;
   _superglobals[id(globs)] = superglobs;
+  for sym in superglobs:
+    Pyxis.Internals._index_superglobal(globs,sym);
+  Pyxis.Internals._template_graph.invalidate();
   Pyxis.Context[modname] = module;
   # add superglobals
   for sym in superglobs:
@@ -131,6 +137,302 @@ def document_globals (obj,*patterns):
       text += "  %-20s %s\n"%(sym,doc);
     obj.__doc__ = (obj.__doc__ or "")+ text;
   
+import collections
+import functools
+
+def _freeze_value (value):
+  """Helper function: converts a variable value into something hashable for use as a cache key.
+  Raises TypeError if this is not possible.""";
+  if isinstance(value,(list,tuple)):
+    return type(value),tuple([ _freeze_value(x) for x in value ]);
+  elif isinstance(value,dict):
+    return dict,tuple(sorted([ (key,_freeze_value(x)) for key,x in value.items() ],key=repr));
+  elif isinstance(value,(set,frozenset)):
+    return frozenset(value);
+  hash(value);
+  return value;
+
+def template_inputs (inputs,outputs="",cache=16):
+  """Decorator for callable templates: declares the variables that the template depends on,
+  and any other variables that it sets as a side effect. E.g. in a module:
+
+    @template_inputs("MS DDID",outputs="SPWID TOTAL_CHANNELS")
+    def _msinfo_Template ():
+      global SPWID,TOTAL_CHANNELS
+      ...
+
+  'inputs' and 'outputs' are space-separated lists of [MODULE.]NAME; unqualified names refer to
+  globals of the template's module (or to superglobals). Pyxis will then re-evaluate the template
+  only when one of its inputs has changed, rather than on every assignment. Results (plus the values
+  of the declared outputs) are also cached by the values of the inputs, so switching back to a previous
+  MS, say, does not re-run the template at all. 'cache' is the number of input combinations to remember
+  (least recently used ones are discarded), use 0 to disable caching.
+  """;
+  if isinstance(inputs,str):
+    inputs = inputs.split();
+  if isinstance(outputs,str):
+    outputs = outputs.split();
+  inputs,outputs = list(inputs),list(outputs);
+  def decorator (func):
+    results = collections.OrderedDict();
+    globs = func.__globals__;
+    def lookup (name,default=None):
+      if '.' in name:
+        modname,name = name.rsplit('.',1);
+        return _namespaces.get(modname,{}).get(name,default);
+      return globs[name] if name in globs else Pyxis.Context.get(name,default);
+    @functools.wraps(func)
+    def wrapper (*args,**kw):
+      # explicit calls with arguments are never cached
+      if args or kw or not cache:
+        return func(*args,**kw);
+      try:
+        key = tuple([ _freeze_value(lookup(name)) for name in inputs ]);
+      except TypeError:
+        return func();
+      if key in results:
+        result,outvalues = results.pop(key);
+        results[key] = result,outvalues;
+        _verbose(3,"%s: inputs unchanged, using cached result"%func.__name__);
+        for name,value in outvalues.items():
+          if '.' in name:
+            modname,name = name.rsplit('.',1);
+            _namespaces[modname][name] = value;
+          else:
+            globs[name] = value;
+        return result;
+      result = func();
+      results[key] = result,dict([ (name,lookup(name)) for name in outputs ]);
+      while len(results) > cache:
+        results.popitem(last=False);
+      return result;
+    wrapper._pyxis_template_inputs = inputs;
+    wrapper._pyxis_template_outputs = outputs;
+    wrapper.cache_clear = results.clear;
+    return wrapper;
+  return decorator;
+
+import json
+import hashlib
+import fcntl
+import re
+
+def _build_state_file ():
+  return str(Pyxis.Context.get("BUILD_STATE",".pyxis-build.json"));
+
+def _read_build_state ():
+  """Helper function: reads the state file of incremental builds, returns dict of step key -> record""";
+  filename = _build_state_file();
+  if not os.path.exists(filename):
+    return {};
+  try:
+    with open(filename) as f:
+      fcntl.flock(f,fcntl.LOCK_SH);
+      data = f.read();
+    return json.loads(data) if data.strip() else {};
+  except (IOError,OSError,ValueError) as exc:
+    _warn("error reading %s, ignoring: %s"%(filename,exc));
+    return {};
+
+def _update_build_state (key,record):
+  """Helper function: updates one record in the state file. The file is locked, since subprocesses of per() loops
+  can update it concurrently.""";
+  filename = _build_state_file();
+  try:
+    with open(filename,"a+") as f:
+      fcntl.flock(f,fcntl.LOCK_EX);
+      f.seek(0);
+      data = f.read();
+      try:
+        state = json.loads(data) if data.strip() else {};
+      except ValueError:
+        state = {};
+      state[key] = record;
+      f.seek(0);
+      f.truncate();
+      json.dump(state,f,indent=1,sort_keys=True);
+  except (IOError,OSError) as exc:
+    _warn("error writing %s: %s"%(filename,exc));
+
+def _column_files (msname,column):
+  """Helper function: returns the files holding the given column of an MS, or None if these can't be determined""";
+  try:
+    import pyrap.tables;
+    tab = pyrap.tables.table(msname,ack=False);
+    try:
+      seqnr = tab.getdminfo(column)["SEQNR"];
+    finally:
+      tab.close();
+  except Exception:
+    return None;
+  return glob.glob(os.path.join(msname,"table.f%d*"%seqnr)) or None;
+
+def _newest_mtime (path,column=None):
+  """Helper function: returns the modification time of a file, or the newest one in a directory (or in the
+  files holding a column, if given). Returns None if path does not exist.""";
+  if not os.path.exists(path):
+    return None;
+  if not os.path.isdir(path):
+    return os.path.getmtime(path);
+  files = column and _column_files(path,column);
+  if files:
+    return max([ os.path.getmtime(name) for name in files ]);
+  return max([ os.path.getmtime(path) ] + [ os.path.getmtime(os.path.join(root,name))
+                                           for root,dirs,names in os.walk(path) for name in names ]);
+
+_re_address = re.compile(" at 0x[0-9a-fA-F]+");
+
+def _canonical_repr (value):
+  """Helper function: returns a representation of a value that is the same in every process, for use in a hash.
+  Unlike repr(), this sorts the contents of sets and dicts (since the order of set elements depends on
+  PYTHONHASHSEED), and represents objects with no meaningful repr (i.e. one giving a memory address) by their
+  type.""";
+  if value is None or isinstance(value,(bool,int,float,complex,str,bytes)):
+    return repr(value);
+  if isinstance(value,(list,tuple)):
+    return "%s(%s)"%(type(value).__name__,",".join(map(_canonical_repr,value)));
+  if isinstance(value,(set,frozenset)):
+    return "%s(%s)"%(type(value).__name__,",".join(sorted(map(_canonical_repr,value))));
+  if isinstance(value,dict):
+    return "%s(%s)"%(type(value).__name__,",".join(sorted([ "%s:%s"%(_canonical_repr(key),_canonical_repr(val))
+                                                             for key,val in value.items() ])));
+  text = repr(value);
+  if type(value).__repr__ is object.__repr__ or _re_address.search(text):
+    return "<%s.%s>"%(type(value).__module__,type(value).__qualname__);
+  return text;
+
+def _code_names (code):
+  """Helper function: returns the set of global names used by a code object, including those used by nested
+  code (comprehensions, lambdas, inner functions)""";
+  names = set(code.co_names);
+  for const in code.co_consts:
+    if inspect.iscode(const):
+      names |= _code_names(const);
+  return names;
+
+def _build_params (func,callargs,params,scope):
+  """Helper function: returns a hash of the parameters of a build step. These are the call arguments (string arguments
+  interpolated, so that e.g. niter="$NITER" follows NITER), the values of module globals used by the function body,
+  and the interpolated values of any other variables in 'params'.""";
+  globs = func.__globals__;
+  values = [ ("arg",name,Pyxis.Internals.interpolate(value,scope) if isinstance(value,str) else value)
+             for name,value in sorted(callargs.items()) ];
+  for name in sorted(_code_names(func.__code__)):
+    value = globs.get(name,None);
+    if name in globs and not callable(value) and not inspect.ismodule(value):
+      values.append(("global",name,value));
+  for name in params:
+    values.append(("param",name,Pyxis.Internals.interpolate("$"+name,scope)));
+  return hashlib.sha256(_canonical_repr(values).encode("utf-8")).hexdigest();
+
+def _rebuild_forced (name):
+  """Helper function: checks REBUILD setting for a step of the given name""";
+  rebuild = Pyxis.Context.get("REBUILD",False);
+  if isinstance(rebuild,str):
+    if rebuild.lower() in ("1","true","all","yes"):
+      return True;
+    rebuild = rebuild.replace(","," ").split();
+  if isinstance(rebuild,(list,tuple,set)):
+    return any([ fnmatch.fnmatch(name,patt) or fnmatch.fnmatch(name.split(".")[-1],patt) for patt in rebuild ]);
+  return bool(rebuild);
+
+def _run_build_step (func,spec,args,kw):
+  """Helper function: runs a function decorated with produces()/consumes(), unless its outputs are up to date""";
+  modname = func.__module__;
+  if modname.startswith("Pyxides."):
+    modname = modname.split(".",1)[-1];
+  name = func.__name__ if modname == "__main__" else "%s.%s"%(modname,func.__name__);
+  try:
+    bound = inspect.signature(func).bind(*args,**kw);
+  except TypeError:
+    return func(*args,**kw);
+  bound.apply_defaults();
+  callargs = dict(bound.arguments);
+  Pyxis.Internals.assign_templates(if_changed=True);
+  scope = Scope(callargs,func.__globals__);
+  outputs = [ Pyxis.Internals.interpolate(path,scope) for path in spec['produces'] ];
+  inputs = [ (Pyxis.Internals.interpolate(path,scope),column) for path,column in spec['consumes'] ];
+  params = _build_params(func,callargs,spec['params'],scope);
+  key = "%s:%s"%(name,",".join(outputs));
+  # check if outputs are up to date
+  record = _read_build_state().get(key);
+  out_mtimes = [ _newest_mtime(path) for path in outputs ];
+  in_mtimes = [ _newest_mtime(path,column) for path,column in inputs ];
+  if _rebuild_forced(name):
+    reason = "REBUILD is set";
+  elif record is None:
+    reason = "no record of previous run";
+  elif None in out_mtimes:
+    reason = "output %s does not exist"%outputs[out_mtimes.index(None)];
+  elif None in in_mtimes:
+    reason = "input %s does not exist"%inputs[in_mtimes.index(None)][0];
+  elif in_mtimes and min(out_mtimes) < max(in_mtimes):
+    reason = "inputs are newer than outputs";
+  elif record.get("params") != params:
+    reason = "parameters have changed";
+  else:
+    _verbose(1,"%s: outputs are up to date, skipping (use REBUILD=%s or pyxis --force to re-run)"%(name,func.__name__));
+    return None;
+  _verbose(2,"%s: %s, running"%(name,reason));
+  result = func(*args,**kw);
+  missing = [ path for path in outputs if not os.path.exists(path) ];
+  if Pyxis.Internals._plan is not None:
+    pass;   # a dry run produces nothing, so there's nothing to record
+  elif missing:
+    _warn("%s: declared output(s) %s not produced, not recording this run"%(name,", ".join(missing)));
+  else:
+    _update_build_state(key,dict(params=params,outputs=outputs,inputs=[ path for path,column in inputs ],time=time.time()));
+  return result;
+
+def _build_step (func):
+  """Helper function: wraps function in a build step (unless already wrapped). Returns the wrapper.""";
+  if hasattr(func,'_pyxis_build'):
+    return func;
+  spec = dict(produces=[],consumes=[],params=[]);
+  @functools.wraps(func)
+  def wrapper (*args,**kw):
+    return _run_build_step(func,spec,args,kw);
+  wrapper._pyxis_build = spec;
+  return wrapper;
+
+def produces (*outputs,**kw):
+  """Decorator for Pyxis commands: declares the files or directories produced by the command, for make-style
+  incremental builds. E.g. in a module:
+
+    @produces("$RESTORED_IMAGE","$RESIDUAL_IMAGE",params="npix cellsize")
+    @consumes("$MS",column="CORRECTED_DATA")
+    def make_image (...):
+
+  Names are interpolated when the command is called, using its arguments and the globals of its module.
+  The call is then skipped if all outputs exist and are newer than all inputs (see consumes()), and the
+  command's parameters are unchanged since its last run. The parameters are the call arguments, the module
+  globals used by the function body, and any other [MODULE.]NAME variables listed in 'params'.
+  Set REBUILD=True (or run pyxis --force) to re-run all such commands regardless, or REBUILD="name1 name2"
+  to re-run specific ones. Records of previous runs are kept in BUILD_STATE (default .pyxis-build.json).
+  Note that a skipped command returns None.""";
+  params = kw.pop('params',"");
+  if kw:
+    raise TypeError("produces() got unexpected keyword argument(s) %s"%", ".join(kw.keys()));
+  def decorator (func):
+    wrapper = _build_step(func);
+    wrapper._pyxis_build['produces'] += list(itertools.chain(*[ x.split() for x in outputs ]));
+    wrapper._pyxis_build['params'] += params.split() if isinstance(params,str) else list(params);
+    return wrapper;
+  return decorator;
+
+def consumes (*inputs,**kw):
+  """Decorator for Pyxis commands: declares the files or directories read by the command, see produces().
+  If column is given, the inputs are taken to be MSs, and only the files holding that column are checked
+  for modifications (if pyrap is not available, any modification of the MS counts).""";
+  column = kw.pop('column',None);
+  if kw:
+    raise TypeError("consumes() got unexpected keyword argument(s) %s"%", ".join(kw.keys()));
+  def decorator (func):
+    wrapper = _build_step(func);
+    wrapper._pyxis_build['consumes'] += [ (path,column) for path in itertools.chain(*[ x.split() for x in inputs ]) ];
+    return wrapper;
+  return decorator;
+
 def interpolate_locals (*varnames):
   """interpolates the variable names (from the local context) given by its argument(s).
   Returns new values in the order given. Useful as the opening line of a function, for example:
@@ -142,12 +444,11 @@ def interpolate_locals (*varnames):
   """;
   ## NB: the rationale for implementing it like this, as opposed to directly manipulating f_locals
   ## of the caller frame, is because f_locals of the caller can be read-only depending on Python implementation.
-  Pyxis.Internals.assign_templates();
-  # interpolate the whole locals() dict
+  Pyxis.Internals.assign_templates(if_changed=True);
+  # interpolate only the requested variables (plus whatever they refer to), in the order listed
   frame = inspect.currentframe().f_back;
-  locs = interpolate(frame.f_locals,frame,depth=2);
-  # return variables in the order listed
-  ret = [ locs.get(name) for name in itertools.chain(*[ v.split(" ") for v in varnames ]) ];
+  names = list(itertools.chain(*[ v.split(" ") for v in varnames ]));
+  ret = Pyxis.Internals._interpolate_names(frame.f_locals,names,frame,depth=2);
   return ret if len(ret) != 1 else ret[0];
     
 def kwopt_to_command_line (**kwopt):
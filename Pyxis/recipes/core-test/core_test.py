@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Checks of Pyxis core semantics that don't need any radio astronomy packages. Run with nose (or pytest) in this
+# directory, or as a script.
+
+import os
+import os.path
+import sys
+import shutil
+import subprocess
+import tempfile
+
+# check installation
+try:
+  PYXIS_ROOT_NAMESPACE = True  # must set this before import!
+  import Pyxis
+  import Pyxis.Internals
+  PACKAGE_TEST_DIR = os.path.join(os.path.dirname(Pyxis.__file__), "recipes", "core-test")
+  if not os.path.exists(PACKAGE_TEST_DIR):
+    raise RuntimeError("Installation excludes {}".format(PACKAGE_TEST_DIR))
+except:
+  sys.stderr.write("Broken pyxis installation\n")
+  sys.stderr.write("Exiting with:\n")
+  import traceback
+  sys.stderr.write(traceback.format_exc())
+  sys.exit(1)
+
+from Pyxis.ModSupport import interpolate_locals
+
+I = Pyxis.Internals;
+
+def _reference_interpolate (text,lookups):
+  """Interpolates a string the way Pyxis did before templates were compiled and cached: %(NAME)s substitutions,
+  then a SmartTemplate pass, looking names up in the given list of dicts""";
+  proxy = I.DictProxy(lookups,());
+  return I.SmartTemplate(text%proxy).safe_substitute(proxy);
+
+def testTemplateExpansion():
+  v.MS = "dir/foo.ms";
+  v.EMPTY = "";
+  v.NUM = 3;
+  local = dict(LOCAL="loc");
+  cases = [
+    ("x=$MS",                       "x=dir/foo.ms"),
+    ("%(MS:BASE)s",                 "foo"),
+    ("%(MS:DIR)s/%(MS:FILE)s",      "dir/foo.ms"),
+    ("%(MS:BASEPATH)s",             "dir/foo"),
+    ("%(p<MS>s)s",                  "pdir/foo.mss"),
+    ("%(EMPTY?default)s",           "default"),
+    ("%(EMPTY)s-%(-<EMPTY)s",       "-"),
+    ("%(v.MS:BASE)s",               "foo"),
+    ("$NUM$MS",                     "3dir/foo.ms"),
+    ("$LOCAL/$UNDEFINED",           "loc/"),
+    ("$$MS $ 100%%",                "$MS $ 100%"),
+    ("x=${MS}.img",                 "x=${MS}.img"),
+    ("${MS:BASE}",                  "${MS:BASE}"),
+    ("no references",               "no references"),
+  ];
+  for text,expected in cases:
+    # twice, to check the compiled template cache
+    for i in range(2):
+      result = I.interpolate(text,local);
+      if result != expected:
+        raise RuntimeError("interpolate(%r) gives %r, expected %r"%(text,result,expected));
+    reference = _reference_interpolate(text,[local,Pyxis.Context]);
+    if result != reference:
+      raise RuntimeError("interpolate(%r) gives %r, uncompiled template gives %r"%(text,result,reference));
+  # cached templates must pick up new values
+  v.MS = "bar.ms";
+  if I.interpolate("%(MS:BASE)s",local) != "bar":
+    raise RuntimeError("compiled template did not pick up new value of MS");
+  print("template expansion ok");
+
+def testTemplateReevaluation():
+  v.MS = "dir/foo.ms";
+  v.OUTDIR = "out";
+  v.OUTFILE_Template = "%(OUTDIR>/)s%(MS:BASE)s%(_s<STEP)s";
+  v.IMAGE_Template = "$OUTFILE.img";
+  v.OTHER_Template = "other-$DDID";
+  def check (**expected):
+    for name,value in expected.items():
+      if getattr(v,name) != value:
+        raise RuntimeError("%s=%r, expected %r"%(name,getattr(v,name),value));
+      # a full evaluation of the template must agree
+      full = I.interpolate(Pyxis.Context[name+"_Template"],Pyxis.Context);
+      if full != value:
+        raise RuntimeError("%s=%r, but the template evaluates to %r"%(name,value,full));
+  check(OUTFILE="out/foo",IMAGE="out/foo.img",OTHER="other-");
+  v.STEP = 2;
+  check(OUTFILE="out/foo_s2",IMAGE="out/foo_s2.img",OTHER="other-");
+  v.MS = "a.ms";
+  check(OUTFILE="out/a_s2",IMAGE="out/a_s2.img",OTHER="other-");
+  v.DDID = 1;
+  check(OUTFILE="out/a_s2",IMAGE="out/a_s2.img",OTHER="other-1");
+  print("template re-evaluation ok");
+
+def testInterpolateLocals():
+  v.MS = "dir/foo.ms";
+  def func (a="$MS",b="$a.1",c="$b/$MS",d=3,e="%(a:BASE)s.x",f="$e-$d",**kw):
+    frame = sys._getframe();
+    # interpolate_locals() used to interpolate the whole locals() dict (in place of which Python 3.13+ gives a proxy)
+    locs = frame.f_locals;
+    reference = I.interpolate(locs if isinstance(locs,dict) else dict(locs),frame,depth=2);
+    values = interpolate_locals("a b c d e f");
+    return values,[ reference[name] for name in "abcdef" ];
+  values,reference = func(extra="$MS");
+  if values != reference or values[:4] != ["dir/foo.ms","dir/foo.ms.1","dir/foo.ms.1/dir/foo.ms",3]:
+    raise RuntimeError("interpolate_locals() gives %r, expected %r"%(values,reference));
+  print("interpolate_locals ok");
+
+def _run_pyxis (workdir,*args,**env):
+  """Runs pyxis with the core-test recipe in the given directory, returns its exit code""";
+  pyxis = shutil.which("pyxis") or os.path.join(os.path.dirname(Pyxis.__file__),"bin","pyxis");
+  environ = dict(os.environ);
+  environ["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(Pyxis.__file__))]+
+                                           [ x for x in environ.get("PYTHONPATH","").split(os.pathsep) if x ]);
+  environ.update(env);
+  cmd = [sys.executable,pyxis,"-f","JOB_STAGGER=0"] + list(args);
+  print("========== $"," ".join(cmd));
+  return subprocess.call(cmd,cwd=workdir,env=environ,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL);
+
+def _workdir ():
+  workdir = tempfile.mkdtemp(prefix="pyxis-core-test-");
+  shutil.copy(os.path.join(PACKAGE_TEST_DIR,"pyxis-core.py"),workdir);
+  return workdir;
+
+def _run_counts (workdir,*names):
+  counts = [];
+  for name in names:
+    filename = os.path.join(workdir,"ran-%s"%name);
+    counts.append(len(open(filename).readlines()) if os.path.exists(filename) else 0);
+  return counts;
+
+def testPerLedgerResume():
+  for command,jobs in ("loop",1),("ploop",2):
+    workdir = _workdir();
+    try:
+      # first run fails at V=2, but carries on with V=3
+      if not _run_pyxis(workdir,"PER_LEDGER=ledger.txt","PERSIST=1","FAIL=2","JOBS=%d"%jobs,command):
+        raise RuntimeError("%s: per-loop with a failing value did not fail"%command);
+      if _run_counts(workdir,1,2,3) != [1,1,1]:
+        raise RuntimeError("%s: first run gave counts %s"%(command,_run_counts(workdir,1,2,3)));
+      # second run only needs to redo V=2
+      if _run_pyxis(workdir,"PER_LEDGER=ledger.txt","JOBS=%d"%jobs,command):
+        raise RuntimeError("%s: resumed per-loop failed"%command);
+      if _run_counts(workdir,1,2,3) != [1,2,1]:
+        raise RuntimeError("%s: resumed run gave counts %s"%(command,_run_counts(workdir,1,2,3)));
+    finally:
+      shutil.rmtree(workdir,ignore_errors=True);
+  # PER_LEDGER=1 (as given on the command line) means a ledger next to the log, not a ledger file called "1"
+  workdir = _workdir();
+  try:
+    for runs in 1,1:
+      if _run_pyxis(workdir,"PER_LEDGER=1","LOG=core.log","loop"):
+        raise RuntimeError("per-loop with PER_LEDGER=1 failed");
+      if _run_counts(workdir,1,2,3) != [runs]*3:
+        raise RuntimeError("PER_LEDGER=1: run gave counts %s"%_run_counts(workdir,1,2,3));
+    if os.path.exists(os.path.join(workdir,"1")) or not os.path.exists(os.path.join(workdir,"core.ledger")):
+      raise RuntimeError("PER_LEDGER=1: ledger was not kept next to the log");
+  finally:
+    shutil.rmtree(workdir,ignore_errors=True);
+  print("per-loop ledger ok");
+
+def testBuildStepSkip():
+  workdir = _workdir();
+  try:
+    # runs in processes with different string hashing must agree on the parameters, so the second one is skipped
+    for seed,runs in ("1",1),("2",1),("3",1):
+      if _run_pyxis(workdir,"build",PYTHONHASHSEED=seed):
+        raise RuntimeError("build step failed");
+      if _run_counts(workdir,"build") != [runs]:
+        raise RuntimeError("build step ran %d times, expected %d"%(_run_counts(workdir,"build")[0],runs));
+    # changing a global used by the step (only inside a comprehension) must re-run it
+    if _run_pyxis(workdir,"NITER=2","build"):
+      raise RuntimeError("build step failed");
+    if _run_counts(workdir,"build") != [2]:
+      raise RuntimeError("build step was not re-run after a parameter changed");
+    # changing a variable that is only reached through an interpolated default argument must re-run a step, too
+    for steps,runs in ("10",1),("10",1),("20",2):
+      if _run_pyxis(workdir,"STEPS=%s"%steps,"build2"):
+        raise RuntimeError("build step failed");
+      if _run_counts(workdir,"build2") != [runs]:
+        raise RuntimeError("build step with STEPS=%s ran %d times, expected %d"%(steps,_run_counts(workdir,"build2")[0],runs));
+  finally:
+    shutil.rmtree(workdir,ignore_errors=True);
+  print("build step skipping ok");
+
+if __name__ == "__main__":
+  testTemplateExpansion()
+  testTemplateReevaluation()
+  testInterpolateLocals()
+  testPerLedgerResume()
+  testBuildStepSkip()
@@ -0,0 +1,44 @@
+# Recipe used by core_test.py: per-loop ledger and incremental build steps
+from Pyxis.ModSupport import *
+
+def _record (name):
+  """Appends a line to the given file, so that the test can count how many times a step has run""";
+  with open(name,"a") as f:
+    f.write("ran\n");
+
+V_List = [1,2,3]
+FAIL = None
+
+def step ():
+  _record("ran-%s"%V);
+  if str(V) == str(FAIL):
+    abort("failing V=$V as asked");
+
+def loop ():
+  per("V",step);
+
+def ploop ():
+  pper("V",step);
+
+# build step parameters include a set (whose repr depends on PYTHONHASHSEED), an object (whose repr has
+# its address), and a global that is only used inside a comprehension
+LABELS = {"alpha","beta","gamma","delta"}
+OPTIONS = object()
+NITER = 1
+
+@produces("$OUT")
+def build (OUT="built.txt"):
+  _record("ran-build");
+  assert OPTIONS is not None;
+  with open(OUT,"w") as f:
+    f.write(" ".join([ "%s:%s"%(label,NITER) for label in sorted(LABELS) ])+"\n");
+
+# a step that only sees STEPS through an interpolated default
+STEPS = 10
+
+@produces("$OUT")
+def build2 (OUT="built2.txt",nsteps="$STEPS"):
+  nsteps = interpolate_locals("nsteps");
+  _record("ran-build2");
+  with open(OUT,"w") as f:
+    f.write("%s\n"%nsteps);